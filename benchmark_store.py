@@ -0,0 +1,124 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Benchmark store ###
+### Benchmark, spliced asset class and risk-free returns parsed once onto the month axis and kept as arrays ###
+import numpy as np
+import pandas as pd
+from month_axis import *
+from run_log import get_logger
+
+log = get_logger('benchmark_store')
+
+class BenchmarkStore(object):
+    """ Monthly returns (R+1) of every benchmark file, plain and fee adjusted
+
+    The months of benchmark names[i] are first_months[i] onwards, with its returns at
+    values[offsets[i]:offsets[i+1]] (fee adjusted: adjusted[...]).  Months without a return are NaN.
+    Series handed out are built once and memoized. """
+
+    columns = ['first_months', 'offsets', 'values', 'adjusted']
+
+    def __init__(self, names, first_months, offsets, values, adjusted):
+        self.names = list(names)
+        self.first_months = first_months
+        self.offsets = offsets
+        self.values = values
+        self.adjusted = adjusted
+        self._positions = dict((name, i) for i, name in enumerate(self.names))
+        self._memo = {}
+
+    @classmethod
+    def from_files(cls, index_path, sources, fees):
+        """ Parses each benchmark file once: sources is {benchmark: file name} (benchmark_source), fees the
+        annual fee to take off each benchmark when fee adjusted (benchmark_index_fees)
+
+        Files are tab separated with a Return column in percent.  Returns within the same month are
+        multiplied, as resample('M', how='prod') did """
+        names = sorted(sources.keys())
+        first_months, values, adjusted = [], [], []
+        for name in names:
+            log.debug('Parsing benchmark %s', name)
+            returns = pd.read_csv(index_path + sources[name], sep='\t', parse_dates=True)['Return']/100+1
+            months = month_ordinals(returns.index)
+            returns = np.asarray(returns, dtype=np.float64)
+            first_month, plain = monthly_products(months, returns)
+            first_month, adjusted_returns = monthly_products(months, returns - fees.get(name, 0) / 12)
+            first_months.append(first_month)
+            values.append(plain)
+            adjusted.append(adjusted_returns)
+        offsets = np.r_[0, np.cumsum([len(v) for v in values])].astype(np.int64)
+        return cls(names, np.array(first_months, dtype=np.int64), offsets,
+                   np.concatenate(values) if values else np.zeros(0), np.concatenate(adjusted) if adjusted else np.zeros(0))
+
+    def save(self, path):
+        """ Saves the arrays as one .npz file """
+        f = open(path, 'wb')
+        try:
+            np.savez(f, names=np.array(self.names), **dict((c, getattr(self, c)) for c in self.columns))
+        finally:
+            f.close()
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls([str(name) for name in data['names']], *[data[c] for c in cls.columns])
+
+    def months(self, name, fee_adjust=False):
+        """ (first month ordinal, array of returns) of a benchmark """
+        i = self._positions[name]
+        rows = slice(self.offsets[i], self.offsets[i+1])
+        return self.first_months[i], (self.adjusted if fee_adjust else self.values)[rows]
+
+    def series(self, name, fee_adjust=False):
+        """ Monthly return series of a benchmark, indexed by calendar month end (freq 'M', as resample gives) """
+        key = ('series', name, bool(fee_adjust))
+        if key not in self._memo:
+            first_month, returns = self.months(name, fee_adjust)
+            self._memo[key] = pd.Series(returns, index=month_end_index(first_month, first_month + len(returns) - 1),
+                                        name=name)
+        return self._memo[key].copy()
+
+    def spliced(self, benchmarks, name=None, fee_adjust=True):
+        """ Splices benchmarks in priority order (earlier ones win where they have a return), as splice_returns() """
+        key = ('spliced', tuple(benchmarks), name, bool(fee_adjust))
+        if key not in self._memo:
+            parts = [self.months(b, fee_adjust) for b in benchmarks]
+            first_month = min(first for first, returns in parts)
+            last_month = max(first + len(returns) - 1 for first, returns in parts)
+            spliced = np.empty(last_month - first_month + 1)
+            spliced.fill(np.nan)
+            for first, returns in reversed(parts):
+                rows = slice(first - first_month, first - first_month + len(returns))
+                spliced[rows] = np.where(np.isnan(returns), spliced[rows], returns)
+            self._memo[key] = pd.Series(spliced, index=month_end_index(first_month, last_month), name=name)
+        return self._memo[key].copy()
+
+def monthly_products(months, returns):
+    """ (first month, returns by month from the first to the last month) multiplying returns in the same month,
+    NaN for months without one """
+    if not len(months):
+        return 0, np.zeros(0)
+    first_month = months.min()
+    cells = months - first_month
+    order = np.argsort(cells, kind='mergesort')
+    cells, returns = cells[order], returns[order]
+    starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+    monthly = np.empty(cells[-1] + 1)
+    monthly.fill(np.nan)
+    monthly[cells[starts]] = np.multiply.reduceat(returns, starts)
+    return first_month, monthly
@@ -0,0 +1,188 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Benchmark suite ###
+### Times the data loading, bucketing and trial stages of the engine on a synthetic CRSP database ###
+from __future__ import division
+import os
+import sys
+import json
+import platform
+import logging
+import argparse
+import subprocess
+from datetime import date, datetime
+from time import time as wall_time
+from multiprocessing import cpu_count
+import sqlite3 as lite
+import numpy as np
+import pandas as pd
+from settings import config
+from synthetic_crsp import generate
+from run_log import setup_logging
+
+SUITE_VERSION = 2
+
+# modules whose import is timed: the trial engine alone (what worker processes need), the engine and the charts
+import_modules = ['trial_engine', 'engine', 'reporting']
+
+# comparison portfolio of the trials benchmark: asset class benchmarks, so it doesn't depend on fund numbers
+benchmark_portfolio = {'US_TotalMarket':{'alloc':0.6, 'funds':['US_TotalMarket']},
+                       'US_Bond_Total':{'alloc':0.4, 'funds':['US_Bond_Total']}}
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the engine on a synthetic CRSP database.')
+    parser.add_argument('--funds', type=int, default=10000, help='number of funds in the synthetic database')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic database')
+    parser.add_argument('--first_year', type=int, default=1962, help='first year of returns')
+    parser.add_argument('--last_year', type=int, default=2012, help='last year of returns')
+    parser.add_argument('--workdir', default='benchmark', help='directory for the synthetic databases and their caches')
+    parser.add_argument('--trials', type=int, default=2000, help='trials to time')
+    parser.add_argument('--batch_size', type=int, default=1000, help='trial batch size')
+    parser.add_argument('--workers', type=int, default=1, help='processes to run the trials and R2 on')
+    parser.add_argument('--repeat', type=int, default=3, help='times to run each benchmark')
+    parser.add_argument('--output', default='benchmark_results.json', help='results file (json)')
+    parser.add_argument('--baseline', default=None, help='earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction by which a benchmark may be slower than the baseline')
+    args = parser.parse_args()
+    setup_logging(logging.WARNING) # the engine's own log would only add to the timings
+
+    results = run_suite(args.funds, args.seed, args.first_year, args.last_year, args.workdir, args.trials,
+                        args.batch_size, args.workers, args.repeat)
+    f = open(args.output, 'w')
+    try:
+        json.dump(results, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    print_results(results)
+    print 'Wrote', args.output
+
+    if args.baseline:
+        f = open(args.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        if regressions(results, baseline, args.tolerance):
+            sys.exit(1)
+
+def run_suite(funds=10000, seed=0, first_year=1962, last_year=2012, workdir='benchmark', trials=2000, batch_size=1000,
+              workers=1, repeat=3):
+    """ Times the engine's stages on a synthetic database of funds funds (generated the first time, see
+    synthetic_crsp.py), returns the results as a json-able dict
+
+    Each stage is run repeat times, from the database (or rebuilt) rather than from the cache unless its
+    name says cached, and so is importing each of import_modules in a new process.  Trials per second is taken
+    from the median time of running the trials of one prepared scenario. """
+    data_dir = os.path.join(workdir, 'funds%d-seed%d-%d-%d' % (funds, seed, first_year, last_year))
+    db_path = os.path.join(data_dir, 'crsp.db')
+    index_dir = os.path.join(data_dir, 'indexes')
+    if not os.path.exists(db_path):
+        print 'Generating', db_path
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        started = wall_time()
+        generate(db_path + '.tmp', index_dir, funds=funds, seed=seed, first_year=first_year, last_year=last_year)
+        os.rename(db_path + '.tmp', db_path)
+        print 'Generated in %.1fs' % (wall_time() - started)
+
+    # the engine reads its paths from settings when first imported
+    config.update(db_path=db_path, index_path=index_dir + os.sep, cache_dir=os.path.join(data_dir, 'cache'))
+    import engine
+
+    timings = {}
+    def timed(name, f):
+        seconds = []
+        for i in range(repeat):
+            started = wall_time()
+            result = f()
+            seconds.append(round(wall_time() - started, 4))
+        timings[name] = timing(seconds)
+        return result
+
+    for module in import_modules:
+        timings['import ' + module] = timing([round(import_seconds(module), 4) for i in range(repeat)])
+
+    engine.check_fund_eligibility()
+    timed('get_all_fund_returns', lambda: engine.get_all_fund_returns(force_db_read=True))
+    timed('get_all_fund_returns (cached)', lambda: engine.get_all_fund_returns())
+    panel = timed('get_fund_returns_panel', lambda: engine.get_fund_returns_panel(force_rebuild=True))
+    timed('get_fund_returns_panel (cached)', lambda: engine.get_fund_returns_panel())
+    timed('get_unique_funds_from_groups', engine.get_unique_funds_from_groups)
+    timed('get_style_bucket_funds', lambda: engine.get_style_bucket_funds(panel, force_bucket=True))
+    timed('calc_all_fund_r2', lambda: engine.calc_all_fund_r2(panel, force_calc=True, workers=workers))
+    timed('get_fund_date_bounds', lambda: engine.get_fund_date_bounds(panel))
+
+    # same horizon as engine.py's defaults, as far as the data goes
+    start_date, end_date = date(max(first_year + 1, last_year - 16), 12, 25), date(last_year, 12, 31)
+    universe = engine.Universe(panel)
+    scenario = timed('prepare_scenario', lambda: engine.prepare_scenario(benchmark_portfolio, universe, start_date,
+                                                                         end_date, export=False))
+    timed('run_scenario', lambda: engine.run_scenario(scenario, trials, seed=seed, batch_size=batch_size,
+                                                      workers=workers, keep_diffs=False))
+
+    con = lite.connect(db_path)
+    try:
+        rows = dict((table, con.execute("select count(*) from %s;" % table).fetchone()[0])
+                    for table in ['FUND_HDR', 'FUND_STYLE', 'FUND_FEES', 'MONTHLY_RETURNS', 'MONTHLY_TNA'])
+    finally:
+        con.close()
+    return {'suite_version':SUITE_VERSION, 'created':datetime.now().isoformat(),
+            'scale':{'funds':funds, 'seed':seed, 'first_year':first_year, 'last_year':last_year, 'rows':rows,
+                     'portfolio_funds':dict((a, len(f)) for a, f in scenario.fund_lists.items())},
+            'run':{'trials':trials, 'batch_size':batch_size, 'workers':workers, 'repeat':repeat},
+            'environment':{'python':platform.python_version(), 'numpy':np.__version__, 'pandas':pd.__version__,
+                           'sqlite':lite.sqlite_version, 'platform':platform.platform(), 'cpus':cpu_count()},
+            'timings':timings,
+            'trials_per_second':round(trials / timings['run_scenario']['median'], 1)}
+
+def timing(seconds):
+    return {'seconds':seconds, 'min':min(seconds), 'median':float(np.median(seconds))}
+
+def import_seconds(module):
+    """ Seconds it takes a new python process to import a module (everything it imports included) """
+    code = 'from time import time; started = time(); import %s; print(time() - started)' % module
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    return float(subprocess.check_output([sys.executable, '-c', code], env=env).split()[-1])
+
+def print_results(results):
+    print 'Benchmarks on %(funds)s funds:' % results['scale']
+    for name in sorted(results['timings'].keys()):
+        print '  %-34s median %9.4fs  min %9.4fs' % (name, results['timings'][name]['median'], results['timings'][name]['min'])
+    print '  %-34s %.1f' % ('trials per second', results['trials_per_second'])
+
+def regressions(results, baseline, tolerance=0.25):
+    """ Benchmarks whose median time is more than tolerance slower than in the baseline results (both from
+    run_suite()), printed and returned as a list of names.  Results of a different scale or run aren't compared """
+    if results['scale'] != baseline['scale'] or results['run'] != baseline['run']:
+        print 'Baseline is of a different scale or run, not comparing'
+        return []
+    slower = []
+    for name, timing in sorted(results['timings'].items()):
+        if name not in baseline['timings']:
+            continue
+        ratio = timing['median'] / max(baseline['timings'][name]['median'], 1e-6)
+        print '  %-34s %.2fx the baseline' % (name, ratio)
+        if ratio > 1 + tolerance:
+            slower.append(name)
+    if slower:
+        print 'Slower than the baseline:', ', '.join(slower)
+    return slower
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Cache manager ###
+### Caches derived artifacts (returns, buckets, R2...) under a fingerprint of everything they were built from ###
+import os, shutil, gzip, hashlib
+import cPickle as pickle
+from run_log import get_logger
+
+# bump when a code change alters what a cached artifact contains, so old entries stop matching
+CODE_VERSION = 2
+
+log = get_logger('cache_manager')
+
+def file_fingerprint(path, sample_bytes=65536):
+    """ Fingerprint of a file: size, modification time and a hash of its first and last bytes """
+    if not os.path.isfile(path):
+        return (path, None)
+    st = os.stat(path)
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        h.update(f.read(sample_bytes))
+        if st.st_size > sample_bytes:
+            f.seek(max(st.st_size - sample_bytes, sample_bytes))
+            h.update(f.read(sample_bytes))
+    finally:
+        f.close()
+    return (path, st.st_size, int(st.st_mtime), h.hexdigest())
+
+def fingerprint(parts):
+    """ Stable hash of a nested structure of strings, numbers, lists, tuples and dicts """
+    h = hashlib.sha1()
+    def feed(x):
+        if isinstance(x, dict):
+            h.update('{')
+            for k in sorted(x.keys()):
+                feed(k)
+                feed(x[k])
+            h.update('}')
+        elif isinstance(x, (list, tuple)):
+            h.update('[')
+            for item in x:
+                feed(item)
+            h.update(']')
+        else:
+            h.update(repr(x))
+            h.update(',')
+    feed(parts)
+    return h.hexdigest()
+
+def dump_pickle(obj, path):
+    f = gzip.open(path, 'wb', 1)
+    try:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+
+def load_pickle(path):
+    f = gzip.open(path, 'rb')
+    try:
+        return pickle.load(f)
+    finally:
+        f.close()
+
+class ArtifactCache(object):
+    """ Directory of cached artifacts, each stored under name-key where key fingerprints its inputs
+
+    An artifact is valid as long as its inputs (database file, SQL text, mappings, upstream artifact keys
+    and CODE_VERSION) are unchanged, otherwise it is rebuilt on next use.  Entries are gzipped pickles
+    unless the artifact supplies its own dump/load (e.g. memory-mapped columns, which must stay
+    uncompressed).  Every hit touches the entry, and once the directory grows beyond max_bytes the least
+    recently used entries are removed. """
+
+    def __init__(self, cache_dir='cache', max_bytes=8*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, name, parts):
+        return fingerprint([name, CODE_VERSION, parts])[:20]
+
+    def path(self, name, parts):
+        return os.path.join(self.cache_dir, '%s-%s' % (name, self.key(name, parts)))
+
+    def has(self, name, parts):
+        return os.path.exists(self.path(name, parts))
+
+    def get(self, name, parts, build, force=False, dump=dump_pickle, load=load_pickle):
+        """ Returns the cached artifact for these inputs, building and storing it with build() if needed """
+        path = self.path(name, parts)
+        if not force and os.path.exists(path):
+            log.debug('Loading %s from cache: %s', name, path)
+            os.utime(path, None) # mark as recently used
+            return load(path)
+
+        log.info('Building %s (not cached for the current data/mappings/code)', name)
+        obj = build()
+        self.store(name, path, obj, dump)
+        return load(path) if load is not load_pickle else obj
+
+    def update(self, name, parts, source, build, refresh, force=False):
+        """ Like get(), for artifacts that can be brought up to date rather than rebuilt
+
+        The entry is keyed by parts alone and remembers the source fingerprint it was made from.  When the 
+        source changes (e.g. a new CRSP release) refresh(old artifact) updates it instead of build() """
+        path = self.path(name, parts)
+        if not force and os.path.exists(path):
+            old_source, obj = load_pickle(path)
+            os.utime(path, None) # mark as recently used
+            if old_source == source:
+                log.debug('Loading %s from cache: %s', name, path)
+                return obj
+            log.info('Updating %s for the current data/mappings', name)
+            obj = refresh(obj)
+        else:
+            log.info('Building %s (not cached)', name)
+            obj = build()
+        self.store(name, path, (source, obj))
+        return obj
+
+    def store(self, name, path, obj, dump=dump_pickle):
+        """ Writes an entry (through a temporary file, so readers never see half of it) """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_path = '%s.tmp%s' % (path, os.getpid())
+        dump(obj, tmp_path)
+        self.remove(path)
+        os.rename(tmp_path, path)
+        log.debug('Saved %s to cache: %s', name, path)
+        self.evict(keep=path)
+
+    def remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def entries(self):
+        """ (last_used, size, path) of every entry, least recently used first """
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if '.tmp' in name:
+                continue
+            if os.path.isdir(path):
+                size = sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files)
+            else:
+                size = os.path.getsize(path)
+            entries.append((os.path.getmtime(path), size, path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """ Removes least recently used entries until the cache fits in max_bytes """
+        entries = self.entries()
+        total = sum(size for last_used, size, path in entries)
+        for last_used, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            log.debug('Evicting cache entry %s', path)
+            self.remove(path)
+            total -= size
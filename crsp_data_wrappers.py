@@ -17,388 +17,364 @@
 
 ### Data functions ###
 ### These functions interact with a sqlite database of CRSP data, schema as of 12/31/2012 ###
-import os, sys
+import os, sys, threading
 import sqlite3 as lite
 from datetime import date, datetime, time
 from cStringIO import StringIO
 import numpy as np
 import pandas as pd
 from settings import config 
+from month_axis import dates_from_yyyymmdd
+from returns_store import ReturnsPanel
+from fund_catalog import FundCatalog
+from fee_index import FeeIndex
+from fund_eligibility import *
+from cache_manager import *
+from run_metrics import rss_bytes, budget_count, note
+from run_log import get_logger
 
-def get_fund_styles():
-    """ Gets fund styles using CRSP style codes for the purpose of bucketing """
-    try:
-        print "Getting fund styles from database"
-        con=None
-        con = lite.connect(config['db_path'])    
-        cur = con.cursor()    
-        # NEW CRSP style codes
-        # get style codes from DB - this query excludes fund that never had a style  
-        sql="""select crsp_fundno, crsp_obj_cd, max(begdt) from FUND_STYLE where crsp_obj_cd <> '' group by crsp_fundno;"""
-        cur.execute(sql) 
-        data = cur.fetchall()
-        print "Done getting styles"
+log = get_logger('crsp_data_wrappers')
+
+# rows of the fund returns query fetched at a time, and the bytes each one takes as python objects while fetched
+FETCH_CHUNK_ROWS = 100000
+FETCH_ROW_BYTES = 200
+
+# NEW CRSP style codes
+# get style codes from DB - this query excludes fund that never had a style  
+sql_fund_styles = """select crsp_fundno, crsp_obj_cd, max(begdt) from FUND_STYLE where crsp_obj_cd <> '' group by crsp_fundno;"""
+
+# sql query to get fee data for each fund. the end date is the time till which the fee is applicable for the fund
+sql_fund_fees = """select crsp_fundno,begdt,enddt,exp_ratio from FUND_FEES order by crsp_fundno, enddt;"""
+
+# the engine only reads the database (FUND_ELIGIBILITY is written by crsp_import.py), so connections are 
+# opened read-only and tuned for large sequential scans; sizes are overridable in settings.py
+tuning_pragmas = """PRAGMA mmap_size = %d; PRAGMA cache_size = -%d; PRAGMA temp_store = MEMORY;"""
+
+sql_fund_returns = """select mr.crsp_fundno, caldt, mret from FUND_ELIGIBILITY fe, MONTHLY_RETURNS mr 
+        where fe.crsp_fundno=mr.crsp_fundno  
+        and fe.load_ok = 1
+        ;"""
+
+sql_monthly_tna = """select crsp_fundno, substr(caldt,1,4) as year, mtna from MONTHLY_TNA where mtna <> '';"""
+
+class CrspDatabase(object):
+    """ Access to the CRSP sqlite database, shared by everything in a run
+    
+    Each thread (and each worker process after a fork) gets its own read-only connection, opened once 
+    and reused for every query, with the case sensitive LIKE and tuning pragmas applied at connect time.
+    Nothing here writes to the database: the FUND_ELIGIBILITY table the queries join on is built by 
+    crsp_import.py, and a run stops with an error if it is missing or out of date.
+    Errors are raised as sqlite3 exceptions to the caller.  Results derived from the database are cached 
+    in an ArtifactCache, see cache_manager.py.  With a memory_budget (bytes), large reads are fetched in 
+    chunks small enough to stay under it. """
+
+    def __init__(self, db_path, cache=None, mmap_size=2*1024**3, cache_kb=256*1024, memory_budget=None):
+        self.db_path = db_path
+        self.cache = cache if cache is not None else ArtifactCache()
+        self.mmap_size = mmap_size
+        self.cache_kb = cache_kb
+        self.memory_budget = memory_budget
+        self._local = threading.local()
+        self._eligibility_checked = False
+        self._catalog = None
+        self._fee_index = None
+
+    def connect(self):
+        """ Opens a new read-only connection (mode=ro URI, or the query_only pragma on Pythons whose sqlite3 
+        module doesn't take URIs) """
+        if not os.path.isfile(self.db_path):
+            # sqlite would silently create an empty database
+            raise lite.OperationalError('unable to open database file: %s' % self.db_path)
+        try:
+            con = lite.connect('file:%s?mode=ro' % self.db_path, uri=True)
+        except TypeError:
+            con = lite.connect(self.db_path)
+            con.execute("PRAGMA query_only = 1;")
+        con.executescript(pragmas + tuning_pragmas % (self.mmap_size, self.cache_kb))
+        return con
+
+    def connection(self):
+        """ The read-only connection of the calling thread, reopened after a fork """
+        con = getattr(self._local, 'con', None)
+        if con is None or self._local.pid != os.getpid():
+            con = self.connect()
+            self._local.con, self._local.pid = con, os.getpid()
+        return con
+
+    def close(self):
+        """ Closes the calling thread's connection """
+        con = getattr(self._local, 'con', None)
+        if con is not None and self._local.pid == os.getpid():
+            con.close()
+        self._local.con = None
+
+    def query(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    def fingerprint(self):
+        """ Fingerprint of the CRSP database file, part of the cache key of everything read from it """
+        return file_fingerprint(self.db_path)
+
+    ### Fund eligibility ###
+
+    def fund_eligibility_current(self):
+        """ True if FUND_ELIGIBILITY exists and was built with the current exclusion rules and FUND_HDR """
+        return fund_eligibility_current(self.connection())
+
+    def check_fund_eligibility(self):
+        """ Raises an error if FUND_ELIGIBILITY is missing or out of date (checked once per process) """
+        if not self._eligibility_checked and not self.fund_eligibility_current():
+            raise RuntimeError('FUND_ELIGIBILITY in %s is missing or out of date (the exclusion rules or FUND_HDR '
+                               'changed): run python crsp_import.py %s --classify' % (self.db_path, self.db_path))
+        self._eligibility_checked = True
+
+    def get_exclusion_reasons(self, fundno_list):
+        """ Why each of the supplied funds is excluded: {crsp_fundno: [reason, ...]}, empty list if eligible """
+        self.check_fund_eligibility()
+        data = self.query("select crsp_fundno, reasons from FUND_ELIGIBILITY where crsp_fundno in (%s);" 
+                          % ','.join(str(int(x)) for x in fundno_list))
+        return dict((fundno, [reason for reason, condition in exclusion_rules if mask & exclusion_bits[reason]])
+                    for fundno, mask in data)
+
+    ### Fund data ###
+
+    def get_fund_styles(self):
+        """ Gets fund styles using CRSP style codes for the purpose of bucketing """
+        log.debug('Getting fund styles from database')
+        data = self.query(sql_fund_styles)
+        log.debug('Done getting styles')
         rawdf =  pd.DataFrame(list(data),columns=['FundNo', 'StyleCode', 'BegDt'])
-        #reindex by fund number
-        rawdf.index = [rawdf['FundNo']]
+        #reindex by fund number (a flat index: a list of columns makes a one-level MultiIndex of tuples)
+        rawdf.index = pd.Index(rawdf['FundNo'])
         del rawdf['FundNo']
         # we actually don't need the date, just had it for purposes of the groupby
         del rawdf['BegDt']
         return rawdf 
-    except lite.Error, e:
-        print "Error %s:" % e.args[0]
-        sys.exit(1)
-        
-    finally:
-        if con:
-            con.close()    
-
-def get_fund_fees():
-    """ Gets expense ratios for the purpose of filtering criteria """
-    try:
-        print "Getting fund fees from database"
-        con=None
-        con = lite.connect(config['db_path'])    
-        cur = con.cursor()    
-        # sql query to get fee data for each fund. the end date is the time till which the fee is applicable for the fund
-        sql="""select crsp_fundno,begdt,enddt,exp_ratio from FUND_FEES order by crsp_fundno, enddt;"""  #
-        cur.execute(sql) 
-        data = cur.fetchall()
-        print "Done getting fees"
+
+    def get_fund_fees(self):
+        """ Gets expense ratios for the purpose of filtering criteria """
+        log.debug('Getting fund fees from database')
+        data = self.query(sql_fund_fees)
+        log.debug('Done getting fees')
         df = pd.DataFrame(list(data),columns=['FundNo', 'StartDate', 'EndDate', 'ExpRatio'])
         return df.groupby('FundNo').last()       
-    except lite.Error, e:
-        print "Error %s:" % e.args[0]
-        sys.exit(1)
-        
-    finally:
-        
-        if con:
-            con.close()
 
-# leave out variable annuity funds, institutional funds, non-retail funds, 
-# target data / balanced funds, and various non-applicable share classes
-# NOTE: Some funds were marked non-retail (e.g. ETFs), so we manually change the flag in order to use in analysis
-#    e.g. update FUND_HDR set retail_fund='Y' where crsp_fundno in ( 16429 ,31351, 31350, 16413,16432) ;
-
-common_excludes_data_load = """and vau_fund<>"Y"
-        and inst_fund <> 'Y' 
-        and retail_fund<>'N'
-        and fund_name not like '%2010%'
-        and fund_name not like '%2015%'
-        and fund_name not like '%2020%'
-        and fund_name not like '%2025%'
-        and fund_name not like '%2030%'
-        and fund_name not like '%2035%'
-        and fund_name not like '%2040%'
-        and fund_name not like '%2045%'
-        and fund_name not like '%2050%'
-        and fund_name not like '%2055%'
-        and fund_name not like '%2060%'
-        and fund_name not like '%130/30%'
-        and fund_name not like '%120/20%'
-        and fund_name not like '%Long/Short%'
-        and fund_name not like '%Long-Short%'
-        and fund_name not like '%Pacific Life%'
-        and fund_name not like '%MassMutual %'
-        and fund_name not like '%Transamerica %'
-        and fund_name not like '%/Instl' 
-        and fund_name not like '%/Y'
-        and fund_name not like '%/X' 
-        and fund_name not like '%/H' 
-        and fund_name not like '%/D' 
-        and fund_name not like '%/N' 
-        and fund_name not like '%/Z' 
-        and fund_name not like '%/Q' 
-        and fund_name not like '%/Ist'
-        and fund_name not like '%/Inst' 
-        and fund_name not like '%/P'
-        and fund_name not like '%/E'
-        and fund_name not like '%Institutional Class%'
-        and fund_name not like '%Institutional Shares%'
-        and fund_name not like '%Advisor Shares'
-        and fund_name not like '%R Shares'
-        and fund_name not like '%T Shares'
-        and fund_name not like '%M Shares'
-        and fund_name not like '%H Shares'
-        and fund_name not like '%I Shares'
-        and fund_name not like '%J Shares'
-        and fund_name not like '%G Shares'
-        and fund_name not like '%K Shares'
-        and fund_name not like '%N Shares'
-        and fund_name not like '%L Shares'
-        and fund_name not like '%P Shares'
-        and fund_name not like '%S Shares'
-        and fund_name not like '%E Shares'
-        and fund_name not like '%Y Shares'
-        and fund_name not like '%Z Shares'
-        and fund_name not like '%O Shares'
-        and fund_name not like '%Q Shares'
-        and fund_name not like '%A1 Shares'
-        and fund_name not like '%B1 Shares'
-        and fund_name not like '%C1 Shares'
-        and fund_name not like '%C2 Shares'
-        and fund_name not like '%R1 Shares'
-        and fund_name not like '%R5 Shares'
-        and fund_name not like '%D Shares'
-        and fund_name not like '%X Shares'
-        and fund_name not like '%529%'"""
-
-# We don't want index funds in regular active fund queries, but we do when loading data to the master set
-common_excludes = common_excludes_data_load + """
-        and fund_name not like '%Index Fund%'"""
-
-pragmas = """PRAGMA case_sensitive_like = true; """
-
-def get_unique_funds_from_groups():
-    """ gets crsp_cl_grp and crsp_portno to remove funds that are of the same root """
-    
-    # get funds in 4 groups, depending on the data available for them, since we'll 
-    # process each differently
-    sql_no_grp_no_portno = """select crsp_fundno, crsp_cl_grp, crsp_portno, fund_name From FUND_HDR  
-    where crsp_cl_grp = '' 
-    and crsp_portno = '' 
-    %s 
-    order by fund_name, first_offer_dt asc, end_dt desc;""" % common_excludes     
-        
-    sql_no_grp = """select crsp_fundno, crsp_cl_grp, crsp_portno, fund_name From FUND_HDR 
-    where crsp_cl_grp = '' 
-    and crsp_portno <> ''
-    %s 
-    order by crsp_cl_grp, crsp_portno, fund_name asc, first_offer_dt asc, end_dt desc;""" % common_excludes 
-    
-    sql_no_portno = """
-    select crsp_fundno, crsp_cl_grp, crsp_portno, fund_name From FUND_HDR 
-    where crsp_cl_grp <> '' 
-    and crsp_portno = ''
-    %s 
-    order by crsp_cl_grp, crsp_portno, fund_name asc, first_offer_dt asc, end_dt desc;""" % common_excludes
-
-    sql_both = """
-    select crsp_fundno, crsp_cl_grp, crsp_portno, fund_name From FUND_HDR 
-    where crsp_cl_grp <> '' 
-    and crsp_portno <> ''
-    %s 
-    order by crsp_cl_grp, crsp_portno, fund_name asc, first_offer_dt asc, end_dt desc;""" % common_excludes
-
-    try:
-        print "Getting fund groups from database"
-        con = None
-        con = lite.connect(config['db_path'])    
-        cur = con.cursor()     
-        #setup pragmas
-        cur.execute(pragmas)        
+    def get_fund_fee_index(self):
+        """ Point-in-time expense ratios of all funds (see fee_index.py), read once and kept for the run """
+        if self._fee_index is None:
+            log.debug('Getting fund fee history from database')
+            self._fee_index = FeeIndex.from_rows(self.query(sql_fund_fees))
+        return self._fee_index
+
+    def get_unique_funds_from_groups(self):
+        """ gets crsp_cl_grp and crsp_portno to remove funds that are of the same root """
+        
+        # get funds in 4 groups, depending on the data available for them, since we'll 
+        # process each differently
+        sql_no_grp_no_portno = """select crsp_fundno, crsp_cl_grp, crsp_portno, fund_name From FUND_HDR  
+        where crsp_cl_grp = '' 
+        and crsp_portno = '' 
+        %s 
+        order by fund_name, first_offer_dt asc, end_dt desc;""" % common_excludes     
+            
+        sql_no_grp = """select crsp_fundno, crsp_cl_grp, crsp_portno, fund_name From FUND_HDR 
+        where crsp_cl_grp = '' 
+        and crsp_portno <> ''
+        %s 
+        order by crsp_cl_grp, crsp_portno, fund_name asc, first_offer_dt asc, end_dt desc;""" % common_excludes 
+        
+        sql_no_portno = """
+        select crsp_fundno, crsp_cl_grp, crsp_portno, fund_name From FUND_HDR 
+        where crsp_cl_grp <> '' 
+        and crsp_portno = ''
+        %s 
+        order by crsp_cl_grp, crsp_portno, fund_name asc, first_offer_dt asc, end_dt desc;""" % common_excludes
+
+        sql_both = """
+        select crsp_fundno, crsp_cl_grp, crsp_portno, fund_name From FUND_HDR 
+        where crsp_cl_grp <> '' 
+        and crsp_portno <> ''
+        %s 
+        order by crsp_cl_grp, crsp_portno, fund_name asc, first_offer_dt asc, end_dt desc;""" % common_excludes
+
+        self.check_fund_eligibility()
+        log.debug('Getting fund groups from database')
         
         # without a portno or grp to use, we resort to parsing names by "/" and drop any with common roots        
-        cur.execute(sql_no_grp_no_portno) 
-        data = cur.fetchall()
+        data = self.query(sql_no_grp_no_portno) 
         df_no_grp_no_portno = pd.DataFrame(list(data),columns=['crsp_fundno','crsp_cl_grp', 'crsp_portno', 'fund_name'])
-        df_no_grp_no_portno.index=[df_no_grp_no_portno['crsp_fundno']]
+        df_no_grp_no_portno.index = pd.Index(df_no_grp_no_portno['crsp_fundno'])
 
         trimmed_names = df_no_grp_no_portno['fund_name'].map(lambda x: x.rsplit('/',1)[0])        
         unique_names = trimmed_names.drop_duplicates()
         
         # drop duplicate portfolios by portno
-        cur.execute(sql_no_grp) 
-        data = cur.fetchall()
+        data = self.query(sql_no_grp) 
         df_no_grp = pd.DataFrame(list(data),columns=['crsp_fundno','crsp_cl_grp', 'crsp_portno', 'fund_name'])
-        df_no_grp.index = [df_no_grp['crsp_fundno']]
+        df_no_grp.index = pd.Index(df_no_grp['crsp_fundno'])
         unique_portfs = df_no_grp['crsp_portno'].drop_duplicates()        
 
         # drop duplicate portfoliios by cl_grp
-        cur.execute(sql_no_portno) 
-        data = cur.fetchall()
+        data = self.query(sql_no_portno) 
         df_no_portno = pd.DataFrame(list(data),columns=['crsp_fundno','crsp_cl_grp', 'crsp_portno', 'fund_name'])
-        df_no_portno.index = [df_no_portno['crsp_fundno']]
+        df_no_portno.index = pd.Index(df_no_portno['crsp_fundno'])
         unique_grps = df_no_portno['crsp_cl_grp'].drop_duplicates()        
         
         # if both fields available, drop duplicates by cl_grp
-        cur.execute(sql_both) 
-        data = cur.fetchall()
+        data = self.query(sql_both) 
         df_both = pd.DataFrame(list(data),columns=['crsp_fundno','crsp_cl_grp', 'crsp_portno', 'fund_name'])
-        df_both.index = [df_both['crsp_fundno']]
+        df_both.index = pd.Index(df_both['crsp_fundno'])
         unique_both = df_both['crsp_cl_grp'].drop_duplicates()        
         
         # return everything together
         return unique_both.index.append(unique_grps.index.append(unique_portfs.index.append(unique_names.index)))
-        
-    except lite.Error, e:
-        print "Error %s:" % e.args[0]
-        sys.exit(1)
-        
-    finally:
-        
-        if con:
-            con.close()    
-
-def get_pure_index_funds():
-    """ gets list of pure index funds to optionally exclude from active fund list """
-    try:
-        con=None
-        con = lite.connect(config['db_path'])    
-        cur = con.cursor()      
-        sql = """select crsp_fundno from FUND_HDR where index_fund_flag in ('D');"""
-        cur.execute(sql) 
-        data = cur.fetchall()
+
+    def get_pure_index_funds(self):
+        """ gets list of pure index funds to optionally exclude from active fund list """
+        data = self.query("""select crsp_fundno from FUND_HDR where index_fund_flag in ('D');""")
         return list(pd.DataFrame(list(data),columns=['crsp_fundno'])['crsp_fundno'])
-    except lite.Error, e:
-        print "Error %s:" % e.args[0]
-        sys.exit(1)
-        
-    finally:
-        
-        if con:
-            con.close()
 
-def get_all_fund_returns(force_db_read=False, df_file = 'fund_returns_lite_nona_reindex.pandas'):
-    """ Reads returns for all funds from the database (excludes some things we aren't interested in """
-    # caching to make things faster most of the time
-    if not force_db_read and os.path.isfile(df_file):
-        print "Loading file from cache:",df_file
-        return pd.load(df_file)
-    #otherwise read from db
-    print "Reading fund returns from the database"
-    try:
-        con = lite.connect(config['db_path'])   
-        cur = con.cursor()      
-        
-        # run pragmas (case sensivity on)
-        cur.execute(pragmas)
-        
-        sql= """select mr.crsp_fundno, caldt, mret from FUND_HDR fhdr, MONTHLY_RETURNS mr 
-        where fhdr.crsp_fundno=mr.crsp_fundno  
-        %s
-        ;""" % common_excludes_data_load 
-        cur.execute(sql)
-        data = cur.fetchall()
-        
-        print 'Parsing database results (those pesky date parses take a little while)'
- 
-        df = pd.DataFrame(list(data),columns=['FundNo', 'StrCalDate', 'Return'])
-        
-        # parse the date column (string slicing is faster than datetime.strptime)
-        parsed_dates = df['StrCalDate'].map(lambda x: date(int(str(x)[0:4]),int(str(x)[4:6]),int(str(x)[6:8]) ))
-        
-        # add back to the dataframe
-        df['CalDate'] = pd.Series(parsed_dates,index=df.index) 
-        
-        # remove unneeded column
-        del df['StrCalDate']
-        # change -99 values to NaN, then drop them
-        print 'Drop the -99.0 values'
-        df=df.replace({'Return':-99.0}, value=np.nan)
-        df=df.dropna(subset=['Return'])
-        # add one to all the returns per our convention
-        df['Return']=pd.Series(df['Return'],index=df.index) + 1
+    def get_fund_catalog(self):
+        """ Metadata of every fund in FUND_HDR (see fund_catalog.py), read once and kept for the run """
+        if self._catalog is None:
+            self._catalog = FundCatalog.from_rows(self.query("select %s from FUND_HDR;" % ', '.join(FundCatalog.columns)))
+        return self._catalog
 
-        print 'Re-index by FundNo and Date'
-        df.index = [df['FundNo'],pd.DatetimeIndex(df['CalDate'])]
-        
-        # now that these are indexes, no need to keep the column data
-        del df['CalDate']
-        del df['FundNo']
-        
-        #save the file for next time
-        print "Saving returns dataframe for next time as",df_file 
-        df.save(df_file)
-        
-        return df
-        
-    except lite.Error, e:
-        
-        print "Error %s:" % e.args[0]
-        sys.exit(1)
-        
-            
-def get_fund_info(fundno_list, printout=True):
-    """ Gets the supplied fund names and tickers, mostly for logging purposes """
-    try:
-        con = lite.connect(config['db_path'])   
-        cur = con.cursor()    
-        
-        sql = """select crsp_fundno, fund_name, nasdaq 
-        from FUND_HDR hdr where 
-        crsp_fundno in (%s);"""   
-        
-        # get all funds specified, if actually a fund (int) and not an index
-        cur.execute(sql % ','.join(str(x) for x in fundno_list if type(x)==int or type(x)==np.int64))   
-        
-        data = cur.fetchall() 
+    def get_fund_info(self, fundno_list, printout=True):
+        """ Gets the supplied fund names and tickers, mostly for logging purposes """
+        catalog = self.get_fund_catalog()
         if printout:
-            for fund in data:
-                print '%s - %s (%s)' % (fund[2] if fund[2] else '(Unknown)',fund[1],fund[0])
+            catalog.log_funds(fundno_list)
+        return catalog.info(fundno_list)
 
-        return list(data)
-        
-    except lite.Error, e:
-        
-        print "Error %s:" % e.args[0]
-        sys.exit(1)
-        
-    finally:
-        
-        if con:
-            con.close()            
-
-def get_all_live_funds():
-    """ gets a list of all funds that are not dead """
-    try:
-        con = lite.connect(config['db_path'])   
-        cur = con.cursor()    
-        
-        sql = """select crsp_fundno 
+    def get_all_live_funds(self):
+        """ gets a list of all funds that are not dead """
+        data = self.query("""select crsp_fundno 
         from FUND_HDR hdr where 
-        dead_flag='N';"""   
-        
-        cur.execute(sql)   
-        data = cur.fetchall() 
+        dead_flag='N';""")
         #convert to a list (shortcut..maybe we should use a row_factory)
         return map(list,zip(*data))[0]
+
+    ### Fund returns ###
+
+    def fund_returns_fingerprint(self):
+        """ Cache inputs of the fund returns: database, query and exclusion rules """
+        self.check_fund_eligibility()
+        return [self.fingerprint(), sql_fund_returns, eligibility_fingerprint()]
+
+    def get_all_fund_returns(self, force_db_read=False):
+        """ Reads returns for all funds from the database (excludes some things we aren't interested in """
+        # caching to make things faster most of the time
+        return self.cache.get('fund_returns', self.fund_returns_fingerprint(), self.read_all_fund_returns, 
+                              force=force_db_read)
+
+    def read_all_fund_returns(self):
+        """ Reads the get_all_fund_returns() data from the database, bypassing the cache """
+        fundnos, caldts, returns = self.read_fund_return_arrays()
         
-    except lite.Error, e:
-        
-        print "Error %s:" % e.args[0]
-        sys.exit(1)
-        
-    finally:
-        
-        if con:
-            con.close()       
-       
-def get_annual_total_net_assets(force_db_read=False, df_file = 'monthlytna.pandas'):
-    """ gets average total net assets per fund per year 
-    
-    NOTE: This is not used in the current iteration of research    
-    """
-    # caching to make things faster most of the time
-    if not force_db_read and os.path.isfile(df_file):
-        print "Loading file from cache:",df_file
-        return pd.load(df_file)
-    #otherwise read from db    
-    try:
-        print "Getting Total Net Assets from database"
-        con=None
-        con = lite.connect(config['db_path'])    
-        cur = con.cursor()      
-        sql = """select crsp_fundno, substr(caldt,1,4) as year, mtna from MONTHLY_TNA where mtna <> '';"""
-        cur.execute(sql) 
-        data = cur.fetchall()
-        print "Done getting Total Net Assets"
+        log.debug('Re-index by FundNo and Date')
+        index = pd.MultiIndex.from_arrays([fundnos.astype(np.int64), dates_from_yyyymmdd(caldts)])
+        return pd.DataFrame({'Return':returns}, index=index, columns=['Return'])
+
+    def read_fund_return_arrays(self, chunk_rows=None):
+        """ Streams the fund returns query into arrays, returns (crsp_fundno, caldt as YYYYMMDD, return+1)
+        
+        Rows are fetched chunk_rows at a time into arrays preallocated from the size of MONTHLY_RETURNS, so
+        only one chunk of rows is ever held as python objects.  By default that is FETCH_CHUNK_ROWS, or fewer
+        if the memory budget can't hold them next to the arrays.  Missing (-99.0) returns are dropped. """
+        log.info('Reading fund returns from the database')
+        self.check_fund_eligibility()
+        cur = self.connection().cursor()
+        
+        # the join only removes rows, so the table size is enough room
+        cur.execute("select count(*) from MONTHLY_RETURNS;")
+        capacity = cur.fetchone()[0]
+        fundnos = np.empty(capacity, dtype=np.int32)
+        caldts = np.empty(capacity, dtype=np.int32)
+        returns = np.empty(capacity, dtype=np.float64)
+        if chunk_rows is None:
+            # the arrays aren't resident until they are written to
+            chunk_rows = budget_count(self.memory_budget, FETCH_ROW_BYTES, FETCH_CHUNK_ROWS, 
+                                      used=rss_bytes() + capacity * 16, minimum=1000)
+        note('fetch_chunk_rows', chunk_rows)
+        
+        cur.execute(sql_fund_returns)
+        n = 0
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                break
+            chunk = np.array(rows, dtype=np.float64)
+            fundnos[n:n+len(chunk)] = chunk[:,0]
+            caldts[n:n+len(chunk)] = chunk[:,1]
+            returns[n:n+len(chunk)] = chunk[:,2]
+            n += len(chunk)
+        log.debug('Read %s returns, dropping the -99.0 values', n)
+        
+        keep = (returns[:n] != -99.0) & ~np.isnan(returns[:n])
+        # add one to all the returns per our convention
+        return fundnos[:n][keep], caldts[:n][keep], returns[:n][keep] + 1
+
+    def get_fund_returns_panel(self, force_rebuild=False, fund_returns=None):
+        """ Memory-mapped columnar (CSR) version of get_all_fund_returns(), see returns_store.py
+        
+        Built from the pandas returns (fund_returns) or straight from the database the first time and then 
+        opened straight from its uncompressed .npy files in the cache """
+        def build():
+            if fund_returns is not None:
+                return ReturnsPanel.from_frame(fund_returns)
+            return ReturnsPanel.from_arrays(*self.read_fund_return_arrays())
+        return self.cache.get('fund_returns_panel', self.fund_returns_fingerprint(), build, force=force_rebuild,
+                              dump=lambda panel, path: panel.save(path), load=ReturnsPanel.load)
+
+    ### Total net assets ###
+
+    def get_annual_total_net_assets(self, force_db_read=False):
+        """ gets average total net assets per fund per year 
+        
+        NOTE: This is not used in the current iteration of research    
+        """
+        # caching to make things faster most of the time
+        return self.cache.get('monthlytna', [self.fingerprint(), sql_monthly_tna], self.read_annual_total_net_assets, 
+                              force=force_db_read)
+
+    def read_annual_total_net_assets(self):
+        """ Reads the get_annual_total_net_assets() data from the database, bypassing the cache """
+        log.debug('Getting Total Net Assets from database')
+        data = self.query(sql_monthly_tna)
+        log.debug('Done getting Total Net Assets')
         df = pd.DataFrame(list(data),columns=['FundNo','Year','mtna'],dtype=np.float64) 
 
         df=df.replace({'mtna':-99.0}, value=np.nan)
         df.dropna(subset=['mtna'])
 
         grouped = df.groupby(['FundNo','Year'])
-        tna_means = grouped.mean()
-        print "Saving monthly TNA dataframe for next time as",df_file
-        tna_means.save(df_file)
-        return tna_means
-    except lite.Error, e:
-        print "Error %s:" % e.args[0]
-        sys.exit(1)
-
-    finally:
-
-        if con:
-            con.close()
\ No newline at end of file
+        return grouped.mean()
+
+# cache for everything derived from the database, see cache_manager.py
+artifact_cache = ArtifactCache(config.get('cache_dir', 'cache'), config.get('cache_max_bytes', 8*1024**3))
+
+# the database of this run; connections are only opened on first use
+crsp_db = CrspDatabase(config['db_path'], artifact_cache, 
+                       mmap_size=config.get('db_mmap_size', 2*1024**3), cache_kb=config.get('db_cache_kb', 256*1024),
+                       memory_budget=config.get('memory_budget'))
+
+# module level names for the methods, as used throughout the engine
+db_fingerprint = crsp_db.fingerprint
+check_fund_eligibility = crsp_db.check_fund_eligibility
+get_exclusion_reasons = crsp_db.get_exclusion_reasons
+get_fund_styles = crsp_db.get_fund_styles
+get_fund_fees = crsp_db.get_fund_fees
+get_fund_fee_index = crsp_db.get_fund_fee_index
+get_unique_funds_from_groups = crsp_db.get_unique_funds_from_groups
+get_pure_index_funds = crsp_db.get_pure_index_funds
+get_fund_catalog = crsp_db.get_fund_catalog
+get_fund_info = crsp_db.get_fund_info
+get_all_live_funds = crsp_db.get_all_live_funds
+fund_returns_fingerprint = crsp_db.fund_returns_fingerprint
+get_all_fund_returns = crsp_db.get_all_fund_returns
+read_all_fund_returns = crsp_db.read_all_fund_returns
+read_fund_return_arrays = crsp_db.read_fund_return_arrays
+get_fund_returns_panel = crsp_db.get_fund_returns_panel
+get_annual_total_net_assets = crsp_db.get_annual_total_net_assets
+read_annual_total_net_assets = crsp_db.read_annual_total_net_assets
@@ -0,0 +1,185 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### CRSP importer ###
+### Bulk loads the CRSP pipe-delimited files into sqlite using the CREATE TABLE/.import scripts in ./schema ###
+import os, re, csv, time
+import sqlite3 as lite
+import argparse
+import logging
+from run_log import get_logger, setup_logging
+from run_metrics import parse_bytes, format_bytes, budget_count
+from fund_eligibility import build_fund_eligibility
+
+log = get_logger('crsp_import')
+
+schema_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema')
+schema_part1 = os.path.join(schema_dir, 'mfdb_create_load_procedure_sqlite_part1.txt')
+schema_part2 = os.path.join(schema_dir, 'mfdb_create_table_sqlite_part2_notused.txt')
+
+# the whole load is one transaction on a fresh file, so there is nothing for a journal to protect
+load_pragmas = """PRAGMA synchronous = OFF; PRAGMA journal_mode = OFF; PRAGMA locking_mode = EXCLUSIVE;
+PRAGMA temp_store = MEMORY; PRAGMA cache_size = -1048576;"""
+
+# secondary indexes for the queries in crsp_data_wrappers.py (the primary keys cover lookups by crsp_fundno)
+indexes = [
+    # get_fund_styles(): latest non-blank style per fund, answered from the index alone
+    ('FUND_STYLE', "create index idx_fund_style_obj on FUND_STYLE (crsp_fundno, begdt, crsp_obj_cd);"),
+    # get_fund_fees(): ordered by crsp_fundno, enddt
+    ('FUND_FEES', "create index idx_fund_fees_enddt on FUND_FEES (crsp_fundno, enddt, begdt, exp_ratio);"),
+    # get_unique_funds_from_groups(), get_pure_index_funds(), get_all_live_funds()
+    ('FUND_HDR', "create index idx_fund_hdr_groups on FUND_HDR (crsp_cl_grp, crsp_portno);"),
+    ('FUND_HDR', "create index idx_fund_hdr_index_flag on FUND_HDR (index_fund_flag);"),
+    ('FUND_HDR', "create index idx_fund_hdr_dead on FUND_HDR (dead_flag);"),
+    # returns and net assets by date
+    ('MONTHLY_RETURNS', "create index idx_monthly_returns_caldt on MONTHLY_RETURNS (caldt);"),
+    ('MONTHLY_TNA', "create index idx_monthly_tna_caldt on MONTHLY_TNA (caldt);"),
+    ]
+
+# rows inserted per executemany, and the bytes a row takes as a list of strings (plus per column)
+IMPORT_BATCH_ROWS = 50000
+IMPORT_ROW_BYTES = 100
+IMPORT_FIELD_BYTES = 50
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import of the CRSP mutual fund ascii files into sqlite.')
+    parser.add_argument('db_path', help='sqlite database to create or add tables to')
+    parser.add_argument('data_dir', nargs='?', help='directory holding the CRSP .TXT files')
+    parser.add_argument('--part2', action='store_true',
+                        help='also load the tables of the part2 schema (daily data, holdings...)')
+    parser.add_argument('--skip-header', action='store_true',
+                        help='drop the first line of each file (column names)')
+    parser.add_argument('--memory-budget', type=parse_bytes, default=None,
+                        help='memory the import should stay under, e.g. 2G: picks the insert batch size')
+    parser.add_argument('--classify', action='store_true',
+                        help='only classify the funds of a loaded database again (after changing the exclusion rules or FUND_HDR)')
+    parser.add_argument('--quiet', action='store_true', help='only log warnings and errors')
+    parser.add_argument('--log-json', '--log_json', action='store_true', help='log json lines instead of text')
+    args = parser.parse_args()
+    setup_logging(logging.WARNING if args.quiet else logging.INFO, args.log_json)
+    if args.classify:
+        build_eligibility(args.db_path)
+        return
+    if not args.data_dir:
+        parser.error('data_dir is needed to import')
+
+    scripts = [schema_part1] + ([schema_part2] if args.part2 else [])
+    import_crsp(args.db_path, args.data_dir, scripts, skip_header=args.skip_header, memory_budget=args.memory_budget)
+
+def parse_schema(path):
+    """ (table, create statement, file name) for each table of a sqlite load script, in script order
+
+    Tables without an .import line come with a file name of None """
+    script = open(path).read()
+    imports = dict((table, filename) for filename, table in re.findall(r"^\.import\s+'([^']+)'\s+(\w+)", script, re.M))
+    return [(table, create, imports.get(table))
+            for create, table in re.findall(r'(CREATE TABLE\s+(\w+)\s*\(.*?\)\s*;)', script, re.S)]
+
+def read_rows(path, n_columns, skip_header=False):
+    """ Rows of a pipe-delimited file as lists of strings, like the sqlite shell's .import
+
+    Fields are kept as text (empty fields stay '', they are not NULL) and column affinity converts them on
+    insert.  Quotes get no special meaning. """
+    f = open(path, 'rb')
+    try:
+        reader = csv.reader(f, delimiter='|', quoting=csv.QUOTE_NONE)
+        if skip_header:
+            next(reader, None)
+        for row in reader:
+            if len(row) != n_columns:
+                raise ValueError('%s line %s: expected %s columns but found %s' %
+                                 (path, reader.line_num, n_columns, len(row)))
+            yield row
+    finally:
+        f.close()
+
+def import_table(con, table, path, skip_header=False, batch_rows=IMPORT_BATCH_ROWS):
+    """ Inserts a file into an existing table, returns (rows read, rows inserted) """
+    n_columns = table_columns(con, table)
+    sql = "insert or ignore into %s values (%s);" % (table, ','.join(['?']*n_columns))
+    rows = read_rows(path, n_columns, skip_header)
+    read = inserted = 0
+    while True:
+        batch = [row for row, i in zip(rows, xrange(batch_rows))]
+        if not batch:
+            break
+        before = con.total_changes
+        con.executemany(sql, batch)
+        read += len(batch)
+        inserted += con.total_changes - before
+    return read, inserted
+
+def table_columns(con, table):
+    return len(con.execute("PRAGMA table_info(%s);" % table).fetchall())
+
+def import_crsp(db_path, data_dir, scripts, skip_header=False, memory_budget=None):
+    """ Creates and loads the tables of the schema scripts, then indexes and analyzes the database
+
+    Tables that already exist are left alone, so the part2 tables can be added to a loaded database later.
+    With a memory_budget (bytes), each table is inserted in batches small enough to stay under it. """
+    con = lite.connect(db_path, isolation_level=None)
+    # load bytes as the shell does, whatever the encoding of the files
+    con.text_factory = str
+    try:
+        con.executescript(load_pragmas)
+        con.execute("begin;")
+        existing = set(row[0] for row in con.execute("select name from sqlite_master where type = 'table';"))
+        created = []
+        for script in scripts:
+            for table, create, filename in parse_schema(script):
+                if table in existing:
+                    log.info('Skipping %s (already in the database)', table)
+                    continue
+                con.execute(create)
+                existing.add(table)
+                created.append(table)
+                if filename is None:
+                    continue
+                start = time.time()
+                batch_rows = budget_count(memory_budget, IMPORT_ROW_BYTES + IMPORT_FIELD_BYTES * table_columns(con, table),
+                                          IMPORT_BATCH_ROWS, minimum=100)
+                read, inserted = import_table(con, table, os.path.join(data_dir, filename), skip_header, batch_rows)
+                log.info('Loaded %s: %s rows in %.1fs', table, inserted, time.time() - start)
+                if memory_budget:
+                    log.info('  in batches of %s rows (memory budget %s)', batch_rows, format_bytes(memory_budget))
+                if inserted < read:
+                    log.info('  %s duplicate rows ignored', read - inserted)
+
+        log.info('Creating indexes')
+        for table, sql in indexes:
+            if table in created:
+                con.execute(sql)
+        con.execute("commit;")
+
+        log.info('Analyzing')
+        con.execute("ANALYZE;")
+    except:
+        # without a journal there is no rollback to fall back on
+        log.error('Import failed, %s is incomplete and should be deleted before trying again', db_path)
+        raise
+    finally:
+        con.close()
+
+    if 'FUND_HDR' in created:
+        build_eligibility(db_path)
+
+def build_eligibility(db_path):
+    """ Classifies the funds into FUND_ELIGIBILITY (see fund_eligibility.py), after a load or with --classify """
+    build_fund_eligibility(db_path) # logs its own progress
+
+if __name__ == "__main__":
+    main()
@@ -15,19 +15,33 @@
 
 from __future__ import division  #needed so python deals with floats and division properly
 import sys, os, types
+import logging
+import cProfile, pstats
 from datetime import date, datetime
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from mpl_toolkits.axes_grid.anchored_artists import AnchoredText
 import argparse
 import math
+from multiprocessing import cpu_count
 from settings import config 
 from metamappings import *
 from crsp_data_wrappers import *
 from portfolios import *
+from returns_store import *
+from fund_timeline import *
+from fund_buckets import *
+from r2_engine import *
+from fee_index import *
+from benchmark_store import *
+from trial_engine import *
+from horizon_grid import *
+from trial_results import *
+from trial_summary import *
+from run_metrics import *
+from run_log import *
 
 con = None
+log = get_logger('engine')
 
 def main():
     parser = argparse.ArgumentParser(description='CRSP Data passive/active engine.')
@@ -51,15 +65,78 @@ def main():
                                            help='number of active funds to pick for each asset class')    
     parser.add_argument('--addbias', action='store_true',
                                                help='removes dead funds, introducing survivorship bias')     
+    parser.add_argument('--seed', type=int, default=None,
+                                               help='random seed, for reproducible trials: a seed gives the same trials at the same batch size only, '
+                                                    'and seeds from before the trials were batched give different trials')
+    parser.add_argument('--workers', type=int, default=1,
+                                               help='number of processes to run the trials on')
+    parser.add_argument('--fee_at_replacement', action='store_true',
+                                               help='apply the fee quantile to the fees at each replacement date')
+    parser.add_argument('--results', default=None,
+                                               help='trial results file, appended to as trials finish (default: <name>_trials.bin)')
+    parser.add_argument('--resume', action='store_true',
+                                               help='continue the run in the results file from its last checkpoint')
+    parser.add_argument('--quiet', action='store_true',
+                                               help='only log warnings and errors')
+    parser.add_argument('--verbose', action='store_true',
+                                               help='also log the detail of every step (debug level)')
+    parser.add_argument('--log_json', action='store_true',
+                                               help='log json lines instead of text, for other tools to read')
+    parser.add_argument('--trial_log', default=None,
+                                               help='json lines file of every trial: the funds drawn and the results')
+    parser.add_argument('--start_years', type=int, nargs=2, default=None, metavar=('FIRST', 'LAST'),
+                                               help='horizon grid: every start year from FIRST to LAST, to end_year')
+    parser.add_argument('--windows', type=int, nargs='+', default=None, metavar='YEARS',
+                                               help='horizon grid: rolling windows of these lengths from start_year to end_year')
+    parser.add_argument('--profile', action='store_true',
+                                               help='write phase timings and counters to <name>_metrics.json and a Chrome trace to <name>_trace.json')
+    parser.add_argument('--profile_trials', action='store_true',
+                                               help='also run the trial loop under cProfile, saved to <name>_trials.prof (top functions in <name>_trials.txt)')
+    parser.add_argument('--trace_malloc', action='store_true',
+                                               help='with --profile, also list the top allocators of each stage (needs tracemalloc)')
+    parser.add_argument('--memory_budget', '--memory-budget', type=parse_bytes, default=config.get('memory_budget'),
+                                               help='memory the run should stay under, e.g. 4G: picks the trial batch and database chunk sizes')
+    parser.add_argument('--no_plot', '--no-plot', action='store_true',
+                                               help="don't draw the graphs (and don't load matplotlib), only write the csv outputs")
     args = parser.parse_args()
+    if args.start_years or args.windows:
+        single_run = [flag for flag, used in [('--results', args.results), ('--resume', args.resume), 
+                                              ('--trial_log', args.trial_log), ('--profile_trials', args.profile_trials),
+                                              ('--no_plot', args.no_plot)] if used]
+        if single_run:
+            parser.error('%s cannot be used with a horizon grid (--start_years/--windows)' % ', '.join(single_run))
+    setup_logging(logging.WARNING if args.quiet else logging.DEBUG if args.verbose else logging.INFO, args.log_json)
 
     try:
         comparison_portfolio_def = eval(args.portfolio_name)
     except NameError:
-        print 'Portfolio', args.portfolio_name, 'is not defined.  Check portfolios.py'
+        log.error('Portfolio %s is not defined.  Check portfolios.py', args.portfolio_name)
         return
+    if args.trace_malloc and not metrics.trace_allocations():
+        log.warning('Not tracing allocations, tracemalloc is not available')
+    if args.memory_budget:
+        note('memory_budget', args.memory_budget)
+    crsp_db.memory_budget = args.memory_budget
         
-    returns = get_all_fund_returns(force_db_read=False)
+    with phase('get_fund_returns_panel'):
+        returns = get_fund_returns_panel()
+    profile_path = args.name + '_trials.prof' if args.profile_trials else None
+
+    if args.start_years or args.windows:
+        horizons = []
+        if args.start_years:
+            horizons += start_year_horizons(args.start_years[0], args.start_years[1], args.end_year, 
+                                            args.start_month, args.end_month)
+        if args.windows:
+            horizons += rolling_horizons(args.windows, args.start_year, args.end_year, args.start_month, args.end_month)
+        res = run_horizon_grid(comparison_portfolio_def, returns, horizons, bucketing_type='crsp_style', 
+                           active_picks=args.active_picks, min_fee_quantile=args.fee_quantile, survivor_bias=args.addbias,
+                           trials=args.trials, name=args.name, pf_name=args.portfolio_name, seed=args.seed,
+                           workers=args.workers, fee_at_replacement=args.fee_at_replacement, 
+                           memory_budget=args.memory_budget)
+        if args.profile:
+            write_run_metrics(args)
+        return
     
     # Call the engine
     # NOTE:  We use a day of the month (25) that ensures that end-of-month returns on non-calendar month-end days are not cut off.
@@ -72,7 +149,19 @@ def main():
                  active_picks=args.active_picks,
                  min_fee_quantile=args.fee_quantile, 
                  survivor_bias=args.addbias,
-                 trials=args.trials, name=args.name, pf_name=args.portfolio_name)
+                 trials=args.trials, name=args.name, pf_name=args.portfolio_name, seed=args.seed,
+                 workers=args.workers, fee_at_replacement=args.fee_at_replacement, trial_log=args.trial_log,
+                 results_path=args.results or args.name + '_trials.bin', resume=args.resume, profile_path=profile_path,
+                 memory_budget=args.memory_budget, plot=not args.no_plot)
+    if args.profile:
+        write_run_metrics(args)
+
+def write_run_metrics(args):
+    """ Writes the metrics of the run (see run_metrics.py) next to its other outputs """
+    metrics.write_json(args.name + '_metrics.json', arguments=vars(args))
+    metrics.write_chrome_trace(args.name + '_trace.json')
+    metrics.log_memory(log)
+    log.info('Wrote run metrics to %s and %s', args.name + '_metrics.json', args.name + '_trace.json')
 
 def feq(a,b):
     """ Equals function - used in the allocation checks to deal a precision issue """
@@ -90,34 +179,98 @@ def check_pf_setup(port_def):
     for asset_class in port_def.keys():
         total+= port_def[asset_class]['alloc']
     if not feq(total,target):
-        print "Allocation doesn't add to 100%:", total*100
+        log.error("Allocation doesn't add to 100%%: %s", total*100)
         return False
     
     # check if asset classes are all valid
     isect=[a for a in asset_classes if a in port_def.keys()]
     if len(isect) <> len(port_def.keys()): 
-        print "Invalid asset class specified in portfolio",port_def.keys()
+        log.error('Invalid asset class specified in portfolio %s', port_def.keys())
         return False
     return True
 
-def print_portfolio(port_def):
-    """ Pretty prints a portfolio definition with additional info """
+def log_portfolio(port_def):
+    """ Logs a portfolio definition with additional info """
+    catalog = get_fund_catalog()
     for asset_class in port_def.keys():
-        print asset_class, port_def[asset_class]['alloc'] 
-        get_fund_info(port_def[asset_class]['funds'])
-        print '='*20
+        log.info('%s %s', asset_class, port_def[asset_class]['alloc'], extra=fields(asset_class=asset_class, 
+                                                                                  alloc=port_def[asset_class]['alloc']))
+        catalog.log_funds(port_def[asset_class]['funds'])
+        log.info('='*20)
 
 def export_fund_list(ids,name=''):
     """ Saves a list of fund names to an output file, given a list of crsp_fundno ids """
-    print 'Writing fund list',len(ids),'to file:','fund_list_%s.csv' % name
-    f=open('fund_list_%s.csv' % name, 'wb')
-    info = get_fund_info(ids, printout=False)
-    for fund in info:
-        f.write( "\"%s\",\"%s\",\"%s\"\n" % (fund[2] if fund[2] else 'Unknown',fund[1],fund[0]) )
-    f.close()
+    log.debug('Writing fund list %s to file: fund_list_%s.csv', len(ids), name)
+    get_fund_catalog().write_fund_list('fund_list_%s.csv' % name, ids)
+
+class Universe(object):
+    """ The data every scenario on the same database shares: fund returns, fund date bounds, buckets and the
+    unique, index and live fund lists
+
+    Everything but the returns and date bounds is loaded on first use and kept, so a sweep of scenarios 
+    (see sweep.py) loads each once.  preload() loads up front what a set of scenarios will need. """
+
+    def __init__(self, all_fund_returns):
+        self.returns = all_fund_returns
+        with phase('get_fund_date_bounds'):
+            self.date_bounds = get_fund_date_bounds(all_fund_returns)
+        self._memo = {}
+
+    def _get(self, key, load, phase_name):
+        if key not in self._memo:
+            with phase(phase_name):
+                self._memo[key] = load()
+        return self._memo[key]
+
+    def buckets(self, bucketing_type='crsp_style'):
+        if bucketing_type == 'crsp_style':
+            return self._get('crsp_style', lambda: get_style_bucket_funds(self.returns), 'get_style_bucket_funds')
+        return self._get('R2', get_r2_bucket_funds, 'get_r2_bucket_funds')
+
+    def unique_funds(self):
+        return self._get('unique', lambda: set(get_unique_funds_from_groups()), 'get_unique_funds_from_groups')
+
+    def index_funds(self):
+        return self._get('index', lambda: set(get_pure_index_funds()), 'get_pure_index_funds')
+
+    def live_funds(self):
+        return self._get('live', lambda: set(get_all_live_funds()), 'get_all_live_funds')
+
+    def fee_index(self):
+        return self._get('fees', get_fund_fee_index, 'get_fund_fee_index')
+
+    def riskfree_returns(self):
+        """ Risk-free rate returns for sharpe ratio calculation, End of Month like the rest of our data """
+        return self._get('riskfree', lambda: get_benchmark_store().series('TBill-1mo'), 'riskfree_returns')
+
+    def preload(self, bucketing_types=('crsp_style',), exclude_indexfunds=True, survivor_bias=False, fees=False):
+        for bucketing_type in bucketing_types:
+            self.buckets(bucketing_type)
+        self.unique_funds()
+        self.riskfree_returns()
+        get_fund_catalog()
+        if exclude_indexfunds: self.index_funds()
+        if survivor_bias: self.live_funds()
+        if fees: self.fee_index()
+
+class Scenario(object):
+    """ A prepared scenario: the comparison portfolio results and the return matrix and slots to draw trials from """
+
+    def __init__(self, comp_pf_return, comp_pf_excessreturn, comp_pf_stddev, matrix, slots, riskfree, fund_lists):
+        self.comp_pf_return = comp_pf_return
+        self.comp_pf_excessreturn = comp_pf_excessreturn
+        self.comp_pf_stddev = comp_pf_stddev
+        self.comp_pf_sharpe = (comp_pf_excessreturn - 1) / comp_pf_stddev
+        self.matrix = matrix
+        self.slots = slots
+        self.riskfree = riskfree
+        self.fund_lists = fund_lists
 
 def engine(port_def, all_fund_returns, start_date, end_date, bucketing_type='crsp_style', 
-           min_fee_quantile=None, exclude_indexfunds=True, survivor_bias=False, trials=100, name='figure',pf_name='',active_picks=1):
+           min_fee_quantile=None, exclude_indexfunds=True, survivor_bias=False, trials=100, name='figure',pf_name='',active_picks=1,
+           seed=None, batch_size=1000, workers=1, fee_at_replacement=False, universe=None, outputs=True,
+           results_path=None, resume=False, profile_path=None, memory_budget=None, trial_log=None, plot=True,
+           keep_diffs=None):
     """ Main routine for choosing random portfolios to compare the passive to active strategy
     
     Works by first calculating the passive portfolio return, then developing the universe of active
@@ -133,273 +286,393 @@ def engine(port_def, all_fund_returns, start_date, end_date, bucketing_type='crs
     all_fund_returns: crsp pandas return object from crsp_data_wrappers
     bucketing_type: R2 or crsp_style - defines the method for choosing funds within the asset class
     min_fee_quantile: for excluding high-fee funds.  0.5 would exclude all but the lowest 1/2 of funds
+                      (by the fees charged at the start of the horizon, or when a fund opened if later; funds
+                      without a fee record then are left out)
+    fee_at_replacement: apply min_fee_quantile in every month instead, to the fees charged that month by the 
+                      funds open then, so each replacement fund is drawn from the funds cheap at that date
     exclude_indexfunds: exclude index funds from list of active funds
     trials: how many random active portfolios to pick
     name: name of run, used in graph filename
     pf_name: optional name of portfolio, used in graph
     active_picks: how many active funds to randomly choose for each asset class
+    seed: random seed for the fund draws, a given seed always gives the same trials
+    batch_size: how many trials to run at once through the trial engine (trial_engine.py)
+    workers: how many processes to split the trials across.  Results for a seed don't depend on this
+    universe: a Universe already loaded for all_fund_returns, to share it across scenarios
+    outputs: write the fund lists, return diffs and graphs
+    results_path: file to append the trial results to as they finish, instead of keeping them in memory
+    resume: continue the run in results_path from its last complete batch (the seed is taken from the file)
+    profile_path: run the trials under cProfile and save the stats to this file
+    memory_budget: bytes the run should stay under; batches are run a part at a time until the trials fit
+    trial_log: json lines file to write the funds and results of every trial to (see trial_results.TrialLog)
+    plot: with outputs, also draw the graphs (matplotlib is only imported if so)
+    keep_diffs: keep the return and sharpe diffs of every trial in the summary, by default only with outputs
     
     OUTPUTS:
     Return differences  between activce and passive (csv)
     Graphs of the passive/active return differences and sharpe ratio differences
     Fund name list by asset class (csv)
+    Returns the summary of the trials (see run_scenario()), None if the portfolio is invalid
     
     """
-    if pf_name: print 'Portfolio name:',pf_name
-    print_portfolio(port_def)
-    print 'Time horizon:',start_date,'to',end_date 
-    print 'Active funds from each asset class to pick:',active_picks
+    if pf_name: log.info('Portfolio name: %s', pf_name)
+    log_portfolio(port_def)
+    log.info('Time horizon: %s to %s', start_date, end_date)
+    log.info('Active funds from each asset class to pick: %s', active_picks)
     
     if not check_pf_setup(port_def):
         return 
 
-    # Load risk-free rate returns for sharpe ratio calculation, and set to End of Month like the rest of our data
-    riskfree_returns = load_benchmark_returns(bmk_list=['TBill-1mo'])[0].resample('M',how='prod')
+    if universe is None:
+        universe = Universe(all_fund_returns)
+    with phase('prepare_scenario'):
+        scenario = prepare_scenario(port_def, universe, start_date, end_date, bucketing_type, min_fee_quantile, 
+                                    exclude_indexfunds, survivor_bias, active_picks, fee_at_replacement, export=outputs)
+    params = {'port_def':port_def, 'start_date':str(start_date), 'end_date':str(end_date), 'bucketing_type':bucketing_type,
+              'min_fee_quantile':min_fee_quantile, 'exclude_indexfunds':exclude_indexfunds, 'survivor_bias':survivor_bias,
+              'active_picks':active_picks, 'fee_at_replacement':fee_at_replacement}
+    summary = run_scenario(scenario, trials, seed, batch_size, workers, results_path, resume, params, 
+                           keep_diffs=outputs if keep_diffs is None else keep_diffs, profile_path=profile_path, 
+                           memory_budget=memory_budget, trial_log=trial_log)
+    if outputs:
+        with phase('write_scenario_outputs'):
+            write_scenario_outputs(summary, start_date, end_date, name, pf_name, trials, min_fee_quantile, survivor_bias,
+                                   plot)
+    return summary
+
+def prepare_scenario(port_def, universe, start_date, end_date, bucketing_type='crsp_style', min_fee_quantile=None, 
+                     exclude_indexfunds=True, survivor_bias=False, active_picks=1, fee_at_replacement=False, export=True):
+    """ Calculates the comparison portfolio and filters the funds of each asset class down to those trials draw 
+    from, see engine() for the inputs.  Returns a Scenario """
+    all_fund_returns = universe.returns
+    riskfree_returns = universe.riskfree_returns()
 
     ## FIRST: Calculate passive (comparison) portfolio returns
     # get comparison portfolio returns from the returns set or alternate location, 
     # ensure time period is present and calculate fund return over period
-    print 'Calculating return and stddev of comparison portfolio'
-    comp_pf_return, comp_pf_excessreturn, comp_pf_stddev = get_portfolio_return(port_def, all_fund_returns, riskfree_returns, start_date, end_date)
+    log.debug('Calculating return and stddev of comparison portfolio')
+    with phase('get_portfolio_return'):
+        comp_pf_return, comp_pf_excessreturn, comp_pf_stddev = get_portfolio_return(port_def, all_fund_returns, riskfree_returns, start_date, end_date)
     comp_pf_sharpe = (comp_pf_excessreturn - 1) / comp_pf_stddev
     
-    print 'Comparison portfolio return=',comp_pf_return, 'excess return=', comp_pf_excessreturn, 'stddev=',comp_pf_stddev, 'sharpe=',comp_pf_sharpe
+    log.info('Comparison portfolio return=%s excess return=%s stddev=%s sharpe=%s', comp_pf_return, comp_pf_excessreturn, 
+             comp_pf_stddev, comp_pf_sharpe, extra=fields(comp_pf_return=comp_pf_return, comp_pf_excessreturn=comp_pf_excessreturn,
+                                                          comp_pf_stddev=comp_pf_stddev, comp_pf_sharpe=comp_pf_sharpe))
     
     ## NEXT: Calculate active portfolio returns 
-    print 'Getting fund buckets for each asset class'
-    if bucketing_type=='crsp_style':
-        bucket_df = get_style_bucket_funds(all_fund_returns) 
-    else:
-        bucket_df = get_r2_bucket_funds()
+    log.debug('Getting fund buckets for each asset class')
+    bucket_df = universe.buckets(bucketing_type)
 
-    short_funds = [] #tracks short funds that are not part of our range or have less than certain number of values
-    return_diffs = [] # difference of the passive and active trial return - for graphing
-    sharpe_diffs = [] # difference of the passive and active trial sharpe ratios -for graphing
-    
-    print "Getting list of funds open during the time horizon"
-    date_bounds = get_fund_date_bounds(all_fund_returns)
+    log.debug('Getting list of funds open during the time horizon')
+    date_bounds = universe.date_bounds
     lhs = date_bounds[date_bounds['end_date'] >= start_date]
     rhs = date_bounds[date_bounds['start_date'] <= end_date]
     
     open_funds = list(set(lhs.index).intersection(list(rhs.index)))
-    print 'There are',len(open_funds),'which were open during the time horizon'
+    log.debug('There are %s which were open during the time horizon', len(open_funds))
 
     # remove non-unique funds
-    unique_fund_list = get_unique_funds_from_groups()
-    print "Total unique funds that were open:", len(list(set(unique_fund_list).intersection(open_funds)))
+    unique_fund_list = universe.unique_funds()
+    log.debug('Total unique funds that were open: %s', len(set(unique_fund_list).intersection(open_funds)))
     
     if exclude_indexfunds:
-        print 'Excluding pure index funds'    
-        indexfund_list = get_pure_index_funds()    
+        log.debug('Excluding pure index funds')
+        indexfund_list = universe.index_funds()
     
     if survivor_bias:
-        live_funds = get_all_live_funds()
+        live_funds = universe.live_funds()
 
     master_fund_list = {}
+    timelines = {} # funds open in each month of the horizon, by asset class
     for asset_class in port_def.keys():
-        print 'Filtering for',asset_class
-        fund_list = list(bucket_df[asset_class].dropna().index)
+        log.debug('Filtering for %s', asset_class)
+        fund_list = list(bucket_df.funds(asset_class))
         
         if exclude_indexfunds:
             fund_list = list(set(fund_list).difference(indexfund_list))        
 
         all_fund_count = len(fund_list)
         fund_list = list(set(fund_list).intersection(open_funds))     
-        print "Excluding %s funds that weren't open during this period for this asset class" % (all_fund_count - len(fund_list))
+        log.debug("Excluding %s funds that weren't open during this period for this asset class", all_fund_count - len(fund_list))
         
         all_fund_count = len(fund_list)
         fund_list = list(set(fund_list).intersection(unique_fund_list))     
-        print 'Removing %s non-unique funds' % (all_fund_count - len(fund_list))
+        log.debug('Removing %s non-unique funds', all_fund_count - len(fund_list))
         
         if specific_fund_excludes:
             all_fund_count = len(fund_list)
             fund_list = list(set(fund_list).difference(specific_fund_excludes)) 
             if (all_fund_count - len(fund_list)) > 0:
-                print "Funds explicitly excluded: %s" % (all_fund_count - len(fund_list))
+                log.debug('Funds explicitly excluded: %s', all_fund_count - len(fund_list))
                 
         # if we are using low fee funds only, take out any that aren't low fee
         # do this last so the quantile is taken from the final list
-        if min_fee_quantile:
-            lowest_quantile_funds = specific_funds_by_fee(get_fund_fees(), fund_list, min_fee_quantile)
+        fee_candidates = None
+        if min_fee_quantile and fee_at_replacement:
+            fee_candidates = fund_list # filtered month by month on the timeline below
+        elif min_fee_quantile:
+            # funds that open during the horizon are judged by the fee they charged when they opened
+            opened = date_bounds['start_date'].reindex(fund_list)
+            lowest_quantile_funds = specific_funds_by_fee(universe.fee_index(), fund_list, min_fee_quantile, 
+                                                          asof_date=[max(d, pd.Timestamp(start_date)) for d in opened])
             fund_list = list(set(fund_list).intersection(lowest_quantile_funds))       
                 
         if survivor_bias:
             all_fund_count = len(fund_list)
             fund_list = list(set(fund_list).intersection(live_funds)) 
-            print "Survivorship bias impact: Excluding %s dead funds for this asset class" % (all_fund_count - len(fund_list))
+            log.info('Survivorship bias impact: Excluding %s dead funds for %s', all_fund_count - len(fund_list), asset_class)
             
+        if fee_candidates is not None:
+            log.debug('Filtering funds by fee quantile %s in each month', min_fee_quantile)
+            timeline = OpenFundTimeline.from_date_bounds(date_bounds, fee_candidates, start_date, end_date)
+            timeline = fee_filtered_timeline(timeline, universe.fee_index(), min_fee_quantile).restricted(fund_list)
+            fund_list = list(np.unique(timeline.members))
+        else:
+            timeline = OpenFundTimeline.from_date_bounds(date_bounds, fund_list, start_date, end_date)
         master_fund_list[asset_class] = fund_list
-        print asset_class,'final fund count:',len(fund_list)
-        export_fund_list(fund_list, name=asset_class)
-
-    print 'Starting trials... (',trials,')' 
-    rs_index = pd.date_range(start_date,end_date,freq='M')
-    pcr_index = None
-    for trial in range(trials):   
-        return_df = pd.DataFrame() # to store the trial returns for each asset class, for later portfolio return calculations
-        trial_return = 0
-        for asset_class in port_def.keys():
-            weight = port_def[asset_class]['alloc'] / active_picks #each pick will be equally weighted
-            fund_list = master_fund_list[asset_class]
-            
-            for pick in range(active_picks):
-                combined_returns = pd.Series(None,index=rs_index) # empty return series indexed monthly for date range to start
-                combined_funds = []
-                # keep drawing funds and combining the series until filled
-                while len(combined_returns) <> len(combined_returns.dropna()):
-                    
-                    # filter fund_list by current open funds (those open at the time the last fund ended)                   
-                    next_date = combined_returns[np.isnan(combined_returns)].index[0]
-                    lhs = date_bounds[date_bounds['end_date'] >= next_date]
-                    rhs = date_bounds[date_bounds['start_date'] <= next_date]
-                    current_open_funds = list(set(lhs.index).intersection(list(rhs.index)))
-                    open_fund_list = list(set(fund_list).intersection(current_open_funds)) 
-                    
-                    # draw a random fund
-                    random_fund = open_fund_list[np.random.random_integers(len(open_fund_list))-1]
-                    
-                    #select again if fund is in our list of short_funds, so we don't waste time with ones we know are too short
-                    while random_fund in short_funds:
-                        random_fund = open_fund_list[np.random.random_integers(len(open_fund_list))-1]
-                    fund_pick_returns = all_fund_returns.ix[random_fund]['Return'][start_date:end_date] 
-                    
-                    # if we didn't get returns or the fund has less than 6 months of history left, don't use it and reloop to redraw
-                    if len(fund_pick_returns) == 0:
-                        print 'fund out of range',random_fund
-                    elif len(fund_pick_returns) < 6:
-                        print 'fund too short',random_fund
-                        short_funds.append(random_fund)
-                    else:
-                        # It would be nice to fix this so that we don't do extraneous resampling and splicing if the fund overlaps completely already                                        
-                        fund_pick_returns = fund_pick_returns.resample('M', how='prod')  
-                        cr_size = len(combined_returns.dropna())
-                        combined_returns = splice_returns([combined_returns,fund_pick_returns], resample_base=False)
-                        if len(combined_returns.dropna()) > cr_size:
-                            combined_funds.append(random_fund)
-                            
-                # To calculate the portfolio return without rebalancing, we need to convert to dollar values, sum the cumulative
-                # values for each time period to get the portfolio value, and then calculate the return.
-                # To do this, we add the weight to the start of the return series (like $1 investment) for calculating the portfolio return later 
-                
-                # First, rebuild index to include one leading value and put into a blank series
-                if type(pcr_index) == types.NoneType: # this only needs to be initialized once, so check if it was
-                    pcr_index = pd.Index(pd.date_range(combined_returns.index[0] - pd.tseries.offsets.DateOffset(months=1),\
-                                                       periods=len(combined_returns.index)+1,freq='M'))
-                cr_new = pd.Series(np.empty(len(pcr_index)), index=pcr_index) # create empty series based on this new index
-                cr_new[0] = weight   # store the weight
-                cr_new[combined_returns.index[0]:combined_returns.index[-1]] = combined_returns  #followed by returns            
-                
-                # add return series to the result dataframe
-                if return_df.empty:
-                    return_df = pd.DataFrame(cr_new,columns=[str(random_fund)])
-                else:
-                    return_df[str(random_fund)] = cr_new
-            
-                print trial,'asset class=',asset_class,', combined funds=',combined_funds 
-                
-        # return and stddev calculation at portfolio level
-        pf_values = return_df.cumprod().sum(axis=1)
-        pf_returns = pf_values / pf_values.shift(1)
-        trial_return = calc_annual_return_from_monthly(pf_returns)
-        
-        # calculate excess return (for sharpe calculation)
-        pf_excess_returns = pf_returns.sub(riskfree_returns - 1).dropna()
-        pf_trial_excess_return = calc_annual_return_from_monthly(pf_excess_returns)
-        
-        pf_er_stddev = pf_excess_returns.std() * math.sqrt(12) # annualize stddev
-        trial_sharpe = (pf_trial_excess_return - 1) / (pf_er_stddev) 
-        sharpe_diffs.append(trial_sharpe - comp_pf_sharpe) # save for graphing
-        print 'Trial return=',trial_return,'excess return=',pf_trial_excess_return,'stddev=',pf_er_stddev,'sharpe ratio=',trial_sharpe
-        
-        return_diffs.append((trial_return - comp_pf_return)*100)
-        if comp_pf_return > trial_return:
-            print trial, 'Passive wins by',comp_pf_return - trial_return, 'Passive=',comp_pf_return,'Active=',trial_return
+        timelines[asset_class] = timeline
+        log.info('%s final fund count: %s', asset_class, len(fund_list), extra=fields(asset_class=asset_class, funds=len(fund_list)))
+        if export:
+            export_fund_list(fund_list, name=asset_class)
+
+    with phase('pack_return_matrix'):
+        matrix = pack_return_matrix(all_fund_returns, start_date, end_date,
+                                    [fund for fund_list in master_fund_list.values() for fund in fund_list])
+    with phase('trial_slots'):
+        slots = trial_slots(port_def, timelines, matrix, active_picks)
+    return Scenario(comp_pf_return, comp_pf_excessreturn, comp_pf_stddev, matrix, slots, 
+                    matrix.align(riskfree_returns), master_fund_list)
+
+def run_scenario(scenario, trials=100, seed=None, batch_size=1000, workers=1, results_path=None, resume=False, 
+                 params=None, keep_diffs=True, profile_path=None, memory_budget=None, trial_log=None):
+    """ Runs the trials of a prepared Scenario, returns their summary (see trial_summary.py)
+
+    The summary is accumulated batch by batch, and a progress line with the summary so far, the trials per 
+    second and the time left is logged every few seconds.  With results_path, every batch of trials is 
+    appended to that results file as it finishes (see trial_results.py) along with params (the scenario 
+    inputs) and the seed.  With resume, a run already in that file is continued after its last complete 
+    batch.  With keep_diffs, the summary also holds the return_diffs and sharpe_diffs arrays of all the 
+    trials (for the graphs) and its medians and percentiles are exact; otherwise nothing is kept per trial 
+    and they come from quantile sketches (see TrialSummary.summary(): approximate, rank_error, 
+    percentile_rank_error).  With trial_log, the funds and results of every trial are written to that json lines file, a batch at a time 
+    (see trial_records()).  With profile_path, the trial loop runs under cProfile (this process only, not 
+    trial workers) and the stats are saved there.  With memory_budget (bytes), workers run each batch as many trials at a time as fit in 
+    what the budget leaves (see trial_engine.budget_sub_batch()); batch_size, and so the trials drawn, 
+    stays the same. """
+    comp_pf_return, comp_pf_sharpe = scenario.comp_pf_return, scenario.comp_pf_sharpe
+    matrix, slots = scenario.matrix, scenario.slots
+
+    log.info('Starting trials... (%s)', trials)
+    results = None
+    total = TrialSummary()
+    batches = [] # trial results kept in memory for keep_diffs when there is no results file
+    if results_path:
+        params = dict(params or {}, trials=trials, seed=seed, batch_size=batch_size, memory_budget=memory_budget,
+                      comp_pf_return=comp_pf_return, comp_pf_sharpe=comp_pf_sharpe)
+        if resume and os.path.exists(results_path):
+            results = TrialResultsFile.resume(results_path, params, ignore=('trials', 'memory_budget'))
+            seed, batch_size = results.params['seed'], results.params['batch_size']
+            log.info('Resuming %s after %s trials', results_path, results.trials_done)
+            for batch_start, batch in read_trial_batches(results_path):
+                total.update((batch['trial_returns'] - comp_pf_return)*100, batch['sharpes'] - comp_pf_sharpe)
         else:
-            print trial, 'Active wins by',trial_return - comp_pf_return, 'Passive=',comp_pf_return,'Active=',trial_return
-    
-    ## LAST: Summarize    
-    passive_win_perc = round(sum(map(lambda x: 1 if x<0 else 0, return_diffs)) / (len(return_diffs)) * 100,1)
-    print 'Passive wins %s%% of the time' % passive_win_perc
-    
-    under_median = np.median(filter(lambda x: x<=0, return_diffs))
-    print 'Writing return diffs to file...'
+            if seed is None:
+                seed = np.random.randint(2**31-1)
+            params['seed'] = seed
+            results = TrialResultsFile.create(results_path, params)
+    elif seed is None:
+        seed = np.random.randint(2**31-1)
+    log.info('Random seed: %s workers: %s', seed, workers, extra=fields(seed=seed, workers=workers, batch_size=batch_size))
+    note('batch_size', batch_size)
+    sub_batch = memory_sub_batch(memory_budget, slots, matrix, batch_size, workers)
+    trial_log = TrialLog(trial_log, append=resume) if trial_log else None
+    progress = Progress(log, trials, total.trials)
+    profiler = cProfile.Profile() if profile_path else None
+    if profiler:
+        profiler.enable()
+    try:
+        with phase('trials', trials=trials, workers=workers):
+            for batch_start, batch in run_trials(matrix, slots, scenario.riskfree, trials, seed, batch_size, workers,
+                                                 first_trial=results.trials_done if results else 0, sub_batch=sub_batch):
+                trial_returns, excess_returns, stddevs, sharpes, picks = batch
+                if results:
+                    results.append(batch_start, batch)
+                elif keep_diffs:
+                    batches.append((trial_returns, sharpes))
+                total.update((trial_returns - comp_pf_return)*100, sharpes - comp_pf_sharpe)
+                if trial_log:
+                    trial_log.append(trial_records(matrix, slots, batch_start, batch, comp_pf_return))
+                if progress.due(total.trials):
+                    log_progress(progress, total)
+    finally:
+        if profiler:
+            profiler.disable()
+        if results:
+            results.close()
+        if trial_log:
+            trial_log.close()
+    if profiler:
+        save_profile(profiler, profile_path)
+
+    return_diffs = sharpe_diffs = None
+    if keep_diffs:
+        if results:
+            trial_returns = read_trial_column(results_path, 'trial_returns')
+            sharpes = read_trial_column(results_path, 'sharpes')
+        else:
+            trial_returns = np.concatenate([b[0] for b in batches]) if batches else np.zeros(0)
+            sharpes = np.concatenate([b[1] for b in batches]) if batches else np.zeros(0)
+        # difference of the passive and active trial returns and sharpe ratios - for graphing and exact medians
+        return_diffs, sharpe_diffs = (trial_returns - comp_pf_return)*100, sharpes - comp_pf_sharpe
+    summary = total.summary(return_diffs)
+    log_summary(summary)
+    summary.update(seed=seed, comp_pf_return=comp_pf_return, comp_pf_sharpe=comp_pf_sharpe)
+    if keep_diffs:
+        summary.update(return_diffs=return_diffs, sharpe_diffs=sharpe_diffs)
+    return summary
+
+def memory_sub_batch(memory_budget, slots, matrix, batch_size, workers):
+    """ Trials each worker runs at once to stay in memory_budget (None without a budget or when a whole batch fits) """
+    if not memory_budget:
+        return None
+    sub_batch = budget_sub_batch(memory_budget, len(slots[1]), matrix.months, batch_size, workers)
+    log.info('Memory budget %s: %s trials at a time in each worker', format_bytes(memory_budget), sub_batch)
+    note('sub_batch', sub_batch)
+    return sub_batch if sub_batch < batch_size else None
+
+def trial_records(matrix, slots, batch_start, batch, comp_pf_return):
+    """ The trial log records of a batch of trials: the trial number, the crsp_fundnos spliced into each slot
+    in draw order (as [asset class, funds] pairs), the return, excess return, stddev and sharpe ratio, and 
+    whether passive won """
+    trial_returns, excess_returns, stddevs, sharpes, picks = batch
+    funds = spliced_funds(matrix, picks, len(trial_returns), len(slots[0]))
+    return [{'trial':batch_start + i, 
+             'funds':[[asset_class, [int(f) for f in funds[i][slot]]] for slot, asset_class in enumerate(slots[0])],
+             'trial_return':float(trial_returns[i]), 'excess_return':float(excess_returns[i]), 
+             'stddev':float(stddevs[i]), 'sharpe':float(sharpes[i]), 'passive_wins':bool(comp_pf_return > trial_returns[i])}
+            for i in range(len(trial_returns))]
+
+def save_profile(profiler, path, top=20):
+    """ Saves the stats of a cProfile profiler to path, and the top functions by cumulative time next to it as
+    text (stdout is left alone for --log_json) """
+    profiler.dump_stats(path)
+    text_path = os.path.splitext(path)[0] + '.txt'
+    f = open(text_path, 'w')
+    try:
+        pstats.Stats(path, stream=f).sort_stats('cumulative').print_stats(top)
+    finally:
+        f.close()
+    log.info('Saved the trials profile to %s, top functions in %s', path, text_path)
+
+def log_summary(summary):
+    log.info('Passive wins %s%% of the time', summary['passive_win_perc'], 
+             extra=fields(**dict((key, summary[key]) for key in ['trials', 'passive_win_perc', 'sharpe_win_perc', 
+                                                                 'under_median', 'over_median', 'under_stdev', 'over_stdev'])))
+    log.info('Under median=%s, Over median=%s', summary['under_median'], summary['over_median'])
+    log.info('Under stdev=%s, Over stddev=%s', summary['under_stdev'], summary['over_stdev'])
+    if summary['approximate']:
+        log.info('Medians and percentiles are approximate (quantile sketches, within %s and %s ranks)', 
+                 summary['rank_error'], summary['percentile_rank_error'], 
+                 extra=fields(rank_error=summary['rank_error'], percentile_rank_error=summary['percentile_rank_error']))
+
+def log_progress(progress, summary):
+    """ The progress line of a run, with the summary so far """
+    passive_win_perc = round(summary.passive_wins / summary.trials * 100, 1)
+    under_median, over_median = summary.under_sketch.median(), summary.over_sketch.median()
+    progress.report(summary.trials, ': passive wins %s%%, under median=%s, over median=%s', passive_win_perc, 
+                    under_median, over_median, passive_win_perc=passive_win_perc, under_median=under_median, 
+                    over_median=over_median)
+
+def run_horizon_grid(port_def, all_fund_returns, horizons, bucketing_type='crsp_style', min_fee_quantile=None, 
+                 exclude_indexfunds=True, survivor_bias=False, trials=100, name='figure', pf_name='', active_picks=1,
+                 seed=None, batch_size=1000, workers=1, fee_at_replacement=False, universe=None, outputs=True,
+                 memory_budget=None):
+    """ Runs one set of trials for a whole grid of time horizons, e.g. every start year to a fixed end or
+    rolling windows (see horizon_grid.py for building the list of (start_date, end_date) horizons)
+    
+    The funds are drawn once over the span from the earliest start to the latest end, exactly as engine() would
+    for that span, and a horizon starting later takes each trial's funds as they stand at its start.  The
+    cumulative log returns of the trials then give the return of any horizon with one subtraction.  Each horizon
+    is compared to the comparison portfolio over that horizon.  Other inputs (memory_budget included) are as 
+    for engine().
+    
+    Returns a dataframe with the passive win percentage and the median and stddev of under/outperformance of 
+    each horizon, also written to <name>_horizons.csv.  No trials are kept, so the medians come from quantile
+    sketches: the rank_error column bounds how many ranks they can be off by (0 when exact) """
+    if pf_name: log.info('Portfolio name: %s', pf_name)
+    log_portfolio(port_def)
+    if not check_pf_setup(port_def):
+        return 
+
+    if universe is None:
+        universe = Universe(all_fund_returns)
+    span_start, span_end = min(h[0] for h in horizons), max(h[1] for h in horizons)
+    log.info('Horizon grid of %s horizons, from %s to %s', len(horizons), span_start, span_end)
+    with phase('prepare_scenario'):
+        scenario = prepare_scenario(port_def, universe, span_start, span_end, bucketing_type, min_fee_quantile, 
+                                    exclude_indexfunds, survivor_bias, active_picks, fee_at_replacement, export=outputs)
+    riskfree_returns = universe.riskfree_returns()
+    with phase('get_portfolio_return', horizons=len(horizons)):
+        comp_pf_returns = np.array([get_portfolio_return(port_def, universe.returns, riskfree_returns, start_date, end_date)[0]
+                                    for start_date, end_date in horizons])
+    windows = horizon_windows(horizons, scenario.matrix.first_month, scenario.matrix.months)
+
+    log.info('Starting trials... (%s)', trials)
+    if seed is None:
+        seed = np.random.randint(2**31-1)
+    log.info('Random seed: %s workers: %s', seed, workers, extra=fields(seed=seed, workers=workers, batch_size=batch_size))
+    note('batch_size', batch_size)
+    sub_batch = memory_sub_batch(memory_budget, scenario.slots, scenario.matrix, batch_size, workers)
+    totals = [TrialSummary() for h in horizons]
+    progress = Progress(log, trials)
+    with phase('trials', trials=trials, workers=workers, horizons=len(horizons)):
+        for batch_start, batch in run_trials(scenario.matrix, scenario.slots, scenario.riskfree, trials, seed, 
+                                             batch_size, workers, windows=windows, sub_batch=sub_batch):
+            return_diffs = (batch[0] - comp_pf_returns)*100
+            for h, total in enumerate(totals):
+                total.update(return_diffs[:, h])
+            done = batch_start + len(return_diffs)
+            if progress.due(done):
+                progress.report(done)
+
+    rows = []
+    for h, (start_date, end_date) in enumerate(horizons):
+        log.info('Horizon %s to %s', start_date, end_date, extra=fields(start_date=start_date, end_date=end_date))
+        summary = totals[h].summary()
+        log_summary(summary)
+        rows.append([start_date, end_date, comp_pf_returns[h], summary['passive_win_perc'], summary['under_median'],
+                     summary['over_median'], summary['under_stdev'], summary['over_stdev'], summary['rank_error']])
+    results = pd.DataFrame(rows, columns=['start_date', 'end_date', 'comp_pf_return', 'passive_win_perc', 'under_median', 
+                                          'over_median', 'under_stdev', 'over_stdev', 'rank_error'])
+    if outputs:
+        log.info('Writing horizon results to %s', name + '_horizons.csv')
+        results.to_csv(name + '_horizons.csv', index=False)
+    return results
+
+def write_scenario_outputs(summary, start_date, end_date, name='figure', pf_name='', trials=100, min_fee_quantile=None, 
+                           survivor_bias=False, plot=True):
+    """ Writes the return diffs of a run to csv and, with plot, graphs the return and sharpe ratio diffs (see
+    reporting.py, only imported here so runs without charts never load matplotlib) """
+    return_diffs = list(summary['return_diffs'])
+    log.info('Writing return diffs to %s', name + 'return_diffs.csv')
     meds = open(name + 'return_diffs.csv','wb')
     for trial_return in return_diffs:
         meds.write('%s\n' % str(round(trial_return,5)))
     meds.close()
-    over_median = np.median(filter(lambda x: x>0, return_diffs))
-    under_stdev = np.std(filter(lambda x: x<=0, return_diffs))
-    over_stdev = np.std(filter(lambda x: x>0, return_diffs))
-    print 'Under median=%s, Over median=%s' % (under_median,over_median)
-    print 'Under stdev=%s, Over stddev=%s' % (under_stdev, over_stdev)
-    
-    # Graphs
-    return_diffs.sort()  # order diffs
-
-    title = 'Active vs Index Portfolios from %s to %s\n(Indexing wins %s%% of the time)' % \
-        (str(int(start_date.strftime("%Y"))+1), end_date.strftime("%Y"), passive_win_perc)
-    if min_fee_quantile: title+='\nFilter by lowest %s fee quantile' % min_fee_quantile
-    
-    figname = name + '_figure_' + pf_name + '_' + start_date.strftime("%Y") + '-' + end_date.strftime("%Y") + '_' + \
-        str(trials) + \
-        ('_lowfee' if min_fee_quantile else '') + \
-        ('_biased' if survivor_bias else '') + \
-        '.png'
-    save_bar_chart(data = return_diffs, 
-                       ylabel = 'Return Difference in % (Active - Index)', 
-                       xlabel = 'Sorted Trials', 
-                       title = title, 
-                       ylimits = [-6,4],
-                       under_median = under_median, 
-                       over_median = over_median, 
-                       figname = figname 
-                       )    
-
-    # Graph sharpe diffs
-    sharpe_diffs.sort()  # order diffs
-    title = 'Sharpe Ratio - Active vs Index Portfolios from %s to %s\n(Indexing wins on risk adjusted basis %s%% of the time)' % \
-        (str(int(start_date.strftime("%Y"))+1), end_date.strftime("%Y"), \
-         round(sum(map(lambda x: 1 if x<0 else 0, sharpe_diffs)) / (len(sharpe_diffs)) * 100,1))
-    if min_fee_quantile: title+='\nFilter by lowest %s fee quantile' % min_fee_quantile
-    
-    figname = name + '_sharpe_figure_' + pf_name + '_' + start_date.strftime("%Y") + '-' + end_date.strftime("%Y") + '_' + \
-        str(trials) + \
-        ('_lowfee' if min_fee_quantile else '') + \
-        ('_biased' if survivor_bias else '') + \
-        '.png'
-   
-    save_bar_chart(data = sharpe_diffs, 
-                   ylabel = 'Sharpe Difference in % (Active - Passive)', 
-                   xlabel = 'Sorted Trials', 
-                   title = title, 
-                   figname = figname
-                   )
-                   
-def save_bar_chart(data, ylabel, xlabel, title, figname, ylimits=None, under_median = None, over_median = None):
-    """ Saves a standard bar chart with the specified attributes and file name """
-    fig = plt.figure()
-    ax = fig.add_subplot(111) # our standard type for this project
-    rects = ax.bar(np.arange(len(data)),data, width=1, color='b') #our standard settings
-    ax.set_ylabel(ylabel)
-    ax.set_xlabel(xlabel)
-    ax.set_title(title)
-    if ylimits:
-        plt.ylim(ylimits)
-    plt.subplots_adjust(top=0.86) #move the title up a bit
-    
-    if under_median:
-        ax.add_artist(AnchoredText("Underperformers:\nmedian:%s%%" % (under_median.round(2)), loc=2, prop=dict(size=12)))   
-    if over_median: 
-        ax.add_artist(AnchoredText("Outperformers:\nmedian:%s%%" % (over_median.round(2)), loc=4, prop=dict(size=12)))    
-    
-    print 'Saving figure',figname      
-    plt.savefig(figname)    
-    
-
-def get_current_open_funds(date_bounds, asof_date):
-    """ Returns a list of the current open funds as of a date in a date_bound array """
-    
-    ## Would like to speed this up - maybe create a method that pre-calculates and caches
+    
+    if plot:
+        import reporting
+        reporting.save_scenario_charts(summary, start_date, end_date, name, pf_name, trials, min_fee_quantile, 
+                                       survivor_bias)
+
+def get_current_open_funds(date_bounds, asof_date, timeline=None):
+    """ Returns a list of the current open funds as of a date in a date_bound array 
+    
+    If an OpenFundTimeline is given (built once for the scenario), it is looked up instead of scanning 
+    date_bounds.  The timeline answers as of the end of the month of asof_date. """
+    if timeline is not None:
+        return list(timeline.open_funds(asof_date))
+    
     #find the funds open at the next needed date in the series                    
     lhs = date_bounds['end_date'] >= asof_date  
     rhs = date_bounds['start_date'] <= asof_date
@@ -408,6 +681,8 @@ def get_current_open_funds(date_bounds, asof_date):
 
 def get_fund_list(df):
     """ takes all fund returns dataframe and returns the unique fund list """
+    if isinstance(df, ReturnsPanel):
+        return df.fund_list()
     #fund_list = df.drop_duplicates('FundNo').set_index(['FundNo'])  #prior way
     fund_list = df.groupby(level=0, as_index=False).sum().drop_duplicates('FundNo').set_index(['FundNo']) #now multiindex
     return list(fund_list.index)
@@ -417,20 +692,32 @@ def funds_by_fee(df, max_fee=0.01):
     cheap_funds = df[df.apply(lambda x: x['ExpRatio'] <= max_fee, axis=1)]
     return list(cheap_funds.index)
 
-def specific_funds_by_fee(df, fund_filter, fee_quantile=0.5):
+def specific_funds_by_fee(df, fund_filter, fee_quantile=0.5, asof_date=None):
     """ Returns an array of crsp_fundno's based on the fund filter list, 
-    and max fee quantile criteria for a given date in time  """
-    print 'Filtering funds by fee quantile',fee_quantile
-    df_filtered = df.reindex(fund_filter)
-    
-    quantile = df_filtered['ExpRatio'].quantile(fee_quantile)
+    and max fee quantile criteria for a given date in time  
+    
+    df is a FeeIndex (fees charged at asof_date, a date or one per fund, or the latest fees if None) or the 
+    get_fund_fees() dataframe.  Funds without a fee are left out """
+    log.debug('Filtering funds by fee quantile %s', fee_quantile)
+    fund_filter = np.asarray(list(fund_filter), dtype=np.int64)
+    if isinstance(df, FeeIndex):
+        if asof_date is None:
+            fees = df.latest(fund_filter)
+        elif hasattr(asof_date, '__iter__'):
+            fees = df.as_of(fund_filter, [yyyymmdd(d) for d in asof_date])
+        else:
+            fees = df.as_of(fund_filter, yyyymmdd(asof_date))
+    else:
+        fees = np.asarray(df['ExpRatio'].reindex(fund_filter), dtype=np.float64)
+    cheap, quantile = fee_quantile_mask(fees, fee_quantile)
     
     #return those funds with fees below the quantile
-    print 'quantile threshold for',len(fund_filter),'funds is',quantile 
-    cheap_funds = df_filtered[df_filtered.apply(lambda x: x['ExpRatio'] <= quantile, axis=1)]
-    return list(cheap_funds.index)
+    log.debug('quantile threshold for %s funds is %s', len(fund_filter), quantile)
+    return list(fund_filter[cheap])
 
 def get_fund_date_bounds(df):
+    if isinstance(df, ReturnsPanel):
+        return df.date_bounds()
     fund_list = get_fund_list(df)
     date_df = pd.DataFrame(None,index=fund_list)
     flat_df = df.reset_index(1)
@@ -438,87 +725,69 @@ def get_fund_date_bounds(df):
     date_df['end_date'] = flat_df['level_1'].groupby(level=0).last()
     return date_df
     
-def get_r2_bucket_funds(threshold=0.9, force_bucket=False, r2_file='r2_all_funds.pandas', bucket_file='bucketed_r2.pandas'):
-    """ Creates a dataframe of funds that are highly correlated (by threshold) to each asset class"""
-    if not force_bucket and os.path.isfile(bucket_file):
-        print "Loading bucketed R2 file from cache:",bucket_file
-        return pd.load(bucket_file)
-    #otherwise create the bucket file
-    if not os.path.isfile(r2_file): 
-        print "R2 file (%s) does not exist. Run calc_all_fund_r2() first" % r2_file 
-        return False 
-    else:
-        print "Bucketing by R2"
-    r2_df = pd.load(r2_file)
-    # take only the ones over threshold, and drop any rows with no assets highly correlated
-    bucketed_df=r2_df[r2_df.apply(lambda x: x > threshold, axis=1)].dropna(how='all')  
-
-    # save for next time
-    bucketed_df.save(bucket_file)
-    return bucketed_df
-
-def get_style_bucket_funds(fund_returns, force_bucket=False, bucket_file='bucketed_style.pandas'):
-    """ Creates a dataframe of funds that by style mapped to each asset class"""
-    if not force_bucket and os.path.isfile(bucket_file):
-        print "Loading bucketed style file from cache:",bucket_file
-        return pd.load(bucket_file)
-    #otherwise create the bucket file
-    print "Bucketing by style"
+def benchmark_store_fingerprint():
+    """ Cache inputs of the benchmark store: the benchmark files and fees """
+    return [benchmark_source, benchmark_index_fees, 
+            [file_fingerprint(config['index_path'] + benchmark_source[b]) for b in sorted(benchmark_source.keys())]]
+
+def benchmark_fingerprint():
+    """ Cache inputs of anything computed from the asset class benchmark returns """
+    return [asset_classes, asset_class_bmks, benchmark_store_fingerprint()]
+
+def r2_fingerprint():
+    return [fund_returns_fingerprint(), benchmark_fingerprint()]
+
+def get_r2_bucket_funds(threshold=0.9, force_bucket=False, min_overlap=MIN_R2_OVERLAP):
+    """ Buckets the funds that are highly correlated (by threshold) to each asset class, see fund_buckets.py 
     
+    Derived from the cached R2 statistics each time (cheap), which are updated incrementally with new data """
+    log.debug('Bucketing by R2')
+    r2_df = calc_all_fund_r2(force_calc=force_bucket, min_overlap=min_overlap)
+    # keep the ones over threshold; funds with no assets highly correlated are dropped
+    return FundBuckets.from_frame(r2_df > threshold)
+
+def get_style_bucket_funds(fund_returns, force_bucket=False):
+    """ Buckets the funds by style mapped to each asset class, see fund_buckets.py """
+    # caching to make things faster most of the time
+    return artifact_cache.get('bucketed_style', 
+                              [fund_returns_fingerprint(), sql_fund_styles, asset_classes, crsp_style_mapping],
+                              lambda: bucket_funds_by_style(fund_returns), force=force_bucket)
+
+def bucket_funds_by_style(fund_returns):
+    """ Builds the get_style_bucket_funds() buckets, bypassing the cache """
+    log.info('Bucketing by style')
     fund_styles = get_fund_styles()
-    
-    # apply mapping of our asset classes to styles
-    # [[put in metamappings.py]]
-    asset_style_results = {}
-    fund_list = get_fund_list(fund_returns)
-    asset_list = asset_classes
-    # dataframe to hold our results, index by fund, columns will be asset classes
-    style_df=pd.DataFrame(index=fund_list)
+    buckets = bucket_by_style(get_fund_list(fund_returns), fund_styles.index, fund_styles['StyleCode'],
+                              crsp_style_mapping, asset_classes)
+    counts = buckets.counts()
     for asset_class in asset_classes:
-        print '***** Looking up styles for asset class',asset_class 
-        styles = crsp_style_mapping[asset_class] 
-        #loop through on the funds we have styles for
-        for fund in list(set(fund_list).intersection(list(fund_styles.index))):
-            if fund_styles.ix[fund]['StyleCode'] in styles:
-                asset_style_results[fund] = 1
-        style_df[asset_class] = pd.Series(asset_style_results)
-        asset_style_results = {}    
-    
-    # take only the matching styles, and drop any rows with no assets highly correlated
-    bucketed_df=style_df[style_df.apply(lambda x: x == 1, axis=1)].dropna(how='all')  
-    
-    # save for next time
-    bucketed_df.save(bucket_file)
-    return bucketed_df 
-
-def calc_all_fund_r2(fund_returns, asset_returns, force_calc=False, df_file='r2_all_funds.pandas'):
-    """ Calculates R2 across all funds and asset class benchmarks, returns dataframe of results """
-    # caching to make things faster most of the time
-    if not force_calc and os.path.isfile(df_file):
-        print "Loading R2 file from cache:",df_file
-        return pd.load(df_file)
-    #otherwise re-calc 
-    asset_r2_results = {}
-    fund_list = get_fund_list(fund_returns)
-    asset_list = asset_classes
-    # dataframe to hold our results, index by fund, columns will be asset classes
-    r2_df=pd.DataFrame(index=fund_list)
-    for asset_series in asset_returns:
-        print '***** Calculating R2 for asset class',asset_series.name 
-        for fund in fund_list:
-            #reindex as datetime so we can resample to EOM dates and join with the benchmark
-            f = fund_returns.ix[fund]
-            f.index = pd.DatetimeIndex(f.index)
-            f = f.resample('M', how='prod') # just to normalize dates, shouldn't change data points
-            r2 = calc_r2(f.join(asset_series,how='outer'))
-            asset_r2_results[fund] = r2 
-            print 'R2(%s, fund %s) = %s' % (asset_series.name,fund,r2)
-            
-        r2_df[asset_series.name] = pd.Series(asset_r2_results)
-        asset_r2_results = {}
-    print 'Saving R2 results to',df_file 
-    r2_df.save(df_file)
-    return r2_df 
+        log.info('%s: %s funds', asset_class, counts[asset_class])
+    return buckets
+
+def get_r2_stats(fund_returns=None, asset_returns=None, force_calc=False, workers=1):
+    """ Sufficient statistics of R2 across all funds and asset class benchmarks, see r2_engine.py
+
+    Kept in the cache across data releases: when the database or benchmarks change, only the new funds 
+    and new months are folded in (force_calc recomputes everything).  fund_returns and asset_returns 
+    default to get_fund_returns_panel() and the returns of all asset_classes """
+    def funds():
+        return fund_returns if fund_returns is not None else get_fund_returns_panel()
+    def assets():
+        return asset_returns if asset_returns is not None else load_asset_class_returns(asset_classes)
+    return artifact_cache.update('r2_stats', [asset_classes], fingerprint(r2_fingerprint()),
+                                 lambda: r2_stats(funds(), assets(), workers=workers),
+                                 lambda stats: refresh_r2_stats(stats, funds(), assets(), workers=workers),
+                                 force=force_calc)
+
+def calc_all_fund_r2(fund_returns=None, asset_returns=None, force_calc=False, min_overlap=MIN_R2_OVERLAP, workers=1):
+    """ Calculates R2 across all funds and asset class benchmarks, returns dataframe of results 
+    
+    Pairs with fewer than min_overlap months in common get no R2.  See get_r2_stats() for the arguments """
+    return get_r2_stats(fund_returns, asset_returns, force_calc, workers).to_frame(min_overlap)
+
+def calc_fund_r2(fund_returns, asset_returns, min_overlap=MIN_R2_OVERLAP, workers=1):
+    """ Builds the calc_all_fund_r2() dataframe, bypassing the cache """
+    return r2_stats(fund_returns, asset_returns, workers=workers).to_frame(min_overlap)
 
 def calc_r2(df1,df2):
     """ calculates R2 of the first column of each of two dataframes """
@@ -542,7 +811,8 @@ def calc_annual_return_from_monthly(ts):
 def get_portfolio_return(port_def, crsp_returns, riskfree_returns, start_date, end_date): # iterates over portfolio, splices  
     """ Loads the portfolio, splices funds for each asset class and calculates the returns
     
-    Handles portfolio of non-CRSP returns via csv, for example those sourced from xignite """
+    Handles portfolio of non-CRSP returns via csv, for example those sourced from xignite.  Raises ValueError
+    when the funds of an asset class do not have returns for the whole horizon """
     comp_pf_return = 0
     return_df = pd.DataFrame()
     
@@ -552,7 +822,7 @@ def get_portfolio_return(port_def, crsp_returns, riskfree_returns, start_date, e
         constituent_list = [pd.Series(None,index=pd.date_range(start_date,end_date,freq='M'))]
         for ticker in tickers:
             if type(ticker) == int: #it's a crsp_fundno, get from CRSP data
-                constituent_list.append(crsp_returns.ix[ticker]['Return'])
+                constituent_list.append(fund_return_series(crsp_returns, ticker))
             else:  # get from file-based data (xignite, index, etc)
                 constituent_list.append(load_asset_class_returns(asset_list=[ticker])[0])   
                 
@@ -560,13 +830,12 @@ def get_portfolio_return(port_def, crsp_returns, riskfree_returns, start_date, e
         
         spliced_returns = spliced_returns[start_date:end_date]
         spliced_returns.index = pd.DatetimeIndex(spliced_returns.index) #convert to DatetimeIndex
-        spliced_returns = spliced_returns.resample('M', how='prod')  # ensure all monthly       
+        spliced_returns = monthly_prod(spliced_returns)  # ensure all monthly       
         ann_return = calc_annual_return_from_monthly(spliced_returns)  # calculate annualized return (old way)
         if len(spliced_returns.dropna()) <> len(spliced_returns):
-            print 'ERROR: Not enough portfolio returns, try adding an index?',asset_class,\
-                  ': need',len(spliced_returns),'got',len(spliced_returns.dropna()) 
-            sys.exit()
-        print asset_class,'return=',ann_return 
+            raise ValueError('Not enough portfolio returns, try adding an index? %s: need %s got %s' % 
+                             (asset_class, len(spliced_returns), len(spliced_returns.dropna())))
+        log.debug('%s return=%s', asset_class, ann_return)
         comp_pf_return += ann_return * weight # old way
         
         # portfolio way
@@ -589,8 +858,8 @@ def get_portfolio_return(port_def, crsp_returns, riskfree_returns, start_date, e
     pf_values = return_df.cumprod().sum(axis=1)
     pf_returns = pf_values / pf_values.shift(1)
     pf_trial_return = calc_annual_return_from_monthly(pf_returns)
-    print 'comp_pf_return (old way) =',comp_pf_return
-    print 'pf_return=',pf_trial_return
+    log.debug('comp_pf_return (old way) = %s', comp_pf_return)
+    log.debug('pf_return= %s', pf_trial_return)
     
     # calculate excess return (for sharpe calculation)
     pf_excess_returns = pf_returns.sub(riskfree_returns - 1).dropna()
@@ -599,56 +868,71 @@ def get_portfolio_return(port_def, crsp_returns, riskfree_returns, start_date, e
     # return annual return and annualized standard deviation of returns
     return pf_trial_return, pf_trial_excess_return, pf_excess_returns.std() * math.sqrt(12)
 
+_benchmark_store = {}
+
+def get_benchmark_store(force_rebuild=False):
+    """ The BenchmarkStore of every benchmark file in benchmark_source, see benchmark_store.py
+
+    The files are parsed once per change of the files or fees and kept in the cache as arrays; within a 
+    run the store is loaded once """
+    parts = benchmark_store_fingerprint()
+    key = fingerprint(parts)
+    if force_rebuild or key not in _benchmark_store:
+        _benchmark_store.clear()
+        _benchmark_store[key] = artifact_cache.get('benchmarks', parts, 
+            lambda: BenchmarkStore.from_files(config['index_path'], benchmark_source, benchmark_index_fees),
+            force=force_rebuild, dump=lambda store, path: store.save(path), load=BenchmarkStore.load)
+    return _benchmark_store[key]
+
 def load_benchmark_returns(bmk_list=['MSCI_EAFE'], fee_adjust=None):
-    """ loads the list of benchmark returns from file.  Optionally adjust returns by a fee 
-    
-    Assumes return is in percentage terms, e.g. 5.5 is 5.5%, so we divide by 100 """
-    benchmark_return_series = []
-    for f in bmk_list:
-        rs = pd.Series(pd.read_csv(config['index_path'] + benchmark_source[f], \
-                                   sep='\t',parse_dates=True)['Return']/100+1)
-        if fee_adjust:
-            monthly_fee = benchmark_index_fees[f] / 12
-            print f,': Adjusting benchmark returns by underlying monthly fee',monthly_fee
-            rs -= monthly_fee
-        benchmark_return_series.append(rs)
-    return benchmark_return_series
+    """ loads the list of monthly benchmark returns (R+1, End of Month).  Optionally adjust returns by the 
+    benchmark's fee in benchmark_index_fees """
+    store = get_benchmark_store()
+    return [store.series(f, fee_adjust) for f in bmk_list]
 
 def load_asset_class_returns(asset_list=['US_LargeCap']):
     """ loads the list of asset class returns by looking up benchmarks and splicing them """
-    asset_class_returns = []
-    for a in asset_list:
-        print 'Loaded',a
-        asset_class_returns.append(splice_returns(load_benchmark_returns(asset_class_bmks[a], fee_adjust=True), name=a))
-    return asset_class_returns
+    store = get_benchmark_store()
+    return [store.spliced(asset_class_bmks[a], name=a) for a in asset_list]
     
+def monthly_prod(ts):
+    """ Compounds a returns series to EOM months, leaving months without any return NaN (newer pandas 
+    multiply no returns into 1, which would hide the gap) """
+    has_return = ts.resample('M', how='count') > 0
+    monthly = ts.resample('M', how='prod')
+    monthly[~has_return] = np.nan
+    return monthly
+
 def splice_returns(constituents, name=None, resample_base=True):
     """ Takes a list of monthly returns TimeSeries and concatenates them in order giving precidence to the earlier items 
     To do this we normalize to monthly frequency EOM dates
     We are splicing the constitents INTO the first one listed"""
     if resample_base:
-        master_series = constituents[0].resample('M', how='prod')
+        master_series = monthly_prod(constituents[0])
     else:
         master_series = constituents[0]
     try:  #in case there is nothing to splice
         for c in constituents[1:]:
-            master_series = master_series.combine_first(c.resample('M', how='prod')) 
+            master_series = master_series.combine_first(monthly_prod(c)) 
     except:
         pass 
     master_series.name = name 
     return master_series
 
-def new_data_setup():
-    """ MANUAL: things to run when new data is integrated (force regenerate all pandas cached files) 
-    ********* FOR NEW DATA SETUP ONLY"""
-    
-    # these may be run one at a time.  if this isn't used and pandas files are not available
-    # they will be run anyway by the engine.
-    returns = get_all_fund_returns(force_db_read=True)    
-    fs = get_style_bucket_funds(returns, force_bucket=True)
-    areturns=load_asset_class_returns(asset_classes)
-    allr2 = calc_all_fund_r2(returns,areturns,force_calc=True) # to run
-    buckets=get_r2_bucket_funds(force_bucket=True) # to run
+def new_data_setup(force=False, workers=None):
+    """ Brings every cached artifact up to date with the current database, mappings and code 
+    
+    Artifacts are cached under a fingerprint of their inputs (see cache_manager.py), so only the stale ones
+    are rebuilt.  The engine does the same on demand; this just does it all up front.
+    force: rebuild everything regardless
+    workers: processes for the R2 calculation, defaults to one per core """
+    returns = get_all_fund_returns(force_db_read=force)    
+    panel = get_fund_returns_panel(force_rebuild=force, fund_returns=returns)
+    fs = get_style_bucket_funds(panel, force_bucket=force)
+    bmks = get_benchmark_store(force_rebuild=force)
+    allr2 = calc_all_fund_r2(panel, force_calc=force, workers=workers or cpu_count())
+    buckets = get_r2_bucket_funds()
+    tna = get_annual_total_net_assets(force_db_read=force)
 
 if __name__ == "__main__":
     main()
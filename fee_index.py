@@ -0,0 +1,112 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Fee index ###
+### Point-in-time expense ratios: the fee each fund charged at any date, for many funds at once ###
+import numpy as np
+import pandas as pd
+from month_axis import *
+from fund_timeline import *
+
+class FeeIndex(object):
+    """ FUND_FEES expense ratios in CSR layout
+
+    The fee records of fundnos[i] are rows offsets[i]:offsets[i+1], sorted by begdt (YYYYMMDD integers).
+    The fee of a fund at a date is the one of its latest record that began on or before the date, as long
+    as that record had not ended by then (enddt, rounded up to its month end as CRSP ends records on the 
+    last business day).  Dates before a fund's first record, in gaps between records or after its last 
+    one have no fee (NaN): the fee a fund charged later is never used for an earlier date. """
+
+    def __init__(self, fundnos, offsets, begdt, enddt, exp_ratio):
+        self.fundnos = fundnos
+        self.offsets = offsets
+        self.begdt = begdt
+        self.enddt = enddt
+        self.exp_ratio = exp_ratio
+        # search keys of the rows: (fund position, begdt), sorted since rows sort by fund then begdt
+        self.keys = np.repeat(np.arange(len(fundnos), dtype=np.int64), np.diff(offsets)) * 10**8 + begdt
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Builds the index from (crsp_fundno, begdt, enddt, exp_ratio) rows as read by get_fund_fees()
+
+        Records without a begin date or expense ratio (blank or the -99 missing code) are dropped, records
+        without an end date are open-ended """
+        numbers = (int, long, float)
+        rows = [(fund, begdt, enddt if isinstance(enddt, numbers) else 99991231, exp_ratio) 
+                for fund, begdt, enddt, exp_ratio in rows
+                if isinstance(begdt, numbers) and isinstance(exp_ratio, numbers) and exp_ratio != -99.0]
+        fund = np.array([row[0] for row in rows], dtype=np.int64)
+        begdt = np.array([row[1] for row in rows], dtype=np.int64)
+        enddt = np.array([row[2] for row in rows], dtype=np.int64)
+        exp_ratio = np.array([row[3] for row in rows], dtype=np.float64)
+        enddt = np.where(enddt < 99991231, month_end_yyyymmdd((enddt // 10000)*12 + enddt // 100 % 100 - 1), enddt)
+
+        order = np.lexsort((begdt, fund))
+        fund, begdt, enddt, exp_ratio = fund[order], begdt[order], enddt[order], exp_ratio[order]
+        fundnos, starts = np.unique(fund, return_index=True)
+        return cls(fundnos, np.r_[starts, len(fund)].astype(np.int64), begdt, enddt.astype(np.int64), exp_ratio)
+
+    def positions(self, fundnos):
+        """ (positions, known) of fundnos in the index: known is False for funds without fee data """
+        fundnos = np.asarray(fundnos, dtype=np.int64)
+        if not len(self.fundnos):
+            return np.zeros(len(fundnos), dtype=np.int64), np.zeros(len(fundnos), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.fundnos, fundnos), len(self.fundnos)-1)
+        return pos, self.fundnos[pos] == fundnos
+
+    def as_of(self, fundnos, dates):
+        """ Expense ratio of each fund at each date (YYYYMMDD integers, one per fund or a single one for all),
+        NaN for funds without a fee record covering the date """
+        pos, known = self.positions(fundnos)
+        dates = np.asarray(dates, dtype=np.int64) * np.ones(len(pos), dtype=np.int64)
+        fees = np.empty(len(pos))
+        fees.fill(np.nan)
+        pos, dates, at = pos[known], dates[known], np.flatnonzero(known)
+
+        # one searchsorted for all funds finds the last record of each fund that began by its date
+        rows = np.searchsorted(self.keys, pos * 10**8 + dates, side='right') - 1
+        covered = rows >= self.offsets[pos]
+        rows = np.maximum(rows, self.offsets[pos])
+        covered &= dates <= self.enddt[rows]
+        fees[at[covered]] = self.exp_ratio[rows[covered]]
+        return fees
+
+    def latest(self, fundnos):
+        """ Expense ratio of each fund's latest record (like get_fund_fees()), NaN for funds without fee data """
+        pos, known = self.positions(fundnos)
+        fees = np.empty(len(pos))
+        fees.fill(np.nan)
+        fees[known] = self.exp_ratio[self.offsets[pos[known]+1] - 1]
+        return fees
+
+def fee_quantile_mask(fees, fee_quantile):
+    """ True for the fees at or below the fee_quantile quantile of the (non-NaN) fees: funds without a fee are
+    left out, as the dataframe filter always did """
+    quantile = pd.Series(fees).quantile(fee_quantile)
+    with np.errstate(invalid='ignore'):
+        return fees <= quantile, quantile
+
+def fee_filtered_timeline(timeline, fee_index, fee_quantile):
+    """ Keeps, in each month of an OpenFundTimeline, the funds whose fee at that month end is at or below the
+    fee_quantile quantile of the fees of that month's open funds """
+    fees = fee_index.as_of(timeline.members, month_end_yyyymmdd(timeline.entry_months()))
+    keep = np.zeros(len(fees), dtype=bool)
+    for t in range(timeline.months):
+        month = slice(timeline.offsets[t], timeline.offsets[t+1])
+        keep[month] = fee_quantile_mask(fees[month], fee_quantile)[0]
+    return timeline.where(keep)
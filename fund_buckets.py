@@ -0,0 +1,78 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Fund buckets ###
+### Which funds belong to each asset class, as a boolean asset class x fund matrix ###
+import numpy as np
+
+class FundBuckets(object):
+    """ Asset class membership of funds
+
+    members[i, j] is True if fundnos[j] is in the bucket of asset_classes[i].  Only funds in at least one
+    bucket are kept, sorted by crsp_fundno. """
+
+    def __init__(self, asset_classes, fundnos, members):
+        self.asset_classes = list(asset_classes)
+        self.fundnos = fundnos
+        self.members = members
+
+    @classmethod
+    def from_matrix(cls, asset_classes, fundnos, members):
+        """ Drops the funds in no bucket and sorts by crsp_fundno """
+        fundnos = np.asarray(fundnos, dtype=np.int64)
+        members = np.asarray(members, dtype=bool)
+        keep = members.any(axis=0)
+        order = np.argsort(fundnos[keep], kind='mergesort')
+        return cls(asset_classes, fundnos[keep][order], members[:, keep][:, order])
+
+    @classmethod
+    def from_frame(cls, df):
+        """ From a boolean dataframe indexed by fund with one column per asset class (NaN counts as False) """
+        return cls.from_matrix(list(df.columns), df.index, np.asarray(df.fillna(False), dtype=bool).T)
+
+    def funds(self, asset_class):
+        """ crsp_fundnos in the bucket of an asset class """
+        return self.fundnos[self.members[self.asset_classes.index(asset_class)]]
+
+    def counts(self):
+        return dict(zip(self.asset_classes, self.members.sum(axis=1)))
+
+def bucket_by_style(fundnos, style_fundnos, style_codes, style_mapping, asset_classes):
+    """ Buckets funds by their style code in one pass
+
+    fundnos: the funds to bucket, style_fundnos/style_codes: one style code per fund (funds without one are
+    left out), style_mapping: {asset class: [style codes]} as crsp_style_mapping in metamappings.py """
+    # explode the mapping into an asset class x style code table
+    codes = np.unique(np.asarray(style_codes, dtype=object))
+    table = np.zeros((len(asset_classes), len(codes)), dtype=bool)
+    for i, asset_class in enumerate(asset_classes):
+        table[i] = np.in1d(codes, np.asarray(style_mapping[asset_class], dtype=object))
+
+    # style code of each fund, -1 for funds without one
+    fundnos = np.unique(np.asarray(fundnos, dtype=np.int64))
+    style_fundnos = np.asarray(style_fundnos, dtype=np.int64)
+    code_ids = np.searchsorted(codes, np.asarray(style_codes, dtype=object))
+    fund_code = np.repeat(-1, len(fundnos))
+    pos = np.searchsorted(fundnos, style_fundnos)
+    found = pos < len(fundnos)
+    found[found] = fundnos[pos[found]] == style_fundnos[found]
+    fund_code[pos[found]] = code_ids[found]
+
+    has_style = fund_code >= 0
+    members = np.zeros((len(asset_classes), len(fundnos)), dtype=bool)
+    members[:, has_style] = table[:, fund_code[has_style]]
+    return FundBuckets.from_matrix(asset_classes, fundnos, members)
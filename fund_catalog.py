@@ -0,0 +1,74 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Fund catalog ###
+### Names, tickers, groups and flags of every fund, read from FUND_HDR once per run ###
+import numpy as np
+from run_log import get_logger
+
+log = get_logger('fund_catalog')
+
+class FundCatalog(object):
+    """ FUND_HDR metadata as a structured array sorted by crsp_fundno, looked up with searchsorted
+
+    Replaces per-call "crsp_fundno in (...)" queries when printing and exporting fund lists """
+
+    columns = ['crsp_fundno', 'fund_name', 'nasdaq', 'crsp_cl_grp', 'crsp_portno',
+               'retail_fund', 'inst_fund', 'index_fund_flag', 'vau_fund', 'dead_flag']
+    dtype = [('crsp_fundno', np.int64)] + [(name, object) for name in columns[1:]]
+
+    def __init__(self, funds):
+        self.funds = funds
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Builds the catalog from query rows holding the columns above, in order """
+        funds = np.array([tuple(row) for row in rows], dtype=cls.dtype)
+        funds.sort(order='crsp_fundno')
+        return cls(funds)
+
+    def __len__(self):
+        return len(self.funds)
+
+    def lookup(self, fundno_list):
+        """ Catalog records of the given funds in the order given, skipping non-fund ids (benchmark names)
+        and funds not in FUND_HDR """
+        ids = np.array([x for x in fundno_list if isinstance(x, (int, long, np.integer))], dtype=np.int64)
+        fundnos = self.funds['crsp_fundno']
+        if not len(fundnos):
+            return self.funds[:0]
+        pos = np.minimum(np.searchsorted(fundnos, ids), len(fundnos)-1)
+        return self.funds[pos[fundnos[pos] == ids]]
+
+    def info(self, fundno_list):
+        """ (crsp_fundno, fund_name, nasdaq) of the given funds, as get_fund_info() returns them """
+        return [(int(f['crsp_fundno']), f['fund_name'], f['nasdaq']) for f in self.lookup(fundno_list)]
+
+    def log_funds(self, fundno_list):
+        for fundno, name, ticker in self.info(fundno_list):
+            log.info('%s - %s (%s)', ticker if ticker else '(Unknown)', name, fundno)
+
+    def write_fund_list(self, path, fundno_list):
+        """ Writes "ticker","name","crsp_fundno" lines for the given funds in a single write """
+        lines = ['"%s","%s","%s"\n' % (ticker if ticker else 'Unknown', name, fundno)
+                 for fundno, name, ticker in self.info(fundno_list)]
+        f = open(path, 'wb')
+        try:
+            f.write(''.join(lines))
+        finally:
+            f.close()
+        return len(lines)
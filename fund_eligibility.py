@@ -0,0 +1,128 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Fund eligibility ###
+### The rules leaving funds out of the engine, classified once per fund into the FUND_ELIGIBILITY table ###
+import sqlite3 as lite
+from cache_manager import fingerprint
+from run_log import get_logger
+
+log = get_logger('fund_eligibility')
+
+# leave out variable annuity funds, institutional funds, non-retail funds, 
+# target data / balanced funds, and various non-applicable share classes
+# NOTE: Some funds were marked non-retail (e.g. ETFs), so we manually change the flag in order to use in analysis
+#    e.g. update FUND_HDR set retail_fund='Y' where crsp_fundno in ( 16429 ,31351, 31350, 16413,16432) ;
+#
+# Each rule is a reason code and the FUND_HDR condition that excludes a fund for that reason.  The rules are 
+# evaluated once per fund into the FUND_ELIGIBILITY table (see build_fund_eligibility()) and queries join on 
+# that table instead of repeating the conditions for every row.  A NULL flag or name counts as excluded, 
+# just like the "<> 'Y'" / "not like" predicates these rules replace.
+
+def like_any(patterns):
+    return ' or '.join("fund_name like '%s'" % p for p in patterns)
+
+exclusion_rules = [
+    ('variable_annuity', "vau_fund = 'Y' or vau_fund is null"),
+    ('institutional', "inst_fund = 'Y' or inst_fund is null"),
+    ('non_retail', "retail_fund = 'N' or retail_fund is null"),
+    ('missing_name', "fund_name is null"),
+    ('target_date', like_any(['%2010%', '%2015%', '%2020%', '%2025%', '%2030%', '%2035%', 
+                              '%2040%', '%2045%', '%2050%', '%2055%', '%2060%'])),
+    ('long_short', like_any(['%130/30%', '%120/20%', '%Long/Short%', '%Long-Short%'])),
+    ('insurer', like_any(['%Pacific Life%', '%MassMutual %', '%Transamerica %'])),
+    ('share_class', like_any(['%/Instl', '%/Y', '%/X', '%/H', '%/D', '%/N', '%/Z', '%/Q', '%/Ist', '%/Inst', 
+                              '%/P', '%/E', '%Institutional Class%', '%Institutional Shares%', '%Advisor Shares',
+                              '%R Shares', '%T Shares', '%M Shares', '%H Shares', '%I Shares', '%J Shares', 
+                              '%G Shares', '%K Shares', '%N Shares', '%L Shares', '%P Shares', '%S Shares', 
+                              '%E Shares', '%Y Shares', '%Z Shares', '%O Shares', '%Q Shares', '%A1 Shares', 
+                              '%B1 Shares', '%C1 Shares', '%C2 Shares', '%R1 Shares', '%R5 Shares', 
+                              '%D Shares', '%X Shares'])),
+    ('529_plan', like_any(['%529%'])),
+    ('index_fund', like_any(['%Index Fund%'])),
+    ]
+
+exclusion_bits = dict((reason, 1 << i) for i, (reason, condition) in enumerate(exclusion_rules))
+
+# We don't want index funds in regular active fund queries, but we do when loading data to the master set
+data_load_exclusions = sum(bit for reason, bit in exclusion_bits.items() if reason != 'index_fund')
+active_exclusions = sum(exclusion_bits.values())
+
+# filters on FUND_HDR (alias-free) for the two fund sets
+common_excludes_data_load = """and crsp_fundno in (select crsp_fundno from FUND_ELIGIBILITY where load_ok = 1)"""
+common_excludes = """and crsp_fundno in (select crsp_fundno from FUND_ELIGIBILITY where active_ok = 1)"""
+
+pragmas = """PRAGMA case_sensitive_like = true; """
+
+def eligibility_fingerprint():
+    """ Identifies the exclusion rules the FUND_ELIGIBILITY table was built with """
+    return fingerprint([pragmas, exclusion_rules])
+
+# the FUND_HDR columns the rules look at, so that edits to FUND_HDR (a new load, or a hand-fixed flag like 
+# the retail_fund update above) get the funds classified again
+sql_fund_hdr_rule_columns = """select crsp_fundno, vau_fund, inst_fund, retail_fund, fund_name from FUND_HDR 
+        order by crsp_fundno, rowid;"""
+
+def fund_hdr_signature(con):
+    """ Hash of the rule columns of every FUND_HDR row, NULLs included """
+    return fingerprint(list(con.execute(sql_fund_hdr_rule_columns)))
+
+def fund_eligibility_current(con):
+    """ True if FUND_ELIGIBILITY exists and was built with the current exclusion rules and FUND_HDR """
+    if not con.execute("select count(*) from sqlite_master where type = 'table' and name = 'FUND_ELIGIBILITY_VERSION';").fetchone()[0]:
+        return False
+    row = con.execute("select * from FUND_ELIGIBILITY_VERSION;").fetchone()
+    return row is not None and tuple(row) == (eligibility_fingerprint(), fund_hdr_signature(con))
+
+def build_fund_eligibility(db_path):
+    """ Classifies every fund in FUND_HDR once into the FUND_ELIGIBILITY table
+    
+    reasons is a bitmask of exclusion_bits; load_ok/active_ok flag the funds passing common_excludes_data_load
+    and common_excludes.  Everything is computed in a single scan of FUND_HDR with SQLite's own LIKE, so the 
+    result is the same as the predicate chains this replaces.
+
+    This is the only write the engine's code makes to the database, run by crsp_import.py after a load (or 
+    with --classify).  It is one transaction, taken with BEGIN IMMEDIATE and with the sqlite3 module's own 
+    transaction handling off (it would commit before each create/drop), so engine processes reading the 
+    database see either the old tables or the new ones. """
+    log.info('Classifying fund eligibility')
+    reasons = ' | '.join('(case when (%s) then %d else 0 end)' % (condition, exclusion_bits[reason]) 
+                         for reason, condition in exclusion_rules)
+    con = lite.connect(db_path, isolation_level=None)
+    try:
+        con.executescript(pragmas)
+        con.execute("begin immediate;")
+        try:
+            con.execute("drop table if exists FUND_ELIGIBILITY;")
+            con.execute("drop table if exists FUND_ELIGIBILITY_VERSION;")
+            con.execute("""create table FUND_ELIGIBILITY (crsp_fundno INTEGER NOT NULL PRIMARY KEY, 
+                           reasons INTEGER NOT NULL, load_ok INTEGER NOT NULL, active_ok INTEGER NOT NULL);""")
+            con.execute("""insert into FUND_ELIGIBILITY 
+                           select crsp_fundno, reasons, (reasons & %d) = 0, (reasons & %d) = 0 
+                           from (select crsp_fundno, %s as reasons from FUND_HDR);""" 
+                        % (data_load_exclusions, active_exclusions, reasons))
+            con.execute("create index idx_fund_eligibility_load on FUND_ELIGIBILITY (load_ok, crsp_fundno);")
+            con.execute("create index idx_fund_eligibility_active on FUND_ELIGIBILITY (active_ok, crsp_fundno);")
+            con.execute("create table FUND_ELIGIBILITY_VERSION (rules TEXT NOT NULL, fund_hdr TEXT NOT NULL);")
+            con.execute("insert into FUND_ELIGIBILITY_VERSION values (?, ?);", 
+                        (eligibility_fingerprint(), fund_hdr_signature(con)))
+            con.execute("commit;")
+        except:
+            con.execute("rollback;")
+            raise
+    finally:
+        con.close()
@@ -0,0 +1,83 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Open fund timeline ###
+### Precomputes which funds of a fund list are open in each month, so "who is open at month m" is a table lookup ###
+import numpy as np
+from month_axis import *
+
+class OpenFundTimeline(object):
+    """ The funds of a fund list that are open in each month of a time horizon
+
+    The open funds for month first_month+t are members[offsets[t]:offsets[t+1]], sorted by crsp_fundno.
+    A fund is open in a month if it started on or before the month end and ended on or after it. """
+
+    def __init__(self, first_month, offsets, members):
+        self.first_month = first_month
+        self.offsets = offsets
+        self.members = members
+
+    @classmethod
+    def from_bounds(cls, fundnos, open_first, open_last, first_month, last_month):
+        """ Builds the timeline from each fund's first and last open month (ordinals) """
+        fundnos = np.asarray(fundnos, dtype=np.int64)
+        first = np.maximum(np.asarray(open_first), first_month)
+        last = np.minimum(np.asarray(open_last), last_month)
+        lengths = np.maximum(last - first + 1, 0)
+
+        # expand each fund into one (month, fundno) pair per open month, then order by month and fundno
+        pair_fund = np.repeat(fundnos, lengths)
+        pair_start = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        pair_month = np.repeat(first, lengths) + (np.arange(lengths.sum()) - pair_start)
+        order = np.lexsort((pair_fund, pair_month))
+        counts = np.bincount(pair_month - first_month, minlength=last_month - first_month + 1)
+        return cls(first_month, np.r_[0, np.cumsum(counts)], pair_fund[order])
+
+    @classmethod
+    def from_date_bounds(cls, date_bounds, fund_list, start_date, end_date):
+        """ Builds the timeline of fund_list over a horizon, from get_fund_date_bounds() output """
+        bounds = date_bounds.reindex(np.unique(np.asarray(fund_list, dtype=np.int64))).dropna()
+        return cls.from_bounds(bounds.index, month_ordinals(bounds['start_date']), last_open_months(bounds['end_date']),
+                               month_ordinal(start_date), month_ordinal(end_date))
+
+    @property
+    def months(self):
+        return len(self.offsets) - 1
+
+    def open_at(self, month):
+        """ crsp_fundnos open in a month (ordinal), empty outside the horizon """
+        t = month - self.first_month
+        if t < 0 or t >= self.months:
+            return self.members[:0]
+        return self.members[self.offsets[t]:self.offsets[t+1]]
+
+    def open_funds(self, asof_date):
+        """ crsp_fundnos open at the end of the month of asof_date """
+        return self.open_at(month_ordinal(asof_date))
+
+    def restricted(self, fundnos):
+        """ A new timeline keeping only the given crsp_fundnos """
+        return self.where(np.in1d(self.members, np.asarray(fundnos, dtype=np.int64)))
+
+    def where(self, keep):
+        """ A new timeline keeping the (month, fund) entries where keep (aligned with members) is True """
+        kept_before = np.r_[0, np.cumsum(keep)]
+        return OpenFundTimeline(self.first_month, kept_before[self.offsets], self.members[keep])
+
+    def entry_months(self):
+        """ Month ordinal of each entry of members """
+        return self.first_month + np.repeat(np.arange(self.months), np.diff(self.offsets))
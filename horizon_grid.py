@@ -0,0 +1,70 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Horizon grid ###
+### Returns of many time horizons at once from cumulative log returns on the month axis ###
+from __future__ import division
+from datetime import date
+import numpy as np
+from month_axis import *
+
+def start_year_horizons(first_start_year, last_start_year, end_year, start_month=12, end_month=12):
+    """ (start_date, end_date) of every start year from first_start_year to last_start_year to a fixed end,
+    with the same days engine.py's main() uses """
+    return [(date(y, start_month, 25), date(end_year, end_month, 31)) for y in range(first_start_year, last_start_year + 1)
+            if y <= end_year]
+
+def rolling_horizons(window_years, first_start_year, last_end_year, start_month=12, end_month=12):
+    """ (start_date, end_date) of rolling windows of each length in window_years, starting every year from
+    first_start_year and ending by last_end_year """
+    return [(date(y, start_month, 25), date(y + w, end_month, 31)) for w in window_years
+            for y in range(first_start_year, last_end_year - w + 1)]
+
+def horizon_windows(horizons, first_month, months=None):
+    """ (first column, last column) of each horizon on a month axis starting at first_month
+
+    Windows may overlap.  Raises ValueError for a horizon ending before it starts or, given the axis length
+    months, not within the axis. """
+    windows = np.array([(month_ordinal(s) - first_month, month_ordinal(e) - first_month) for s, e in horizons],
+                       dtype=np.int64).reshape(-1, 2)
+    for (start_date, end_date), (first, last) in zip(horizons, windows):
+        if last < first:
+            raise ValueError('Horizon %s to %s ends before it starts' % (start_date, end_date))
+        if first < 0 or (months is not None and last >= months):
+            raise ValueError('Horizon %s to %s is outside the %s months of the trials' % (start_date, end_date, months))
+    return windows
+
+def prefix_log_returns(returns):
+    """ Cumulative log returns along the last axis with a leading 0, so the growth over columns a..b is
+    exp(prefix[..., b+1] - prefix[..., a]) """
+    shape = returns.shape[:-1] + (returns.shape[-1] + 1,)
+    prefix = np.zeros(shape)
+    np.cumsum(np.log(returns), axis=-1, out=prefix[..., 1:])
+    return prefix
+
+def window_returns(prefix, weights, windows):
+    """ Annualized buy-and-hold portfolio return of every trial in every window
+
+    prefix: trials x slots x (months+1) from prefix_log_returns(), weights: the slot weights, windows: from
+    horizon_windows().  Without rebalancing, the portfolio grows by the weighted average of the slot growths, and
+    like get_portfolio_return() the leading weight month counts toward the period.  Returns a
+    trials x windows array """
+    first, last = windows[:, 0], windows[:, 1]
+    growth = np.exp(prefix[:, :, last + 1] - prefix[:, :, first])
+    weights = np.asarray(weights, dtype=np.float64)
+    pf_growth = (growth * weights[None, :, None]).sum(axis=1) / weights.sum()
+    return pf_growth ** (12 / (last - first + 2))
@@ -0,0 +1,95 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Month axis helpers ###
+### Months are stored as integer ordinals (year*12 + month-1) so that return series can live in plain arrays ###
+from datetime import date
+import numpy as np
+# pandas is imported by the few functions returning pandas objects, so the trial engine starts without it
+
+_days_in_month = np.array([31,28,31,30,31,30,31,31,30,31,30,31])
+
+def month_ordinal(d):
+    """ Month ordinal of a date/datetime/Timestamp """
+    return d.year*12 + d.month - 1
+
+def month_ordinals(dates):
+    """ Month ordinals for an array-like of dates (anything DatetimeIndex accepts) """
+    import pandas as pd
+    dates = pd.DatetimeIndex(dates)
+    return np.asarray(dates.year, dtype=np.int32)*12 + np.asarray(dates.month, dtype=np.int32) - 1
+
+def month_end_index(first_month, last_month):
+    """ DatetimeIndex of the calendar month ends from first_month to last_month (ordinals, inclusive) """
+    import pandas as pd
+    return pd.date_range(datetime_from_ordinal(first_month), periods=last_month-first_month+1, freq='M')
+
+def datetime_from_ordinal(m):
+    """ First day of the month for a month ordinal """
+    year, month = divmod(int(m), 12)
+    return date(year, month+1, 1)
+
+def days_in_month(years, months):
+    """ Number of days in each month, months numbered 1-12 """
+    years = np.asarray(years)
+    months = np.asarray(months)
+    leap = ((years % 4 == 0) & (years % 100 != 0)) | (years % 400 == 0)
+    return _days_in_month[months-1] + ((months == 2) & leap)
+
+def last_open_months(end_dates):
+    """ Last month ordinal in which each fund counts as open, given the date of its last return
+
+    A fund is open at a month end only if its last return is dated on or after the calendar month end,
+    so a final return dated before the calendar month end (e.g. the last trading day) does not count
+    that month.  This mirrors the end_date >= month end comparisons made against get_fund_date_bounds() """
+    import pandas as pd
+    end_dates = pd.DatetimeIndex(end_dates)
+    years = np.asarray(end_dates.year)
+    months = np.asarray(end_dates.month)
+    short = np.asarray(end_dates.day) < days_in_month(years, months)
+    return (years*12 + months - 1 - short).astype(np.int32)
+
+def days_from_civil(years, months, days):
+    """ Days since 1970-01-01 for arrays of year, month (1-12) and day, using integer arithmetic only """
+    years = np.asarray(years, dtype=np.int64) - (np.asarray(months) <= 2)
+    months = np.asarray(months, dtype=np.int64)
+    era = years // 400
+    year_of_era = years - era*400
+    day_of_year = (153*(months + np.where(months > 2, -3, 9)) + 2)//5 + np.asarray(days, dtype=np.int64) - 1
+    day_of_era = year_of_era*365 + year_of_era//4 - year_of_era//100 + day_of_year
+    return era*146097 + day_of_era - 719468
+
+def dates_from_yyyymmdd(values):
+    """ DatetimeIndex from an array of YYYYMMDD integers (CRSP date format) """
+    values = np.asarray(values, dtype=np.int64)
+    days = days_from_civil(values//10000, values//100 % 100, values % 100)
+    import pandas as pd
+    return pd.DatetimeIndex((days * 86400 * 10**9).view('M8[ns]'))
+
+def month_end_yyyymmdd(ordinals):
+    """ Calendar month end of each month ordinal as a YYYYMMDD integer """
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    years, months = ordinals // 12, ordinals % 12
+    return years*10000 + (months+1)*100 + days_in_month(years, months+1)
+
+def month_end_dates(ordinals):
+    """ DatetimeIndex of the calendar month end for each month ordinal """
+    return dates_from_yyyymmdd(month_end_yyyymmdd(ordinals))
+
+def yyyymmdd(d):
+    """ YYYYMMDD integer of a date/datetime/Timestamp """
+    return d.year*10000 + d.month*100 + d.day
@@ -0,0 +1,222 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### R2 engine ###
+### R2 of every fund against every asset class benchmark, from masked matrix products over a common month axis ###
+from __future__ import division
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from month_axis import *
+from returns_store import *
+from trial_engine import pack_return_matrix, share_arrays, attach_arrays
+from run_log import get_logger
+
+log = get_logger('r2_engine')
+
+# fund/benchmark pairs with fewer months in common than this get no R2 (NaN)
+MIN_R2_OVERLAP = 12
+# funds per matrix product
+R2_BLOCK_SIZE = 2000
+
+class R2Stats(object):
+    """ Pairwise sums over the months where both a fund and a benchmark have a return
+
+    For fund i and benchmark k, over their common months (returns as R, not R+1): n[i,k] months,
+    sx/sxx sum and sum of squares of the fund returns, sy/syy of the benchmark returns and sxy the sum of
+    products.  That is all a Pearson correlation needs, so R2 never has to go back to the returns, and 
+    new months or funds are folded in by adding their sums (see refresh_r2_stats()).
+
+    The benchmark returns the sums were built from are kept (bench_values/bench_valid from first_month on) 
+    to tell whether a refresh only adds months or also restates history, and so is a checksum of each 
+    fund's returns up to last_month (fund_digest, see fund_digests()) for the same purpose on the fund side. """
+
+    fields = ['n', 'sx', 'sy', 'sxx', 'syy', 'sxy']
+
+    def __init__(self, fundnos, benchmarks, first_month, bench_values, bench_valid, n, sx, sy, sxx, syy, sxy, 
+                 fund_digest=None):
+        self.fundnos = fundnos
+        self.benchmarks = list(benchmarks)
+        self.first_month = first_month
+        self.bench_values = bench_values
+        self.bench_valid = bench_valid
+        self.n = n
+        self.sx = sx
+        self.sy = sy
+        self.sxx = sxx
+        self.syy = syy
+        self.sxy = sxy
+        self.fund_digest = fund_digest
+
+    @property
+    def last_month(self):
+        return self.first_month + self.bench_values.shape[1] - 1
+
+    def sums(self):
+        return [getattr(self, f) for f in self.fields]
+
+    def r2(self, min_overlap=MIN_R2_OVERLAP):
+        """ fund x benchmark matrix of squared correlations, NaN below min_overlap or without variance """
+        n = self.n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = n*self.sxy - self.sx*self.sy
+            var = (n*self.sxx - self.sx**2) * (n*self.syy - self.sy**2)
+            r2 = cov**2 / var
+        r2[(n < max(min_overlap, 2)) | ~(var > 0)] = np.nan
+        return np.minimum(r2, 1.0)
+
+    def to_frame(self, min_overlap=MIN_R2_OVERLAP):
+        """ R2 dataframe indexed by fund with one column per benchmark, like calc_all_fund_r2() """
+        return pd.DataFrame(self.r2(min_overlap), index=self.fundnos, columns=self.benchmarks)
+
+def benchmark_matrix(asset_returns):
+    """ (first_month, values, valid) of a list of monthly benchmark series (R+1) on their common month axis,
+    values as R and 0 where invalid """
+    months = [month_ordinals(s.index) for s in asset_returns]
+    first_month = min(m.min() for m in months)
+    last_month = max(m.max() for m in months)
+    values = np.zeros((len(asset_returns), last_month - first_month + 1))
+    valid = np.zeros(values.shape, dtype=bool)
+    for k, (series, m) in enumerate(zip(asset_returns, months)):
+        v = np.asarray(series, dtype=np.float64)
+        ok = ~np.isnan(v)
+        values[k, m[ok] - first_month] = v[ok] - 1
+        valid[k, m[ok] - first_month] = True
+    return first_month, values, valid
+
+def fund_digests(fund_returns, fundnos, first_month, last_month):
+    """ A checksum of the returns of each of the (sorted) fundnos from first_month to last_month, as uint64
+
+    Order-free sum of a hash of each (month, return) row, so any return added, removed or restated in 
+    those months changes the fund's checksum """
+    funds, months, values = fund_returns.take(fundnos)
+    keep = (months >= first_month) & (months <= last_month)
+    digest = np.zeros(len(fundnos), dtype=np.uint64)
+    if not keep.any():
+        return digest
+    rows = np.searchsorted(fundnos, funds[keep])
+    h = np.ascontiguousarray(values[keep], dtype=np.float64).view(np.uint64)
+    h = (h ^ (months[keep].astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15))) * np.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> np.uint64(31)
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    digest[rows[starts]] = np.add.reduceat(h, starts)
+    return digest
+
+def block_stats(fund_returns, fundnos, first_month, bench_values, bench_valid):
+    """ The R2Stats sums of one block of funds against all benchmarks, as a tuple of arrays in R2Stats.fields order """
+    last_month = first_month + bench_values.shape[1] - 1
+    matrix = pack_return_matrix(fund_returns, datetime_from_ordinal(first_month), datetime_from_ordinal(last_month), fundnos)
+    m = matrix.valid.astype(np.float64)
+    x = np.where(matrix.valid, matrix.returns - 1, 0.0)
+    bm = bench_valid.astype(np.float64)
+    return (np.dot(m, bm.T), np.dot(x, bm.T), np.dot(m, bench_values.T),
+            np.dot(x*x, bm.T), np.dot(m, (bench_values**2).T), np.dot(x, bench_values.T))
+
+def r2_stats(fund_returns, asset_returns, block_size=R2_BLOCK_SIZE, workers=1):
+    """ R2Stats of every fund of fund_returns (crsp pandas return object or ReturnsPanel) against the
+    asset_returns series, computed block_size funds at a time, over a pool of processes if workers > 1 """
+    if not isinstance(fund_returns, ReturnsPanel):
+        fund_returns = ReturnsPanel.from_frame(fund_returns)
+    fundnos = np.asarray(fund_returns.fundnos)
+    first_month, bench_values, bench_valid = benchmark_matrix(asset_returns)
+    log.info('Calculating R2 of %s funds against %s benchmarks', len(fundnos), len(asset_returns))
+    sums = pair_sums(fund_returns, fundnos, first_month, bench_values, bench_valid, block_size, workers)
+    digest = fund_digests(fund_returns, fundnos, first_month, first_month + bench_values.shape[1] - 1)
+    return R2Stats(fundnos, [s.name for s in asset_returns], first_month, bench_values, bench_valid, *sums, 
+                   fund_digest=digest)
+
+def refresh_r2_stats(stats, fund_returns, asset_returns, block_size=R2_BLOCK_SIZE, workers=1):
+    """ Brings R2Stats up to date with new data by only computing what changed
+
+    Funds that are new, or whose returns changed in months already folded in (months that arrived in a 
+    later load or restated returns, told by fund_digest), get their full sums.  The other funds already in 
+    stats only get the sums of the benchmark months added since, and funds no longer in fund_returns are 
+    dropped.  Benchmarks that changed in months already folded in or a different set of benchmarks 
+    trigger a full rebuild. """
+    if not isinstance(fund_returns, ReturnsPanel):
+        fund_returns = ReturnsPanel.from_frame(fund_returns)
+    first_month, bench_values, bench_valid = benchmark_matrix(asset_returns)
+    old_months = stats.bench_values.shape[1]
+    if getattr(stats, 'fund_digest', None) is None:
+        log.info('R2 stats without fund checksums, recalculating R2 for all funds')
+        return r2_stats(fund_returns, asset_returns, block_size, workers)
+    if [s.name for s in asset_returns] != stats.benchmarks or first_month != stats.first_month or \
+       bench_values.shape[1] < old_months or \
+       not np.array_equal(bench_valid[:, :old_months], stats.bench_valid) or \
+       not np.array_equal(bench_values[:, :old_months], stats.bench_values):
+        log.info('Benchmarks changed, recalculating R2 for all funds')
+        return r2_stats(fund_returns, asset_returns, block_size, workers)
+
+    fundnos = np.asarray(fund_returns.fundnos)
+    known = np.in1d(fundnos, stats.fundnos)
+    old_rows = np.searchsorted(stats.fundnos, fundnos[known])
+    changed = np.zeros(len(fundnos), dtype=bool)
+    changed[known] = fund_digests(fund_returns, fundnos[known], stats.first_month, stats.last_month) != \
+                     stats.fund_digest[old_rows]
+    known &= ~changed
+    old_rows = np.searchsorted(stats.fundnos, fundnos[known])
+    sums = [np.zeros((len(fundnos), len(stats.benchmarks))) for f in R2Stats.fields]
+    for total, old in zip(sums, stats.sums()):
+        total[known] = old[old_rows]
+
+    new_months = bench_values.shape[1] - old_months
+    log.info('Updating R2: %s new funds, %s funds with changed returns, %s new months for %s funds', 
+             (~known).sum() - changed.sum(), changed.sum(), new_months, known.sum())
+    if (~known).any():
+        for total, part in zip(sums, pair_sums(fund_returns, fundnos[~known], first_month, bench_values, bench_valid,
+                                               block_size, workers)):
+            total[~known] = part
+    if new_months and known.any():
+        for total, part in zip(sums, pair_sums(fund_returns, fundnos[known], stats.last_month + 1, 
+                                               bench_values[:, old_months:], bench_valid[:, old_months:], 
+                                               block_size, workers)):
+            total[known] += part
+    digest = fund_digests(fund_returns, fundnos, first_month, first_month + bench_values.shape[1] - 1)
+    return R2Stats(fundnos, stats.benchmarks, first_month, bench_values, bench_valid, *sums, fund_digest=digest)
+
+def pair_sums(fund_returns, fundnos, first_month, bench_values, bench_valid, block_size=R2_BLOCK_SIZE, workers=1):
+    """ The R2Stats sums of the given funds against benchmark months from first_month on, by blocks of funds """
+    blocks = [fundnos[start:start + block_size] for start in range(0, len(fundnos), block_size)]
+    if workers <= 1 or len(blocks) <= 1:
+        results = [block_stats(fund_returns, block, first_month, bench_values, bench_valid) for block in blocks]
+    else:
+        # the forked workers inherit the panel (memory maps once loaded, shared through the page cache), only
+        # the benchmarks are copied into shared memory
+        _worker['panel'] = fund_returns
+        try:
+            pool = Pool(workers, initializer=_attach_worker, 
+                        initargs=(share_arrays(dict(bench_values=bench_values, bench_valid=bench_valid)), first_month))
+            try:
+                results = pool.map(_run_block, blocks)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            _worker.clear()
+    k = bench_values.shape[0]
+    return [np.concatenate([r[f] for r in results]) if results else np.zeros((0, k)) for f in range(len(R2Stats.fields))]
+
+_worker = {}
+
+def _attach_worker(shared, first_month):
+    """ Pool initializer: the benchmarks as views onto the shared arrays (the panel is inherited) """
+    a = attach_arrays(shared)
+    _worker['bench'] = (first_month, a['bench_values'], a['bench_valid'])
+
+def _run_block(fundnos):
+    return block_stats(_worker['panel'], fundnos, *_worker['bench'])
@@ -0,0 +1,125 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Reporting ###
+### Charts of the trial results; matplotlib is only imported on first use, on the non-interactive Agg backend ###
+from __future__ import division
+import sys
+import numpy as np
+from run_metrics import phase
+from run_log import get_logger
+
+log = get_logger('reporting')
+
+# most steps drawn in a chart of sorted trials; more trials than this are drawn as a quantile profile
+CHART_POINTS = 2000
+
+def pyplot():
+    """ matplotlib.pyplot, imported on first use with the Agg backend (files only, no display needed) unless
+    pyplot was already imported with another """
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def save_scenario_charts(summary, start_date, end_date, name='figure', pf_name='', trials=100, min_fee_quantile=None,
+                         survivor_bias=False):
+    """ Graphs the return and sharpe ratio diffs of a run (see engine.run_scenario()) """
+    return_diffs = np.sort(summary['return_diffs'])
+    sharpe_diffs = np.sort(summary['sharpe_diffs'])
+    passive_win_perc = summary['passive_win_perc']
+
+    # Graphs
+    title = 'Active vs Index Portfolios from %s to %s\n(Indexing wins %s%% of the time)' % \
+        (str(int(start_date.strftime("%Y"))+1), end_date.strftime("%Y"), passive_win_perc)
+    if min_fee_quantile: title+='\nFilter by lowest %s fee quantile' % min_fee_quantile
+    
+    figname = name + '_figure_' + pf_name + '_' + start_date.strftime("%Y") + '-' + end_date.strftime("%Y") + '_' + \
+        str(trials) + \
+        ('_lowfee' if min_fee_quantile else '') + \
+        ('_biased' if survivor_bias else '') + \
+        '.png'
+    save_bar_chart(data = return_diffs, 
+                       ylabel = 'Return Difference in % (Active - Index)', 
+                       xlabel = 'Sorted Trials', 
+                       title = title, 
+                       ylimits = [-6,4],
+                       under_median = summary['under_median'], 
+                       over_median = summary['over_median'], 
+                       figname = figname 
+                       )    
+
+    # Graph sharpe diffs
+    title = 'Sharpe Ratio - Active vs Index Portfolios from %s to %s\n(Indexing wins on risk adjusted basis %s%% of the time)' % \
+        (str(int(start_date.strftime("%Y"))+1), end_date.strftime("%Y"), summary['sharpe_win_perc'])
+    if min_fee_quantile: title+='\nFilter by lowest %s fee quantile' % min_fee_quantile
+    
+    figname = name + '_sharpe_figure_' + pf_name + '_' + start_date.strftime("%Y") + '-' + end_date.strftime("%Y") + '_' + \
+        str(trials) + \
+        ('_lowfee' if min_fee_quantile else '') + \
+        ('_biased' if survivor_bias else '') + \
+        '.png'
+   
+    save_bar_chart(data = sharpe_diffs, 
+                   ylabel = 'Sharpe Difference in % (Active - Passive)', 
+                   xlabel = 'Sorted Trials', 
+                   title = title, 
+                   figname = figname
+                   )
+                   
+def save_bar_chart(data, ylabel, xlabel, title, figname, ylimits=None, under_median = None, over_median = None):
+    """ Saves a standard bar chart of sorted trials with the specified attributes and file name
+
+    The bars are drawn as one filled step curve (see quantile_profile()), so the time to draw the chart and the
+    size of the file don't grow with the number of trials """
+    with phase('save_bar_chart', trials=len(data)):
+        plt = pyplot()
+        fig = plt.figure()
+        ax = fig.add_subplot(111) # our standard type for this project
+        if len(data):
+            edges, values = quantile_profile(data)
+            ax.fill_between(np.repeat(edges, 2)[1:-1], np.repeat(values, 2), color='b', linewidth=0) #our standard settings
+            ax.set_xlim(0, len(data))
+        ax.set_ylabel(ylabel)
+        ax.set_xlabel(xlabel)
+        ax.set_title(title)
+        if ylimits:
+            plt.ylim(ylimits)
+        plt.subplots_adjust(top=0.86) #move the title up a bit
+    
+        if under_median:
+            ax.add_artist(anchored_text("Underperformers:\nmedian:%s%%" % (under_median.round(2)), loc=2, prop=dict(size=12)))   
+        if over_median: 
+            ax.add_artist(anchored_text("Outperformers:\nmedian:%s%%" % (over_median.round(2)), loc=4, prop=dict(size=12)))    
+    
+        log.info('Saving figure %s', figname)
+        plt.savefig(figname)
+        plt.close(fig)
+
+def quantile_profile(data, points=CHART_POINTS):
+    """ (edges, values) of the steps of a bar chart of sorted data: a step per trial up to points trials, above
+    that points equal steps of trials, each at the value of the trial in its middle (a quantile of the data) """
+    data = np.asarray(data, dtype=np.float64)
+    edges = np.linspace(0, len(data), min(len(data), points) + 1)
+    values = np.interp((edges[:-1] + edges[1:]) / 2 - 0.5, np.arange(len(data)), data)
+    return edges, values
+
+def anchored_text(text, loc, prop):
+    """ A text box anchored in a corner of the axes (imported here, as it loads pyplot) """
+    from mpl_toolkits.axes_grid.anchored_artists import AnchoredText
+    return AnchoredText(text, loc=loc, prop=prop)
@@ -0,0 +1,121 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Columnar returns store ###
+### Keeps the fund returns panel on disk as .npy columns (CSR layout) that are memory-mapped instead of unpickled ###
+import os, shutil
+import numpy as np
+from month_axis import * # pandas only where a pandas object is built, see month_axis.py
+
+class ReturnsPanel(object):
+    """ Monthly returns (R+1) of all funds in CSR layout
+
+    fundnos: sorted crsp_fundnos, offsets: the returns of fundnos[i] are rows offsets[i]:offsets[i+1]
+    months: int32 month ordinal of each row (date order within a fund), returns: float64 return of each row
+    bounds: int32 YYYYMMDD date of the first and last return of each fund (kept for get_fund_date_bounds())
+
+    Loaded with load() the columns are read-only memory maps, so startup does not read the panel and
+    concurrent engine processes share the pages through the OS page cache. """
+
+    columns = ['fundnos', 'offsets', 'months', 'returns', 'bounds']
+
+    def __init__(self, fundnos, offsets, months, returns, bounds):
+        self.fundnos = fundnos
+        self.offsets = offsets
+        self.months = months
+        self.returns = returns
+        self.bounds = bounds
+
+    @classmethod
+    def from_frame(cls, df):
+        """ Builds the panel from the crsp pandas return object of get_all_fund_returns() """
+        import pandas as pd
+        dates = pd.DatetimeIndex(df.index.get_level_values(1))
+        return cls.from_arrays(df.index.get_level_values(0), 
+                               np.asarray(dates.year)*10000 + np.asarray(dates.month)*100 + np.asarray(dates.day), 
+                               df['Return'])
+
+    @classmethod
+    def from_arrays(cls, fund_col, caldt, returns):
+        """ Builds the panel from one row per return: crsp_fundno, caldt as YYYYMMDD and return (R+1) """
+        fund_col = np.asarray(fund_col, dtype=np.int64)
+        caldt = np.asarray(caldt, dtype=np.int32)
+        order = np.lexsort((caldt, fund_col))
+        fund_col, caldt = fund_col[order], caldt[order]
+
+        fundnos, starts = np.unique(fund_col, return_index=True)
+        offsets = np.r_[starts, len(fund_col)].astype(np.int64)
+        bounds = np.column_stack((caldt[offsets[:-1]], caldt[offsets[1:]-1])).astype(np.int32)
+        months = ((caldt // 10000)*12 + (caldt // 100 % 100) - 1).astype(np.int32)
+        returns = np.asarray(returns, dtype=np.float64)[order]
+        return cls(fundnos, offsets, months, returns, bounds)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """ Opens a panel saved with save(), memory-mapped by default """
+        return cls(*[np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in cls.columns])
+
+    @staticmethod
+    def exists(path):
+        return all(os.path.isfile(os.path.join(path, name + '.npy')) for name in ReturnsPanel.columns)
+
+    def save(self, path):
+        """ Saves the columns as .npy files in the path directory
+
+        The files are written to a temporary directory that then replaces path, so processes opening the
+        panel never see a half-written one """
+        tmp_path = path.rstrip('/') + '.tmp%s' % os.getpid()
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name in self.columns:
+            np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(getattr(self, name)))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    def fund_list(self):
+        return list(self.fundnos)
+
+    def take(self, fundnos):
+        """ (fund, month, return) row arrays for the given crsp_fundnos, only touching their part of the panel """
+        pos = np.flatnonzero(np.in1d(self.fundnos, np.asarray(fundnos, dtype=np.int64)))
+        lengths = self.offsets[pos+1] - self.offsets[pos]
+        rows = np.repeat(self.offsets[pos] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return np.repeat(self.fundnos[pos], lengths), np.asarray(self.months[rows]), np.asarray(self.returns[rows])
+
+    def series(self, fundno):
+        """ Return series of one fund, indexed by calendar month end """
+        i = np.searchsorted(self.fundnos, fundno)
+        if i == len(self.fundnos) or self.fundnos[i] != fundno:
+            raise KeyError(fundno)
+        rows = slice(self.offsets[i], self.offsets[i+1])
+        import pandas as pd
+        return pd.Series(np.array(self.returns[rows]), index=month_end_dates(self.months[rows]), name='Return')
+
+    def date_bounds(self):
+        """ Same as get_fund_date_bounds() on the pandas return object: start_date/end_date by fund """
+        import pandas as pd
+        return pd.DataFrame({'start_date':dates_from_yyyymmdd(self.bounds[:,0]),
+                             'end_date':dates_from_yyyymmdd(self.bounds[:,1])},
+                            index=self.fundnos, columns=['start_date','end_date'])
+
+def fund_return_series(fund_returns, fundno):
+    """ Return series of one fund from either the pandas return object or a ReturnsPanel """
+    if isinstance(fund_returns, ReturnsPanel):
+        return fund_returns.series(fundno)
+    return fund_returns.ix[fundno]['Return']
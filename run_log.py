@@ -0,0 +1,100 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Run log ###
+### Leveled logging of a run, as plain text or as json lines for tools, and a progress line with throughput and ETA ###
+from __future__ import division
+import sys
+import json
+import logging
+from time import time as wall_time
+
+# every module logs under this logger, see get_logger()
+LOG_NAME = 'whitepaper'
+# nothing is shown until setup_logging() (python 2 would complain about a logger without handlers)
+logging.getLogger(LOG_NAME).addHandler(logging.NullHandler())
+
+def get_logger(name):
+    """ Logger of a module of the engine, under LOG_NAME """
+    return logging.getLogger(LOG_NAME + '.' + name)
+
+def fields(**values):
+    """ extra= of a logging call, to add named values to the record (json lines output includes them) """
+    return {'fields':values}
+
+class TextFormatter(logging.Formatter):
+    """ Info messages as they are, anything else prefixed by its level """
+
+    def format(self, record):
+        message = logging.Formatter.format(self, record)
+        return message if record.levelno == logging.INFO else '%s: %s' % (record.levelname, message)
+
+class JsonFormatter(logging.Formatter):
+    """ One json object per record: time, level, logger and message, plus any fields() """
+
+    def format(self, record):
+        entry = {'time':record.created, 'level':record.levelname, 'logger':record.name, 'message':record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, sort_keys=True, default=str)
+
+def setup_logging(level=logging.INFO, json_lines=False, stream=None):
+    """ Sends the engine's log at level and above to stream (stdout by default), as text or json lines """
+    logger = logging.getLogger(LOG_NAME)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter() if json_lines else TextFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+def format_duration(seconds):
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+class Progress(object):
+    """ Progress of a run of total items: rate and time left since it started at done items
+
+    due() says whether a progress line is worth logging now (every interval seconds, and at the end), so
+    the caller only works out what goes in the line when it is. """
+
+    def __init__(self, logger, total, done=0, interval=2.0, unit='trials'):
+        self.logger = logger
+        self.total = total
+        self.first = done
+        self.interval = interval
+        self.unit = unit
+        self.started = self.logged = wall_time()
+
+    def due(self, done):
+        return done >= self.total or wall_time() - self.logged >= self.interval
+
+    def report(self, done, message='', *args, **values):
+        """ Logs 'done of total unit, rate unit/s, ETA h:mm:ss' followed by message % args, with the numbers
+        and values as fields """
+        now = wall_time()
+        self.logged = now
+        rate = (done - self.first) / max(now - self.started, 1e-9)
+        eta = (self.total - done) / rate if rate else None
+        self.logger.info('%s of %s %s, %.0f %s/s, ETA %s' + message, done, self.total, self.unit, rate, self.unit, 
+                         format_duration(eta), *args, 
+                         extra=fields(done=done, total=self.total, rate=rate, eta_seconds=eta, **values))
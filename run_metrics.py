@@ -0,0 +1,262 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Run metrics ###
+### Phase timers, memory use and hot path counters of a run, written as a json metrics file and a Chrome trace timeline ###
+from __future__ import division
+import os
+import re
+import sys
+import json
+from time import time as wall_time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None # not on windows
+try:
+    import tracemalloc # python 3.4+, or the pytracemalloc backport on python 2
+except ImportError:
+    tracemalloc = None
+
+# counters reported per trial as well as in total
+trial_counters = ['draws', 'redraws', 'splices', 'short_funds', 'resamples']
+# allocators listed for each phase when tracing allocations
+TOP_ALLOCATORS = 10
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def rss_bytes():
+    """ Resident set size of this process (its peak where /proc isn't there to read) """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            return int(f.read().split()[1]) * PAGE_SIZE
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return peak_rss_bytes()
+
+def peak_rss_bytes():
+    """ Peak resident set size of this process, since the last reset_peak_rss() where that works """
+    try:
+        f = open('/proc/self/status')
+        try:
+            hwm = re.search(r'^VmHWM:\s*(\d+) kB', f.read(), re.M)
+        finally:
+            f.close()
+        if hwm:
+            return int(hwm.group(1)) * 1024
+    except (IOError, OSError):
+        pass
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # bytes on macs, kB elsewhere
+
+def reset_peak_rss():
+    """ Sets the peak of peak_rss_bytes() back to the current RSS, returns whether the OS allows it (Linux 4+) """
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        try:
+            f.write('5')
+        finally:
+            f.close()
+        return True
+    except (IOError, OSError):
+        return False
+
+def parse_bytes(text):
+    """ Bytes from a size like 512M, 4G or 1.5GB (powers of 1024), or a plain number of bytes """
+    match = re.match(r'^\s*([\d.]+)\s*([kmgt]?)i?b?\s*$', str(text), re.I)
+    if not match:
+        raise ValueError('Not a size: %s' % text)
+    return int(float(match.group(1)) * 1024**' kmgt'.index(match.group(2).lower() or ' '))
+
+def format_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1024:
+            return '%.1f%s' % (n, unit)
+        n /= 1024
+    return '%.1fTB' % n
+
+def budget_count(budget, item_bytes, default, used=None, minimum=1):
+    """ How many items of item_bytes each fit in what a memory budget (bytes) leaves after used bytes (the
+    current RSS by default): default without a budget, otherwise at most default and at least minimum """
+    if not budget:
+        return default
+    if used is None:
+        used = rss_bytes()
+    return int(max(minimum, min(default, (budget - used) // item_bytes)))
+
+class RunMetrics(object):
+    """ Named phase timings and counters of a run
+
+    phase() times a block of code; phases nest, and each one is kept with its start, duration and process so
+    the run can be drawn as a timeline, along with the RSS of the process at its end and the peak RSS while
+    it ran.  count() adds to a named counter and note() keeps a setting the run chose (e.g. a batch size).
+    All are cheap enough to leave on all the time, as phases are stages of a run and counters are added to
+    once per batch of trials.  Worker processes send their phases and counters back with their results, see
+    take() and merge().
+
+    The peak of a phase is exact where the OS lets the peak RSS be reset (Linux), elsewhere it is the peak
+    of the process so far.  With trace_allocations(), the top allocators of what each outer phase
+    allocated and kept are recorded too (needs tracemalloc, and slows the run down). """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = wall_time()
+        self.phases = [] # dicts of name, start (seconds from started), seconds, pid, depth and args
+        self.counters = {}
+        self.notes = {}
+        self.allocation_depth = 0 # phases shallower than this list their top allocators
+        self._depth = 0
+        self._peaks = [0] # peak RSS of each open phase so far, after the peak of the whole run
+
+    def trace_allocations(self, depth=2):
+        """ Starts tracing allocations for the phases nested less than depth deep, False without tracemalloc """
+        if tracemalloc is None:
+            return False
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.allocation_depth = depth
+        return True
+
+    @contextmanager
+    def phase(self, name, **args):
+        before = tracemalloc.take_snapshot() if self._depth < self.allocation_depth else None
+        # the peak so far belongs to the enclosing phase, then this phase's peak starts from here
+        self._peaks[-1] = max(self._peaks[-1], peak_rss_bytes())
+        reset_peak_rss()
+        self._peaks.append(rss_bytes())
+        start = wall_time()
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            peak = max(self._peaks.pop(), peak_rss_bytes())
+            self._peaks[-1] = max(self._peaks[-1], peak)
+            record = {'name':name, 'start':start - self.started, 'seconds':wall_time() - start, 'pid':os.getpid(), 
+                      'depth':self._depth, 'args':args, 'rss':rss_bytes(), 'peak_rss':peak}
+            if before is not None:
+                record['allocators'] = top_allocators(before)
+            self.phases.append(record)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def note(self, name, value):
+        self.notes[name] = value
+
+    def peak_rss(self):
+        """ Peak RSS of this process over the whole run """
+        return max(self._peaks[0], peak_rss_bytes())
+
+    def take(self):
+        """ (phases, counters) recorded since the last take(), which are cleared (the start time is kept) """
+        taken = self.phases, self.counters
+        self.phases, self.counters = [], {}
+        return taken
+
+    def merge(self, taken):
+        """ Adds the take() of another process (forked from this one, so sharing the start time) """
+        phases, counters = taken
+        self.phases.extend(phases)
+        for name, n in counters.items():
+            self.count(name, n)
+
+    def phase_totals(self):
+        """ {phase name: {'calls', 'seconds', 'peak_rss'}} over all the phases recorded """
+        totals = {}
+        for p in self.phases:
+            total = totals.setdefault(p['name'], {'calls':0, 'seconds':0.0, 'peak_rss':0})
+            total['calls'] += 1
+            total['seconds'] += p['seconds']
+            total['peak_rss'] = max(total['peak_rss'], p.get('peak_rss', 0))
+        return totals
+
+    def summary(self):
+        """ The metrics as a json-able dict: wall time, peak RSS, phase totals, counters, trial_counters per
+        trial, notes and the top allocators of the phases that traced them """
+        trials = self.counters.get('trials', 0)
+        return {'wall_seconds':wall_time() - self.started, 'peak_rss':self.peak_rss(), 'phases':self.phase_totals(),
+                'counters':dict(self.counters), 'notes':dict(self.notes),
+                'per_trial':dict((name, self.counters.get(name, 0) / trials) for name in trial_counters) if trials else {},
+                'allocators':[{'phase':p['name'], 'pid':p['pid'], 'top':p['allocators']}
+                              for p in self.phases if 'allocators' in p]}
+
+    def log_memory(self, logger):
+        """ Logs the peak RSS of each phase (in the order they started), the notes and the top allocators traced """
+        totals = self.phase_totals()
+        logger.info('Peak memory %s', format_bytes(self.peak_rss()), 
+                    extra={'fields':{'peak_rss':self.peak_rss(), 'notes':self.notes,
+                                     'phase_peak_rss':dict((name, t['peak_rss']) for name, t in totals.items())}})
+        first = {}
+        for p in self.phases:
+            first[p['name']] = min(first.get(p['name'], p['start']), p['start'])
+        for name in sorted(totals, key=first.get):
+            logger.info('  %-34s peak %10s', name, format_bytes(totals[name]['peak_rss']))
+        for name, value in sorted(self.notes.items()):
+            logger.info('  %-34s %s', name, value)
+        for p in self.phases:
+            if p.get('allocators'):
+                logger.info('Top allocations kept by %s', p['name'])
+                for a in p['allocators']:
+                    logger.info('  %10s %8s blocks  %s', format_bytes(a['size']), a['count'], a['where'])
+
+    def write_json(self, path, **info):
+        """ Writes summary() and any info (e.g. the run parameters) to a json file """
+        metrics = self.summary()
+        metrics.update(info)
+        f = open(path, 'w')
+        try:
+            json.dump(metrics, f, indent=2, sort_keys=True, default=str)
+        finally:
+            f.close()
+
+    def write_chrome_trace(self, path):
+        """ Writes the phases as a Chrome trace (open in chrome://tracing or Perfetto), one row per process """
+        events = [{'name':p['name'], 'ph':'X', 'ts':int(p['start']*1e6), 'dur':int(p['seconds']*1e6), 'pid':p['pid'],
+                   'tid':p['pid'], 'args':p['args']} for p in self.phases]
+        # memory as a counter track per process, at the end of each phase
+        events.extend({'name':'memory MB', 'ph':'C', 'ts':int((p['start'] + p['seconds'])*1e6), 'pid':p['pid'],
+                       'args':{'rss':p['rss'] / 1024**2, 'phase peak':p['peak_rss'] / 1024**2}}
+                      for p in self.phases if 'rss' in p)
+        events.append({'name':'counters', 'ph':'C', 'ts':int((wall_time() - self.started)*1e6), 'pid':os.getpid(),
+                       'args':self.counters})
+        f = open(path, 'w')
+        try:
+            json.dump({'traceEvents':events, 'displayTimeUnit':'ms'}, f, default=str)
+        finally:
+            f.close()
+
+def top_allocators(before, top=TOP_ALLOCATORS):
+    """ The source lines that allocated the most memory still held since the snapshot before, as dicts of
+    where, size (bytes) and count (blocks) """
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    after = tracemalloc.take_snapshot().filter_traces(ignore)
+    return [{'where':str(stat.traceback), 'size':stat.size_diff, 'count':stat.count_diff} 
+            for stat in after.compare_to(before.filter_traces(ignore), 'lineno')[:top] if stat.size_diff > 0]
+
+# the metrics of this process, with module level names for the methods used throughout the engine
+metrics = RunMetrics()
+phase = metrics.phase
+count = metrics.count
+note = metrics.note
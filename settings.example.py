@@ -1,5 +1,10 @@
 config = { "db_path": '/Users/You/crsp-whitepaper/newdb.db' ,
-           "index_path": '/Users/You/crsp-whitepaper/'
+           "index_path": '/Users/You/crsp-whitepaper/',
+           "cache_dir": '/Users/You/crsp-whitepaper/cache',  # cached returns, buckets, R2 (see cache_manager.py)
+           "cache_max_bytes": 8*1024**3,  # least recently used cache entries are removed beyond this size
+           "db_mmap_size": 2*1024**3,  # bytes of the database sqlite may memory-map
+           "db_cache_kb": 256*1024,  # sqlite page cache per connection
+           "memory_budget": None,  # bytes a run should stay under (trials run at once, read chunk sizes), None for no limit
         }           
 
 
@@ -0,0 +1,161 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Scenario sweep ###
+### Runs a grid of engine scenarios on one loaded universe, across a pool of processes, into one results table ###
+import os
+import json
+import itertools
+import argparse
+from datetime import date
+from multiprocessing import Pool, cpu_count
+from time import time as wall_time # engine exports datetime's time
+import numpy as np
+import pandas as pd
+from engine import *
+import portfolios
+
+log = get_logger('sweep')
+
+# grid keys, with the engine.py argument defaults
+sweep_defaults = {'portfolio':'portfolio_1', 'start_year':1996, 'end_year':2012, 'start_month':12, 'end_month':12,
+                  'fee_quantile':None, 'picks':1, 'addbias':False, 'fee_at_replacement':False,
+                  'bucketing':'crsp_style', 'trials':100, 'seed':None}
+# results table columns, after the grid keys
+result_columns = ['comp_pf_return', 'comp_pf_sharpe', 'passive_win_perc', 'sharpe_win_perc', 'under_median',
+                  'over_median', 'under_stdev', 'over_stdev', 'rank_error', 'seconds', 'error']
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a grid of engine scenarios.')
+    parser.add_argument('grid', help='grid spec file (json), see expand_grid()')
+    parser.add_argument('--output', default='sweep_results.csv', help='results table (csv)')
+    parser.add_argument('--workers', type=int, default=cpu_count(), help='number of processes to run scenarios on')
+    parser.add_argument('--charts', default=None, metavar='DIR', 
+                        help="draw each scenario's return and sharpe ratio graphs into this directory")
+    parser.add_argument('--quiet', action='store_true', help='only log warnings and errors')
+    parser.add_argument('--log_json', action='store_true', help='log json lines instead of text')
+    args = parser.parse_args()
+    setup_logging(logging.WARNING if args.quiet else logging.INFO, args.log_json)
+
+    f = open(args.grid)
+    try:
+        spec = json.load(f)
+    finally:
+        f.close()
+    results = run_sweep(expand_grid(spec), workers=args.workers, chart_dir=args.charts)
+    results.to_csv(args.output, index=False)
+    log.info('Wrote %s scenario results to %s', len(results), args.output)
+
+def expand_grid(spec):
+    """ Scenarios of a grid spec: a dict of the sweep_defaults keys, each a single value or a list of values to
+    sweep over.  Every combination of the listed values is a scenario, e.g.
+
+        {"portfolio": ["portfolio_1", "portfolio_2"], "start_year": [1996, 2001], "fee_quantile": [null, 0.5],
+         "trials": 1000, "seed": 42}
+
+    is 8 scenarios of 1000 trials.  A fixed seed gives every scenario the same random streams """
+    unknown = set(spec.keys()).difference(sweep_defaults.keys())
+    if unknown:
+        raise ValueError('Unknown grid keys: %s' % ', '.join(sorted(unknown)))
+    keys = sorted(sweep_defaults.keys())
+    values = []
+    for key in keys:
+        value = spec.get(key, sweep_defaults[key])
+        values.append(value if isinstance(value, list) else [value])
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+def run_sweep(scenarios, workers=1, chart_dir=None):
+    """ Runs the scenarios (as from expand_grid()) and returns a dataframe with one row per scenario
+
+    The universe (returns, buckets, fund lists, fees, benchmarks) is loaded once here; the pool of workers is
+    started after that, so each worker inherits it instead of loading its own.  Scenarios without a seed
+    get one drawn here, so every row records the seed to rerun it with.  A scenario that fails has its error in
+    the table instead of stopping the sweep.  With chart_dir, each worker also draws the graphs of the scenarios
+    it ran there (see reporting.py), named scenario<number>_... so the charts are drawn in parallel too """
+    scenarios = [dict(s) for s in scenarios]
+    for s in scenarios:
+        if s['seed'] is None:
+            s['seed'] = np.random.randint(2**31-1)
+    log.info('Loading the universe for %s scenarios', len(scenarios))
+    universe = Universe(get_fund_returns_panel())
+    universe.preload(bucketing_types=set(s['bucketing'] for s in scenarios),
+                     survivor_bias=any(s['addbias'] for s in scenarios),
+                     fees=any(s['fee_quantile'] for s in scenarios))
+    _sweep['universe'] = universe
+    _sweep['chart_dir'] = chart_dir
+    if chart_dir and not os.path.isdir(chart_dir):
+        os.makedirs(chart_dir)
+
+    jobs = list(enumerate(scenarios))
+    if workers <= 1 or len(jobs) <= 1:
+        rows = map(run_sweep_scenario, jobs)
+    else:
+        pool = Pool(min(workers, len(jobs)))
+        try:
+            rows = []
+            for row in pool.imap_unordered(run_sweep_scenario, jobs):
+                rows.append(row)
+                log.info('Finished scenario %s (%s of %s)', row['scenario'], len(rows), len(jobs), 
+                         extra=fields(scenario=row['scenario'], seconds=row['seconds'], error=row.get('error')))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    rows.sort(key=lambda row: row['scenario'])
+    return pd.DataFrame(rows, columns=['scenario'] + sorted(sweep_defaults.keys()) + result_columns)
+
+def grid_portfolio(name):
+    """ The portfolio definition of a grid's portfolio name (see portfolios.py) """
+    port_def = getattr(portfolios, str(name), None)
+    if not isinstance(port_def, dict):
+        raise ValueError('Unknown portfolio: %s' % name)
+    return port_def
+
+_sweep = {}
+
+def run_sweep_scenario(job):
+    """ Runs one scenario on the shared universe, returns its results table row """
+    i, s = job
+    row = dict(s)
+    row['scenario'] = i
+    started = wall_time()
+    chart_dir = _sweep.get('chart_dir')
+    try:
+        # same horizon dates as engine.py's main()
+        start_date, end_date = date(s['start_year'], s['start_month'], 25), date(s['end_year'], s['end_month'], 31)
+        summary = engine(grid_portfolio(s['portfolio']), _sweep['universe'].returns, start_date, end_date,
+                         bucketing_type=s['bucketing'], min_fee_quantile=s['fee_quantile'], survivor_bias=s['addbias'],
+                         trials=s['trials'], pf_name=s['portfolio'], active_picks=s['picks'], seed=s['seed'],
+                         fee_at_replacement=s['fee_at_replacement'], universe=_sweep['universe'],
+                         outputs=False, keep_diffs=bool(chart_dir))
+        if summary is None:
+            row['error'] = 'Invalid portfolio'
+        else:
+            row.update((c, summary[c]) for c in result_columns if c in summary)
+            if chart_dir:
+                import reporting
+                with phase('save_scenario_charts'):
+                    reporting.save_scenario_charts(summary, start_date, end_date, os.path.join(chart_dir, 'scenario%s' % i),
+                                                   s['portfolio'], s['trials'], s['fee_quantile'], s['addbias'])
+    except Exception, e:
+        log.exception('Scenario %s failed', i)
+        row['error'] = '%s: %s' % (type(e).__name__, e)
+    row['seconds'] = round(wall_time() - started, 3)
+    return row
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Synthetic CRSP database ###
+### Writes a made-up CRSP database and benchmark files with the real schema, to run and time the engine without CRSP ###
+from __future__ import division
+import os
+import time
+import argparse
+from itertools import izip
+import sqlite3 as lite
+import numpy as np
+from month_axis import *
+from metamappings import asset_classes, asset_class_bmks, benchmark_source
+from crsp_import import schema_part1, parse_schema, load_pragmas, indexes, build_eligibility
+
+# style code, share of portfolios (%), name, asset class whose returns its funds follow.  The codes of
+# crsp_style_mapping come first, then some it leaves out (sector, high yield, state munis, mixed...)
+style_codes = [('EDCL', 11, 'Large Cap', 'US_LargeCap'), ('EDYB', 4, 'Blend', 'US_LargeCap'),
+               ('EDYG', 8, 'Growth', 'US_LargeCap'), ('EDYI', 4, 'Equity Income', 'US_LargeCap'),
+               ('EDCM', 6, 'Mid Cap', 'US_MidCap'), ('EDCS', 6, 'Small Cap', 'US_SmallCap'),
+               ('EDCI', 1, 'Micro Cap', 'US_SmallCap'), ('EFRM', 3, 'Emerging Markets', 'Intl_Emerging'),
+               ('EFCL', 5, 'International Equity', 'Intl_Developed'), ('EF', 2, 'Foreign', 'Intl_TotalMarket'),
+               ('EFYG', 1, 'International Growth', 'Intl_Developed'), ('EFYT', 1, 'Global ex-US', 'Intl_TotalMarket'),
+               ('ICQH', 4, 'High Quality Bond', 'US_Bond_Total'), ('ICDS', 2, 'Short Duration Bond', 'US_Bond_Total'),
+               ('ICDI', 3, 'Intermediate Bond', 'US_Bond_Total'), ('ICQM', 2, 'Corporate Bond', 'US_Bond_Total'),
+               ('IGDI', 2, 'Intermediate Government', 'US_Bond_Total'), ('IGDS', 2, 'Short-Term Treasury', 'US_Treas_1-3'),
+               ('EDSR', 2, 'Real Estate', 'REIT'), ('IGT', 1, 'Inflation-Protected Securities', 'TIPS'),
+               ('IUI', 4, 'Intermediate Tax-Exempt', 'MUNI'), ('IUH', 2, 'High Yield Municipal', 'MUNI'),
+               ('EDSI', 4, 'Technology', 'US_LargeCap'), ('EFCS', 1, 'International Small Cap', 'Intl_Developed'),
+               ('ICQY', 3, 'High Yield', 'US_Bond_Total'), ('IUS', 3, 'California Municipal', 'MUNI'),
+               ('MTAG', 5, 'Balanced', 'US_TotalMarket'), ('OMAC', 1, 'Alternative Strategies', 'US_Bond_Total')]
+
+# monthly mean return, beta to a shock common to all equity markets, own volatility of each asset class
+factor_params = {'US_LargeCap':(0.0080, 1.0, 0.012), 'US_MidCap':(0.0088, 1.1, 0.020),
+                 'US_SmallCap':(0.0095, 1.2, 0.030), 'US_TotalMarket':(0.0082, 1.0, 0.010),
+                 'Intl_Emerging':(0.0090, 1.1, 0.050), 'Intl_Developed':(0.0060, 0.9, 0.030),
+                 'Intl_TotalMarket':(0.0065, 0.95, 0.028), 'US_Bond_Total':(0.0050, 0.05, 0.011),
+                 'US_Treas_1-3':(0.0040, 0.0, 0.005), 'US_Treas_Short':(0.0038, 0.0, 0.004),
+                 'REIT':(0.0090, 0.9, 0.045), 'TIPS':(0.0045, 0.05, 0.015), 'MUNI':(0.0042, 0.03, 0.012)}
+equity_shock_vol = 0.04
+
+# first year of each benchmark file (later benchmarks are spliced onto earlier ones, see asset_class_bmks)
+benchmark_first_years = {'Russell1000':1979, 'Russell2000':1979, 'Russell3000':1979, 'MSCI_EM':1988, 'MSCI_EAFE':1970,
+                         'MSCI_ACWI_ex-US':1988, 'Barclay_Agg':1976, 'Barclay_1-3Gov':1976, 'MSCI_REIT':1995,
+                         'NAREIT':1972, 'VWIUX':2001, 'TIPS':2004, 'Morn_Midcap':1992, 'BarclayMuni5yr4-6':1990,
+                         'FedFunds':1954, 'TBill-1mo':1926}
+
+# portfolio kinds (share of portfolios) that the exclusion rules and index fund filters have to catch
+portfolio_kinds = [('active', 0.80), ('index', 0.06), ('variable_annuity', 0.04), ('target_date', 0.03),
+                   ('insurer', 0.03), ('529_plan', 0.02), ('long_short', 0.02)]
+insurers = ['Pacific Life', 'MassMutual Select', 'Transamerica Series']
+
+# share classes: name, old style name suffix, institutional, retail, 12b-1 fee
+share_classes = [('Investor Shares', 'Inv', 'N', 'Y', 0.0), ('Class A Shares', 'A', 'N', 'Y', 0.0025),
+                 ('Class C Shares', 'C', 'N', 'Y', 0.01), ('Class B Shares', 'B', 'N', 'Y', 0.01),
+                 ('Institutional Class', 'Inst', 'Y', 'N', 0.0), ('Admiral Shares', 'Adm', 'N', 'Y', 0.0),
+                 ('Y Shares', 'Y', 'Y', 'N', 0.0), ('R Shares', 'R', 'N', 'N', 0.005)]
+# share of portfolios with 1, 2, ... share classes
+classes_per_portfolio = [0.45, 0.15, 0.15, 0.12, 0.08, 0.05]
+
+family_words = ['Acorn', 'Birch', 'Cedar', 'Dogwood', 'Elm', 'Fir', 'Granite', 'Hawthorn', 'Ironwood', 'Juniper',
+                'Keystone', 'Larch', 'Maple', 'Northgate', 'Oakmont', 'Pinecrest', 'Quarry', 'Redwood', 'Summit',
+                'Timber', 'Upland', 'Valley', 'Willow', 'Yarrow', 'Zephyr']
+family_types = ['Funds', 'Investors', 'Capital', 'Trust', 'Advisors', 'Select', 'Street', 'Partners']
+manager_names = ['Smith/Jones', 'Team Managed', 'Garcia', 'Chen/Patel', 'Miller', 'Okafor/Ruiz', 'Nguyen', 'Kowalski']
+
+# CRSP starts assigning portfolio numbers and class groups with the 1999 data
+portno_first_year = 1999
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes a synthetic CRSP database and benchmark files.')
+    parser.add_argument('db_path', help='sqlite database to create')
+    parser.add_argument('index_dir', help='directory to write the benchmark files to')
+    parser.add_argument('--funds', type=int, default=5000, help='number of funds (share classes)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed, the same seed gives the same database')
+    parser.add_argument('--first_year', type=int, default=1962, help='first year of returns')
+    parser.add_argument('--last_year', type=int, default=2012, help='last year of returns')
+    parser.add_argument('--overwrite', action='store_true', help='replace db_path if it exists')
+    args = parser.parse_args()
+
+    if os.path.exists(args.db_path):
+        if not args.overwrite:
+            print args.db_path, 'already exists, use --overwrite to replace it'
+            return
+        os.remove(args.db_path)
+    generate(args.db_path, args.index_dir, funds=args.funds, seed=args.seed, first_year=args.first_year,
+             last_year=args.last_year)
+
+def generate(db_path, index_dir, funds=5000, seed=0, first_year=1962, last_year=2012, chunk_portfolios=2000):
+    """ Writes a database of made-up funds to db_path (a new file) and the benchmark_source files to index_dir
+
+    Funds are share classes of portfolios that open over the years (more of them every year), live on average
+    about 14 years and die or survive to the end.  A portfolio's returns follow the asset class of its style
+    code (a factor model with a shock common to all equity markets) with its own alpha, beta and tracking
+    error, and its share classes differ by their fees.  The benchmark files follow the same asset class
+    returns.  Names, flags and groups are such that every exclusion rule and the unique fund logic have funds
+    to act on.  Tables are loaded the way crsp_import.py does, ending with the indexes and FUND_ELIGIBILITY.
+    Returns the row count of each table written """
+    rng = np.random.RandomState(seed)
+    first_month, last_month = first_year*12, last_year*12 + 11
+    n_months = last_month - first_month + 1
+    factors, factor_names = factor_returns(rng, n_months)
+    portfolios = draw_portfolios(rng, funds, first_month, last_month, factor_names)
+    classes = draw_share_classes(rng, portfolios, last_month)
+    write_benchmark_files(rng, index_dir, factors, factor_names, first_month, first_year)
+
+    con = lite.connect(db_path, isolation_level=None)
+    counts = {}
+    try:
+        con.executescript(load_pragmas)
+        con.execute("begin;")
+        for table, create, filename in parse_schema(schema_part1):
+            con.execute(create)
+        start = time.time()
+        counts['FUND_HDR'] = insert_rows(con, 'FUND_HDR', fund_hdr_columns(rng, portfolios, classes))
+        for table in ['FUND_STYLE', 'FUND_FEES', 'MONTHLY_RETURNS', 'MONTHLY_TNA']:
+            counts[table] = 0
+        for a in range(0, len(portfolios['start']), chunk_portfolios):
+            b = min(a + chunk_portfolios, len(portfolios['start']))
+            chunk = np.arange(classes['offsets'][a], classes['offsets'][b])
+            counts['FUND_STYLE'] += insert_rows(con, 'FUND_STYLE', fund_style_columns(rng, portfolios, classes, chunk))
+            counts['FUND_FEES'] += insert_rows(con, 'FUND_FEES', fund_fees_columns(rng, classes, chunk))
+            returns, tna = monthly_columns(rng, portfolios, classes, chunk, a, b, factors, first_month)
+            counts['MONTHLY_RETURNS'] += insert_rows(con, 'MONTHLY_RETURNS', returns)
+            counts['MONTHLY_TNA'] += insert_rows(con, 'MONTHLY_TNA', tna)
+            print 'Wrote %s of %s funds (%.1fs)' % (chunk[-1] + 1, len(classes['portfolio']), time.time() - start)
+        print 'Creating indexes'
+        for table, sql in indexes:
+            con.execute(sql)
+        con.execute("commit;")
+        print 'Analyzing'
+        con.execute("ANALYZE;")
+    finally:
+        con.close()
+    build_eligibility(db_path)
+    return counts
+
+def insert_rows(con, table, columns):
+    """ Inserts the rows of a list of (column name, values) into table, returns the number of rows """
+    names = [name for name, values in columns]
+    values = [v.tolist() if isinstance(v, np.ndarray) else v for name, v in columns]
+    con.executemany("insert into %s (%s) values (%s);" % (table, ', '.join(names), ','.join(['?']*len(names))),
+                    izip(*values))
+    return len(values[0])
+
+### Dates ###
+
+def business_month_ends(ordinals):
+    """ Last weekday of each month ordinal as YYYYMMDD, the date CRSP puts monthly data on """
+    ends = month_end_yyyymmdd(ordinals)
+    weekday = (days_from_civil(ends // 10000, ends // 100 % 100, ends % 100) + 3) % 7 # 0 is Monday
+    return ends - np.maximum(weekday - 4, 0)
+
+def month_start_yyyymmdd(ordinals):
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    return (ordinals // 12)*10000 + (ordinals % 12 + 1)*100 + 1
+
+def group_ranges(starts, counts):
+    """ (group, value) of every value of the ranges starts[i] .. starts[i]+counts[i]-1, concatenated """
+    groups = np.repeat(np.arange(len(counts)), counts)
+    firsts = np.r_[0, np.cumsum(counts)[:-1]]
+    return groups, np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(firsts, counts)
+
+### Returns ###
+
+def factor_returns(rng, n_months):
+    """ Monthly returns (R, months x asset classes) of every asset class, and the asset class names """
+    names = [a for a in asset_classes if a in factor_params]
+    mean, beta, vol = [np.array([factor_params[a][i] for a in names]) for i in range(3)]
+    shock = rng.normal(0, equity_shock_vol, n_months)
+    return mean + shock[:, None]*beta + rng.normal(0, 1, (n_months, len(names)))*vol, names
+
+def rate_returns(rng, n_months, spread=0.0):
+    """ Monthly returns of a short term rate wandering between 0.05% and 14% a year """
+    annual = np.clip(0.04 + np.cumsum(rng.normal(0, 0.003, n_months)), 0.0005, 0.14)
+    return (annual + spread) / 12
+
+def write_benchmark_files(rng, index_dir, factors, factor_names, first_month, first_year):
+    """ Writes every benchmark_source file (tab separated, Return in %, month end dates as d-Mon-yyyy) from
+    the returns of the asset class it is the first benchmark of, plus some tracking noise """
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    followed = {}
+    for position in range(max(len(b) for b in asset_class_bmks.values())):
+        for asset_class in asset_classes:
+            if position < len(asset_class_bmks[asset_class]):
+                followed.setdefault(asset_class_bmks[asset_class][position], asset_class)
+    n_months = len(factors)
+    month_names = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+    tbill = rate_returns(rng, n_months)
+    for name in sorted(benchmark_source.keys()):
+        if name in followed:
+            returns = factors[:, factor_names.index(followed[name])] + rng.normal(0, 0.001, n_months)
+        else:
+            returns = tbill + (0.0002 if name == 'FedFunds' else 0)
+        first = max(benchmark_first_years.get(name, first_year), first_year)*12 - first_month
+        ends = month_end_yyyymmdd(np.arange(first_month + first, first_month + n_months))
+        f = open(os.path.join(index_dir, benchmark_source[name]), 'w')
+        try:
+            f.write('Return\n')
+            for end, r in izip(ends.tolist(), returns[first:].tolist()):
+                f.write('%d-%s-%d\t%.4f\n' % (end % 100, month_names[end // 100 % 100 - 1], end // 10000, r*100))
+        finally:
+            f.close()
+
+### Funds ###
+
+def draw_portfolios(rng, funds, first_month, last_month, factor_names):
+    """ The portfolios of the funds: lifetimes, style, kind, family, returns model and number of share classes """
+    n_classes = rng.choice(np.arange(1, len(classes_per_portfolio) + 1), size=funds, p=classes_per_portfolio)
+    # enough portfolios for the fund count, the last one trimmed to fit
+    n = np.searchsorted(np.cumsum(n_classes), funds) + 1
+    n_classes = n_classes[:n]
+    n_classes[-1] -= n_classes.sum() - funds
+
+    # openings grow over the years, and a few portfolios are already open in the first month
+    n_months = last_month - first_month + 1
+    weights = np.exp(4.0 * np.arange(n_months) / n_months)
+    weights[0] += 0.03 * weights.sum()
+    start = first_month + rng.choice(n_months, size=n, p=weights / weights.sum())
+    end = start + 6 + rng.geometric(1 / 168.0, size=n)
+    end = np.minimum(end, last_month)
+
+    style_p = np.array([s[1] for s in style_codes], dtype=np.float64)
+    style = rng.choice(len(style_codes), size=n, p=style_p / style_p.sum())
+    kind = rng.choice(len(portfolio_kinds), size=n, p=[k[1] for k in portfolio_kinds])
+    kind_names = np.array([k[0] for k in portfolio_kinds])[kind]
+    index = kind_names == 'index'
+    return {'n_classes':n_classes, 'start':start, 'end':end, 'style':style, 'kind':kind_names,
+            'factor':np.array([factor_names.index(style_codes[s][3]) for s in style]),
+            'family':rng.randint(len(family_words) * len(family_types), size=n),
+            'alpha':np.where(index, 0.0, rng.normal(-0.0005, 0.001, n)),
+            'beta':np.where(index, 1.0, rng.normal(1.0, 0.12, n)),
+            'tracking':np.where(index, 0.03, rng.uniform(0.1, 0.45, n)),
+            'fee':np.where(index, 0.0025, 0.011) * np.exp(rng.normal(0, 0.35, n)),
+            'has_portno':end >= portno_first_year*12,
+            'has_cl_grp':(end >= portno_first_year*12) & (n_classes > 1) & (rng.rand(n) < 0.8)}
+
+def draw_share_classes(rng, portfolios, last_month):
+    """ The share classes (funds) of the portfolios: share class, lifetime and fees """
+    n_classes = portfolios['n_classes']
+    portfolio, k = group_ranges(np.zeros(len(n_classes), dtype=np.int64), n_classes)
+    # the first class is the investor or A shares, the others differ within a portfolio
+    first_label = rng.randint(2, size=len(n_classes))
+    other_offset = rng.randint(len(share_classes) - 1, size=len(n_classes))
+    label = np.where(k == 0, first_label[portfolio], 1 + (other_offset[portfolio] + k - 1) % (len(share_classes) - 1))
+    label = np.where((k > 0) & (label == first_label[portfolio]), 0, label) # the other one of Investor/A
+
+    start, end = portfolios['start'][portfolio], portfolios['end'][portfolio]
+    # later classes are added over the years, and some are closed before the portfolio is
+    start = np.where(k == 0, start, np.minimum(start + rng.geometric(1 / 36.0, size=len(k)) - 1, end))
+    closed = (k > 0) & (rng.rand(len(k)) < 0.1)
+    end = np.where(closed, np.minimum(end, start + rng.geometric(1 / 60.0, size=len(k))), end)
+
+    b12 = np.array([c[4] for c in share_classes])[label]
+    institutional = np.array([c[2] for c in share_classes])[label] == 'Y'
+    fee = np.maximum(portfolios['fee'][portfolio] + b12 - np.where(institutional, 0.003, 0), 0.0005)
+    return {'portfolio':portfolio, 'k':k, 'label':label, 'start':start, 'end':end, 'fee':fee, 'b12':b12,
+            'fee_drift':rng.uniform(0.97, 1.01, len(k)), 'dead':end < last_month,
+            'offsets':np.r_[0, np.cumsum(n_classes)]}
+
+def fund_names(portfolios, classes):
+    """ Fund names in the CRSP form: "Trust: Fund; Share Class", or "Fund/Class" for the older funds """
+    names = []
+    for i, p in enumerate(classes['portfolio'].tolist()):
+        family = '%s %s' % (family_words[portfolios['family'][p] % len(family_words)],
+                            family_types[portfolios['family'][p] // len(family_words)])
+        kind = portfolios['kind'][p]
+        descriptor = style_codes[portfolios['style'][p]][2]
+        if kind == 'insurer':
+            family = insurers[p % len(insurers)]
+        if kind == 'index':
+            descriptor += ' Index'
+        elif kind == 'target_date':
+            descriptor = 'Target %d' % (2010 + 5*(p % 11))
+        elif kind == '529_plan':
+            descriptor = '529 ' + descriptor
+        elif kind == 'long_short':
+            descriptor += ' 130/30'
+        name = '%s Series Trust %d: %s %s Fund' % (family, p + 1, family, descriptor)
+        if kind == 'variable_annuity':
+            name = '%s Variable Insurance Trust %d: %s Portfolio' % (family, p + 1, descriptor)
+        if portfolios['n_classes'][p] > 1:
+            label = share_classes[classes['label'][i]]
+            name += '; ' + label[0] if portfolios['has_portno'][p] else '/' + label[1]
+        names.append(name)
+    return names
+
+def random_codes(rng, n, length, letters='ABCDEFGHIJKLMNOPQRSTUVWXYZ'):
+    chars = np.array(list(letters))[rng.randint(len(letters), size=(n, length))]
+    return [''.join(c) for c in chars]
+
+def fund_hdr_columns(rng, portfolios, classes):
+    p = classes['portfolio']
+    n = len(p)
+    kind = portfolios['kind'][p]
+    label = classes['label']
+    dead = classes['dead']
+    families = ['%s %s' % (family_words[f % len(family_words)], family_types[f // len(family_words)])
+                for f in portfolios['family'][p].tolist()]
+    index_flag = np.where(kind == 'index', np.where(rng.rand(n) < 0.8, 'D', 'B'), '')
+    return [('crsp_fundno', np.arange(1, n + 1)),
+            ('crsp_portno', [1000001 + x if has else '' for x, has in izip(p.tolist(), portfolios['has_portno'][p])]),
+            ('crsp_cl_grp', [2000001 + x if has else '' for x, has in izip(p.tolist(), portfolios['has_cl_grp'][p])]),
+            ('fund_name', fund_names(portfolios, classes)),
+            ('nasdaq', [code + 'X' if retail else '' for code, retail in
+                        izip(random_codes(rng, n, 4), np.array([c[3] for c in share_classes])[label] == 'Y')]),
+            ('ncusip', random_codes(rng, n, 9, '0123456789ABCDEFGHJKLMNPRSTUVWXYZ')),
+            ('first_offer_dt', month_start_yyyymmdd(classes['start'] - 1)),
+            ('mgmt_name', [f + ' Management' for f in families]),
+            ('mgmt_cd', [f[:2].upper() + f.split()[1][:2].upper() for f in families]),
+            ('mgr_name', [manager_names[x] for x in rng.randint(len(manager_names), size=n)]),
+            ('mgr_dt', month_start_yyyymmdd(classes['start'] + rng.randint(0, 60, n))),
+            ('adv_name', [f + ' Advisors' for f in families]),
+            ('open_to_inv', np.where(dead, 'N', 'Y')),
+            ('retail_fund', np.array([c[3] for c in share_classes])[label]),
+            ('inst_fund', np.array([c[2] for c in share_classes])[label]),
+            ('m_fund', np.array(['N'] * n)),
+            ('index_fund_flag', index_flag),
+            ('vau_fund', np.where(kind == 'variable_annuity', 'Y', 'N')),
+            ('et_flag', np.array([''] * n)),
+            ('end_dt', business_month_ends(classes['end'])),
+            ('dead_flag', np.where(dead, 'Y', 'N')),
+            ('delist_cd', np.where(dead, np.where(rng.rand(n) < 0.5, 'M', 'L'), '')),
+            ('merge_fundno', [''] * n)]
+
+def fund_style_columns(rng, portfolios, classes, chunk):
+    """ Style history of the funds in chunk: one record per fund, or two if the style changed (from a blank
+    code, for some).  The latest style is the portfolio's """
+    p = classes['portfolio'][chunk]
+    start, end = classes['start'][chunk], classes['end'][chunk]
+    code = np.array([style_codes[s][0] for s in portfolios['style'][p]])
+    changed = (rng.rand(len(chunk)) < 0.15) & (end - start > 24)
+    middle = start + (end - start) // 2
+    old_code = np.array([s[0] for s in style_codes])[rng.randint(len(style_codes), size=len(chunk))]
+    old_code = np.where(rng.rand(len(chunk)) < 0.3, '', old_code)
+    fundno = chunk + 1
+    return [('crsp_fundno', np.r_[fundno[changed], fundno]),
+            ('begdt', business_month_ends(np.r_[start[changed], np.where(changed, middle, start)])),
+            ('enddt', business_month_ends(np.r_[middle[changed] - 1, end])),
+            ('crsp_obj_cd', np.r_[old_code[changed], code])]
+
+def fund_fees_columns(rng, classes, chunk):
+    """ One fee record per fund and calendar year it was open, the expense ratio drifting over the years """
+    start, end = classes['start'][chunk], classes['end'][chunk]
+    first_year, last_year = start // 12, end // 12
+    i, year = group_ranges(first_year, last_year - first_year + 1)
+    exp_ratio = np.round(classes['fee'][chunk][i] * classes['fee_drift'][chunk][i] ** (year - first_year[i]), 4)
+    exp_ratio[rng.rand(len(i)) < 0.005] = -99.0
+    b12 = classes['b12'][chunk][i]
+    return [('crsp_fundno', chunk[i] + 1),
+            ('begdt', month_start_yyyymmdd(np.maximum(year*12, start[i]))),
+            ('enddt', business_month_ends(np.minimum(year*12 + 11, end[i]))),
+            ('actual_12b1', b12), ('max_12b1', b12),
+            ('exp_ratio', exp_ratio),
+            ('mgmt_fee', np.round(np.maximum(exp_ratio, 0) * 0.6, 4)),
+            ('turn_ratio', np.round(rng.lognormal(-0.5, 0.7, len(i)), 2)),
+            ('fiscal_yearend', year*10000 + 1231)]
+
+def monthly_columns(rng, portfolios, classes, chunk, a, b, factors, first_month):
+    """ MONTHLY_RETURNS and MONTHLY_TNA columns of the funds in chunk, the share classes of portfolios a..b-1
+
+    Returns are the portfolio's after fees; some are missing (-99), the first month of a fund often.  Net
+    assets grow with the returns and random flows """
+    ports = np.arange(a, b)
+    vol = np.sqrt((factors.var(axis=0)))
+    gross = (portfolios['alpha'][ports, None] + portfolios['beta'][ports, None] * factors[:, portfolios['factor'][ports]].T
+             + rng.normal(0, 1, (len(ports), len(factors))) * (portfolios['tracking'][ports] * vol[portfolios['factor'][ports]])[:, None])
+    start, end = classes['start'][chunk], classes['end'][chunk]
+    counts = end - start + 1
+    i, month = group_ranges(start, counts)
+    years = month // 12 - start[i] // 12
+    fee = classes['fee'][chunk][i] * classes['fee_drift'][chunk][i] ** years
+    mret = np.round(gross[classes['portfolio'][chunk][i] - a, month - first_month] - fee / 12, 6)
+
+    firsts = np.r_[0, np.cumsum(counts)[:-1]]
+    log_growth = np.log1p(np.maximum(mret, -0.9)) + rng.normal(0.002, 0.02, len(i))
+    log_tna = np.cumsum(log_growth)
+    log_tna -= np.repeat(log_tna[firsts] - log_growth[firsts], counts)
+    mtna = np.round(np.exp(np.minimum(rng.normal(3, 2, len(chunk))[i] + log_tna, 13)), 1)
+
+    missing = rng.rand(len(i)) < 0.002
+    missing[firsts[rng.rand(len(chunk)) < 0.3]] = True
+    mret[missing] = -99.0
+    mtna[rng.rand(len(i)) < 0.01] = -99.0
+    caldt = business_month_ends(month)
+    fundno = chunk[i] + 1
+    return ([('crsp_fundno', fundno), ('caldt', caldt), ('mret', mret)],
+            [('crsp_fundno', fundno), ('caldt', caldt), ('mtna', mtna)])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Test helpers ###
+### Puts the engine modules on the path and builds small random return matrices and scenarios to test against ###
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from fund_timeline import OpenFundTimeline
+from trial_engine import ReturnMatrix, trial_slots
+
+# two asset classes, one with two picks, to cover weights and slot classes
+test_portfolio = {'US_TotalMarket':{'alloc':0.6, 'funds':['US_TotalMarket']},
+                  'US_Bond_Total':{'alloc':0.4, 'funds':['US_Bond_Total']}}
+
+def random_matrix(rng, funds=60, months=48, first_month=2000*12):
+    """ A ReturnMatrix of funds that start and end at random months (some open over the whole horizon, so every
+    month has open funds), with a few missing returns inside their lives """
+    starts = rng.randint(0, months // 2, funds)
+    ends = rng.randint(months // 2, months, funds)
+    starts[:4], ends[:4] = 0, months - 1
+    month = np.arange(months)
+    valid = (month >= starts[:,None]) & (month <= ends[:,None]) & (rng.random_sample((funds, months)) > 0.02)
+    returns = np.where(valid, 1 + rng.normal(0.006, 0.04, (funds, months)), np.nan)
+    fundnos = np.arange(funds, dtype=np.int64) * 7 + 1000
+    return ReturnMatrix(fundnos, first_month, returns, valid, valid.sum(axis=1))
+
+def random_scenario(seed=0, funds=60, months=48, active_picks=2):
+    """ (matrix, slots, riskfree) of test_portfolio over a random matrix, the funds split between the asset classes """
+    rng = np.random.RandomState(seed)
+    matrix = random_matrix(rng, funds, months)
+    timelines = {}
+    for c, asset_class in enumerate(sorted(test_portfolio.keys())):
+        rows = np.arange(c, funds, 2)
+        valid_months = [np.flatnonzero(matrix.valid[row]) for row in rows]
+        timelines[asset_class] = OpenFundTimeline.from_bounds(
+            matrix.fundnos[rows], [matrix.first_month + m[0] for m in valid_months], 
+            [matrix.first_month + m[-1] for m in valid_months], matrix.first_month, matrix.first_month + months - 1)
+    slots = trial_slots(test_portfolio, timelines, matrix, active_picks)
+    riskfree = 1 + np.abs(rng.normal(0.002, 0.001, months))
+    riskfree[:3] = np.nan # the risk-free series can start after the horizon does
+    return matrix, slots, riskfree
+
+def synthetic_database(directory, funds=300, seed=0, first_year=2004, last_year=2012):
+    """ Path of a small synthetic CRSP database (see synthetic_crsp.py) written to directory, with its
+    benchmark files in directory/indexes """
+    from synthetic_crsp import generate
+    db_path = os.path.join(directory, 'crsp.db')
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w') # progress lines
+    try:
+        generate(db_path, os.path.join(directory, 'indexes'), funds=funds, seed=seed, first_year=first_year, 
+                 last_year=last_year)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return db_path
+
+_engine_database = []
+
+def engine_database(funds=600, seed=0, first_year=1990, last_year=2012):
+    """ Path of the synthetic database the engine modules read in the tests (db_path of tests/settings.py, 
+    benchmark files in index_path), written once per test run """
+    from settings import config
+    if not _engine_database:
+        directory = os.path.dirname(config['db_path'])
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        _engine_database.append(synthetic_database(directory, funds, seed, first_year, last_year))
+    return _engine_database[0]
+
+class TempDir(object):
+    """ Mixin for test cases: self.tmp is a new directory for each test, removed after it """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='whitepaper-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
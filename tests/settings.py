@@ -0,0 +1,27 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Test settings ###
+### Used by the tests when there is no settings.py next to the engine; the tests make their own databases ###
+import os
+import tempfile
+
+config = { "db_path": os.path.join(tempfile.gettempdir(), 'whitepaper-test', 'crsp.db'),
+           "index_path": os.path.join(tempfile.gettempdir(), 'whitepaper-test', 'indexes') + os.sep,
+           "cache_dir": os.path.join(tempfile.gettempdir(), 'whitepaper-test', 'cache'),
+           "memory_budget": None,
+        }
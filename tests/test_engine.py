@@ -0,0 +1,94 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+
+### Engine tests ###
+### Smoke tests of whole runs against the synthetic database the tests configure the engine with ###
+import sys
+import unittest
+from StringIO import StringIO
+from datetime import date
+import numpy as np
+from helpers import *
+
+benchmark_horizon = (date(1996, 12, 25), date(2012, 12, 31))
+
+class EngineSmokeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        engine_database()
+        import engine
+        cls.engine = engine
+        cls.universe = engine.Universe(engine.get_fund_returns_panel())
+
+    def test_unique_funds_are_fund_numbers(self):
+        unique = list(self.universe.unique_funds())
+        self.assertTrue(all(isinstance(f, (int, long, np.integer)) for f in unique))
+        self.assertTrue(len(set(unique).intersection(int(f) for f in self.universe.returns.fundnos)) > 0)
+
+    def test_scenario_runs(self):
+        from benchmark_suite import benchmark_portfolio
+        scenario = self.engine.prepare_scenario(benchmark_portfolio, self.universe, *benchmark_horizon, export=False)
+        for asset_class in benchmark_portfolio:
+            self.assertTrue(len(scenario.fund_lists[asset_class]) > 0, asset_class)
+        summary = self.engine.run_scenario(scenario, 300, seed=3, batch_size=100, keep_diffs=True)
+        self.assertEqual(summary['trials'], 300)
+        self.assertEqual(len(summary['return_diffs']), 300)
+        self.assertFalse(np.isnan(summary['return_diffs']).any())
+
+class HorizonGridTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        engine_database()
+        import engine
+        cls.engine = engine
+        cls.universe = engine.Universe(engine.get_fund_returns_panel())
+
+    def test_one_horizon_is_the_scenario(self):
+        from benchmark_suite import benchmark_portfolio
+        scenario = self.engine.prepare_scenario(benchmark_portfolio, self.universe, *benchmark_horizon, export=False)
+        summary = self.engine.run_scenario(scenario, 300, seed=3, batch_size=100, keep_diffs=False)
+        grid = self.engine.run_horizon_grid(benchmark_portfolio, None, [benchmark_horizon], trials=300, seed=3, 
+                                            batch_size=100, universe=self.universe, outputs=False)
+        self.assertEqual(len(grid), 1)
+        row = grid.ix[0]
+        self.assertEqual(row['comp_pf_return'], scenario.comp_pf_return)
+        self.assertEqual(row['passive_win_perc'], summary['passive_win_perc'])
+        # the grid's returns come from cumulative log returns, the scenario's from cumulative products
+        for key in ['under_median', 'over_median', 'under_stdev', 'over_stdev']:
+            if np.isnan(summary[key]):
+                self.assertTrue(np.isnan(row[key]), key)
+            else:
+                self.assertAlmostEqual(row[key], summary[key], places=9)
+
+    def test_grid_rejects_single_run_options(self):
+        for option in [['--results', 'r.bin'], ['--resume'], ['--trial_log', 't.jsonl'], ['--profile_trials'], ['--no_plot']]:
+            for grid in [['--start_years', '1996', '1998'], ['--windows', '5']]:
+                argv, stderr = sys.argv, sys.stderr
+                sys.argv, sys.stderr = ['engine.py'] + grid + option, StringIO()
+                try:
+                    with self.assertRaises(SystemExit) as exit:
+                        self.engine.main()
+                    self.assertEqual(exit.exception.code, 2)
+                    self.assertIn(option[0] + ' cannot be used with a horizon grid', sys.stderr.getvalue())
+                finally:
+                    sys.argv, sys.stderr = argv, stderr
+
+if __name__ == '__main__':
+    unittest.main()
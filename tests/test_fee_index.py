@@ -0,0 +1,69 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+
+### Fee index tests ###
+### A fund's fee at a date comes from the record covering that date, never from a later one ###
+import unittest
+import numpy as np
+from helpers import *
+from fee_index import FeeIndex, fee_quantile_mask
+
+rows = [(1, 20050101, 20051230, 0.010),  # ends on the last business day of 2005
+        (1, 20060101, 20061231, 0.012),
+        (1, 20080101, None, 0.009),      # open-ended, after a gap in 2007
+        (2, 20060301, 20060630, 0.020),
+        (2, 20060701, 20061231, -99.0),  # missing code
+        (3, None, 20061231, 0.005)]      # no begin date
+
+class FeeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fees = FeeIndex.from_rows(rows)
+
+    def assertFees(self, fees, expected):
+        self.assertTrue(np.array_equal(np.isnan(fees), np.isnan(expected)), (fees, expected))
+        self.assertTrue(np.allclose(fees[~np.isnan(fees)], np.asarray(expected)[~np.isnan(expected)]))
+
+    def test_dates_inside_records(self):
+        self.assertFees(self.fees.as_of([1, 1, 1, 1, 2], [20050101, 20050615, 20060101, 20081031, 20060630]),
+                        [0.010, 0.010, 0.012, 0.009, 0.020])
+
+    def test_end_date_covers_its_month(self):
+        self.assertFees(self.fees.as_of([1], 20051231), [0.010])
+
+    def test_no_fee_outside_records(self):
+        # before the first record (no look-ahead), in a gap, after the last record, after a -99 record's start
+        self.assertFees(self.fees.as_of([1, 1, 2, 2, 2], [20041231, 20070630, 20060228, 20060731, 20070131]),
+                        [np.nan]*5)
+
+    def test_funds_without_fee_data(self):
+        self.assertFees(self.fees.as_of([3, 4], 20060630), [np.nan, np.nan])
+        self.assertFees(FeeIndex.from_rows([]).as_of([1], 20060630), [np.nan])
+
+    def test_latest(self):
+        self.assertFees(self.fees.latest([2, 1, 3]), [0.020, 0.009, np.nan])
+
+    def test_quantile_leaves_out_missing_fees(self):
+        keep, quantile = fee_quantile_mask(np.array([0.01, np.nan, 0.02, 0.03, np.nan]), 0.5)
+        self.assertEqual(quantile, 0.02)
+        self.assertEqual(list(keep), [True, False, True, False, False])
+        keep, quantile = fee_quantile_mask(np.array([np.nan, np.nan]), 0.5)
+        self.assertFalse(keep.any())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+
+### Fund bucket tests ###
+### Bucketing by style straight from get_fund_styles() ###
+import os
+import shutil
+import tempfile
+import unittest
+from helpers import *
+from metamappings import asset_classes, crsp_style_mapping
+from crsp_data_wrappers import CrspDatabase
+from cache_manager import ArtifactCache
+from fund_buckets import bucket_by_style
+
+class BucketByStyleTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp(prefix='whitepaper-test-')
+        cls.db = CrspDatabase(synthetic_database(cls.data_dir), ArtifactCache(os.path.join(cls.data_dir, 'cache')))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+
+    def test_fund_styles_index_is_flat(self):
+        fund_styles = self.db.get_fund_styles()
+        self.assertEqual(fund_styles.index.nlevels, 1)
+        self.assertEqual(list(fund_styles.index), sorted(set(fund_styles.index)))
+
+    def test_buckets_match_the_mapping(self):
+        fund_styles = self.db.get_fund_styles()
+        # every other styled fund plus funds that have no style
+        fundnos = list(fund_styles.index[::2]) + [max(fund_styles.index) + 1, max(fund_styles.index) + 2]
+        buckets = bucket_by_style(fundnos, fund_styles.index, fund_styles['StyleCode'], 
+                                  crsp_style_mapping, asset_classes)
+        styles = dict(zip(fund_styles.index, fund_styles['StyleCode']))
+        for asset_class in asset_classes:
+            expected = sorted(f for f in fundnos if styles.get(f) in crsp_style_mapping[asset_class])
+            self.assertEqual(list(buckets.funds(asset_class)), expected)
+
+if __name__ == '__main__':
+    unittest.main()
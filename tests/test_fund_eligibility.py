@@ -0,0 +1,125 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Fund eligibility tests ###
+### FUND_ELIGIBILITY is built by the importer in one transaction and only ever read by the engine ###
+import os
+import shutil
+import tempfile
+import unittest
+import sqlite3 as lite
+from helpers import *
+import fund_eligibility
+from fund_eligibility import build_fund_eligibility, fund_eligibility_current, exclusion_bits
+from crsp_data_wrappers import CrspDatabase
+from cache_manager import ArtifactCache, file_fingerprint
+
+class FundEligibilityTest(TempDir, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp(prefix='whitepaper-test-')
+        cls.loaded = synthetic_database(cls.data_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir, ignore_errors=True)
+
+    def setUp(self):
+        TempDir.setUp(self)
+        self.db_path = os.path.join(self.tmp, 'crsp.db')
+        shutil.copy(self.loaded, self.db_path)
+
+    def database(self):
+        return CrspDatabase(self.db_path, ArtifactCache(os.path.join(self.tmp, 'cache')))
+
+    def edit_fund_hdr(self):
+        """ Marks the first eligible fund non-retail, returns its crsp_fundno """
+        con = lite.connect(self.db_path)
+        try:
+            fundno = con.execute("select min(crsp_fundno) from FUND_ELIGIBILITY where active_ok = 1;").fetchone()[0]
+            con.execute("update FUND_HDR set retail_fund = 'N' where crsp_fundno = ?;", (fundno,))
+            con.commit()
+        finally:
+            con.close()
+        return fundno
+
+    def test_classified_by_the_import(self):
+        db = self.database()
+        self.assertTrue(db.fund_eligibility_current())
+        db.check_fund_eligibility()
+        self.assertTrue(len(db.get_unique_funds_from_groups()) > 0)
+
+    def test_engine_stops_on_a_stale_table_without_writing(self):
+        fundno = self.edit_fund_hdr()
+        before = file_fingerprint(self.db_path)
+        db = self.database()
+        self.assertRaises(RuntimeError, db.check_fund_eligibility)
+        self.assertRaises(RuntimeError, db.get_all_fund_returns)
+        db.close()
+        self.assertEqual(file_fingerprint(self.db_path), before)
+
+        build_fund_eligibility(self.db_path)
+        db = self.database()
+        db.check_fund_eligibility()
+        self.assertIn('non_retail', db.get_exclusion_reasons([fundno])[fundno])
+
+    def test_stale_after_any_rule_column_edit(self):
+        # (edit, rows it changes)
+        edits = [("update FUND_HDR set inst_fund = null where crsp_fundno = (select min(crsp_fundno) from FUND_HDR);", 1),
+                 # swap the flags of a retail and a non-retail fund, the counts stay the same
+                 ("""update FUND_HDR set retail_fund = case retail_fund when 'Y' then 'N' else 'Y' end where crsp_fundno in 
+                    ((select min(crsp_fundno) from FUND_HDR where retail_fund = 'Y'), 
+                     (select min(crsp_fundno) from FUND_HDR where retail_fund = 'N'));""", 2),
+                 # rename to a name of the same length
+                 ("""update FUND_HDR set fund_name = substr(fund_name, 2) || substr(fund_name, 1, 1) 
+                    where crsp_fundno = (select min(crsp_fundno) from FUND_HDR);""", 1)]
+        for edit, rows in edits:
+            shutil.copy(self.loaded, self.db_path)
+            con = lite.connect(self.db_path)
+            try:
+                self.assertTrue(fund_eligibility_current(con))
+                self.assertEqual(con.execute(edit).rowcount, rows)
+                con.commit()
+                self.assertFalse(fund_eligibility_current(con), edit)
+            finally:
+                con.close()
+
+    def test_connections_are_read_only(self):
+        con = self.database().connection()
+        self.assertRaises(lite.OperationalError, con.execute, "create table T (a INTEGER);")
+        self.assertRaises(lite.OperationalError, con.execute, "delete from FUND_ELIGIBILITY;")
+
+    def test_failed_rebuild_leaves_the_old_table(self):
+        con = lite.connect(self.db_path)
+        rows = con.execute("select * from FUND_ELIGIBILITY order by crsp_fundno;").fetchall()
+        con.close()
+        rules = fund_eligibility.exclusion_rules
+        fund_eligibility.exclusion_rules = rules + [('index_fund', 'no_such_column = 1')]
+        try:
+            self.assertRaises(lite.OperationalError, build_fund_eligibility, self.db_path)
+        finally:
+            fund_eligibility.exclusion_rules = rules
+        con = lite.connect(self.db_path)
+        try:
+            self.assertTrue(fund_eligibility_current(con))
+            self.assertEqual(con.execute("select * from FUND_ELIGIBILITY order by crsp_fundno;").fetchall(), rows)
+        finally:
+            con.close()
+
+if __name__ == '__main__':
+    unittest.main()
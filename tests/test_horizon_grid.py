@@ -0,0 +1,60 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Horizon grid tests ###
+### Month windows of the horizons and their returns from the cumulative log returns ###
+from __future__ import division
+import unittest
+from datetime import date
+import numpy as np
+from helpers import *
+from horizon_grid import *
+from month_axis import month_ordinal
+
+class HorizonWindowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.first_month = month_ordinal(date(1999, 12, 31))
+
+    def test_windows(self):
+        horizons = [(date(1999, 12, 25), date(2003, 12, 31)), (date(2000, 12, 25), date(2002, 6, 30))]
+        np.testing.assert_array_equal(horizon_windows(horizons, self.first_month, 49), [[0, 48], [12, 30]])
+        self.assertEqual(horizon_windows([], self.first_month).shape, (0, 2))
+
+    def test_horizons_outside_the_span(self):
+        for horizon in [(date(1998, 12, 25), date(2002, 12, 31)), # starts before the trials
+                        (date(2000, 12, 25), date(2004, 1, 31)), # ends after them
+                        (date(2002, 12, 25), date(2001, 12, 31))]: # ends before it starts
+            self.assertRaises(ValueError, horizon_windows, [horizon], self.first_month, 49)
+        # without the axis length only the start is checked
+        self.assertEqual(horizon_windows([(date(2000, 12, 25), date(2004, 1, 31))], self.first_month)[0, 1], 49)
+
+    def test_overlapping_windows(self):
+        rng = np.random.RandomState(6)
+        returns = 1 + rng.normal(0.005, 0.04, size=(20, 3, 48))
+        weights = np.array([0.5, 0.3, 0.2])
+        windows = np.array([[0, 47], [12, 35], [0, 23], [12, 47], [20, 20]])
+        prefix = prefix_log_returns(returns)
+        together = window_returns(prefix, weights, windows)
+        for w, (first, last) in enumerate(windows):
+            growth = returns[:, :, first:last+1].prod(axis=-1)
+            expected = ((growth * weights).sum(axis=1) / weights.sum()) ** (12 / (last - first + 2))
+            np.testing.assert_allclose(together[:, w], expected, rtol=1e-12)
+            np.testing.assert_array_equal(together[:, w], window_returns(prefix, weights, windows[w:w+1])[:, 0])
+
+if __name__ == '__main__':
+    unittest.main()
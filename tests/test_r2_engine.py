@@ -0,0 +1,99 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+
+### R2 engine tests ###
+### Refreshing R2 stats with a later data load gives the same sums as building them from scratch ###
+import os
+import unittest
+import numpy as np
+import pandas as pd
+from helpers import *
+from month_axis import month_end_dates, month_end_yyyymmdd
+from returns_store import ReturnsPanel
+import r2_engine
+from r2_engine import r2_stats, refresh_r2_stats
+
+def matrix_panel(matrix, keep):
+    """ ReturnsPanel of the cells of a ReturnMatrix where keep is True """
+    rows, cols = np.nonzero(matrix.valid & keep)
+    return ReturnsPanel.from_arrays(matrix.fundnos[rows], month_end_yyyymmdd(matrix.first_month + cols),
+                                    matrix.returns[rows, cols])
+
+def benchmarks(rng, first_month, months, count=3):
+    return [pd.Series(1 + rng.normal(0.005, 0.03, months), index=month_end_dates(first_month + np.arange(months)),
+                      name='bench%s' % k) for k in range(count)]
+
+class RefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.matrix = random_matrix(rng, funds=40, months=60)
+        self.bench = benchmarks(rng, self.matrix.first_month, 60)
+        funds, months = self.matrix.returns.shape
+        # the earlier load: benchmarks up to month 40, funds 0-4 not in it yet, a few fund months that only
+        # arrive with the later load (inside the months already folded in) and funds 30-31 that are dropped
+        self.old_keep = (np.arange(months) < 40) & (rng.random_sample((funds, months)) > 0.05)
+        self.old_keep[:5] = False
+        self.new_keep = np.ones((funds, months), dtype=bool)
+        self.new_keep[30:32] = False
+        self.old_bench = [s[:40] for s in self.bench]
+
+    def assertSameStats(self, stats, expected):
+        self.assertTrue(np.array_equal(stats.fundnos, expected.fundnos))
+        self.assertEqual(stats.benchmarks, expected.benchmarks)
+        for got, want in zip(stats.sums(), expected.sums()):
+            self.assertTrue(np.allclose(got, want, rtol=1e-10, atol=1e-12))
+        self.assertTrue(np.array_equal(stats.fund_digest, expected.fund_digest))
+        r2, want = stats.r2(), expected.r2()
+        self.assertTrue(np.array_equal(np.isnan(r2), np.isnan(want)))
+        self.assertTrue(np.allclose(r2[~np.isnan(r2)], want[~np.isnan(want)], rtol=1e-9))
+
+    def test_refresh_matches_a_full_rebuild(self):
+        old = r2_stats(matrix_panel(self.matrix, self.old_keep), self.old_bench)
+        panel = matrix_panel(self.matrix, self.new_keep)
+        self.assertSameStats(refresh_r2_stats(old, panel, self.bench), r2_stats(panel, self.bench))
+
+    def test_restated_returns_are_picked_up(self):
+        old = r2_stats(matrix_panel(self.matrix, self.new_keep), self.old_bench)
+        rows = np.flatnonzero(self.matrix.valid[7, :40])
+        self.matrix.returns[7, rows[:2]] += 0.01
+        panel = matrix_panel(self.matrix, self.new_keep)
+        self.assertSameStats(refresh_r2_stats(old, panel, self.bench), r2_stats(panel, self.bench))
+
+    def test_refresh_without_changes(self):
+        panel = matrix_panel(self.matrix, self.new_keep)
+        stats = r2_stats(panel, self.bench)
+        self.assertSameStats(refresh_r2_stats(stats, panel, self.bench), stats)
+
+class WorkersTest(TempDir, unittest.TestCase):
+
+    def test_same_stats_with_workers(self):
+        rng = np.random.RandomState(4)
+        matrix = random_matrix(rng, funds=40, months=60)
+        bench = benchmarks(rng, matrix.first_month, 60)
+        path = os.path.join(self.tmp, 'panel')
+        matrix_panel(matrix, np.ones(matrix.returns.shape, dtype=bool)).save(path)
+        panel = ReturnsPanel.load(path) # memory-mapped, as the engine loads it
+        expected = r2_stats(panel, bench, block_size=7)
+        stats = r2_stats(panel, bench, block_size=7, workers=3)
+        for got, want in zip(stats.sums(), expected.sums()):
+            np.testing.assert_array_equal(got, want)
+        self.assertFalse(r2_engine._worker)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+
+### Sweep tests ###
+### Grid expansion, and failing scenarios ending up in the error column rather than stopping the sweep ###
+import unittest
+from helpers import *
+
+class ExpandGridTest(unittest.TestCase):
+
+    def test_combinations_and_defaults(self):
+        from sweep import expand_grid, sweep_defaults
+        scenarios = expand_grid({'portfolio':['portfolio_1', 'portfolio_2'], 'start_year':[1996, 2001, 2006], 
+                                 'seed':42})
+        self.assertEqual(len(scenarios), 6)
+        self.assertEqual(sorted(set((s['portfolio'], s['start_year']) for s in scenarios)),
+                         [(p, y) for p in ['portfolio_1', 'portfolio_2'] for y in [1996, 2001, 2006]])
+        for s in scenarios:
+            self.assertEqual(s['seed'], 42)
+            self.assertEqual(s['trials'], sweep_defaults['trials'])
+        self.assertEqual(expand_grid({}), [sweep_defaults])
+
+    def test_unknown_keys(self):
+        from sweep import expand_grid
+        self.assertRaises(ValueError, expand_grid, {'portfolios':'portfolio_1'})
+
+class RunSweepTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        engine_database()
+        import portfolios
+        from benchmark_suite import benchmark_portfolio
+        portfolios.test_benchmark_portfolio = benchmark_portfolio # benchmark files only, no CRSP fund numbers
+
+    @classmethod
+    def tearDownClass(cls):
+        import portfolios
+        del portfolios.test_benchmark_portfolio
+
+    def sweep(self, workers):
+        from sweep import expand_grid, run_sweep
+        # the data ends in 2012, so the comparison portfolio of a horizon to 2015 can't be calculated
+        scenarios = expand_grid({'portfolio':['test_benchmark_portfolio', 'no_such_portfolio', '__name__'],
+                                 'end_year':[2012, 2015], 'trials':200, 'seed':5})
+        return run_sweep(scenarios, workers=workers).set_index(['portfolio', 'end_year'])
+
+    def test_errors_are_recorded(self):
+        results = self.sweep(workers=1)
+        self.assertEqual(len(results), 6)
+        ok = results.ix[('test_benchmark_portfolio', 2012)]
+        self.assertTrue(ok['error'] is None or ok['error'] != ok['error']) # None or NaN
+        self.assertTrue(0 <= ok['passive_win_perc'] <= 100)
+        self.assertIn('Not enough portfolio returns', results.ix[('test_benchmark_portfolio', 2015)]['error'])
+        for name in ['no_such_portfolio', '__name__']:
+            for year in [2012, 2015]:
+                self.assertIn('Unknown portfolio', results.ix[(name, year)]['error'])
+
+    def test_same_results_with_workers(self):
+        serial, parallel = self.sweep(workers=1), self.sweep(workers=3)
+        columns = [c for c in serial.columns if c != 'seconds']
+        self.assertEqual(serial[columns].fillna('-').values.tolist(), parallel[columns].fillna('-').values.tolist())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Trial engine tests ###
+### The batched trial arithmetic against the pandas arithmetic of the one-trial-at-a-time engine it replaced ###
+from __future__ import division
+import math
+import unittest
+import numpy as np
+import pandas as pd
+from helpers import *
+from trial_engine import *
+
+def pandas_trial_stats(slot_returns, weights, riskfree):
+    """ (trial_return, excess_return, stddev) of one trial the way the old engine computed them: a column per
+    slot of its weight followed by its monthly returns, portfolio value from the cumulative products """
+    n_months = slot_returns.shape[1]
+    index = pd.date_range('1999-12-31', periods=n_months+1, freq='M')
+    return_df = pd.DataFrame(dict((str(s), np.r_[weights[s], slot_returns[s]]) for s in range(len(weights))), 
+                             index=index)
+    pf_values = return_df.cumprod().sum(axis=1)
+    pf_returns = pf_values / pf_values.shift(1)
+    trial_return = np.prod(pf_returns)**(12/len(pf_returns))
+    pf_excess_returns = pf_returns.sub(pd.Series(riskfree, index=index[1:]) - 1).dropna()
+    excess_return = np.prod(pf_excess_returns)**(12/len(pf_excess_returns))
+    return trial_return, excess_return, pf_excess_returns.std() * math.sqrt(12)
+
+class TrialStatsTest(unittest.TestCase):
+
+    def test_matches_pandas_arithmetic(self):
+        matrix, slots, riskfree = random_scenario(seed=1)
+        combined, picks = draw_trial_batch(matrix, slots, 25, np.random.RandomState(3))
+        weights = slots[1]
+        trial_returns, excess_returns, stddevs, sharpes = trial_stats(combined, weights, riskfree)
+        for trial in range(len(combined)):
+            expected = pandas_trial_stats(combined[trial], weights, riskfree)
+            np.testing.assert_allclose([trial_returns[trial], excess_returns[trial], stddevs[trial]], expected, 
+                                       rtol=1e-12)
+            self.assertAlmostEqual(sharpes[trial], (expected[1] - 1) / expected[2], places=10)
+
+class DrawTest(unittest.TestCase):
+
+    def test_slots_are_spliced_from_open_funds(self):
+        matrix, slots, riskfree = random_scenario(seed=2)
+        names, weights, slot_class, offsets, members = slots
+        size = 40
+        combined, picks = draw_trial_batch(matrix, slots, size, np.random.RandomState(5))
+        self.assertFalse(np.isnan(combined).any())
+        # replay the splices: each pick fills the months still missing from its fund's returns
+        replay = np.empty_like(combined)
+        replay.fill(np.nan)
+        for trial_idx, slot_idx, rows in picks:
+            for trial, slot, row in zip(trial_idx, slot_idx, rows):
+                missing = np.isnan(replay[trial, slot])
+                month = np.argmax(missing)
+                key = slot_class[slot] * matrix.months + month
+                self.assertIn(row, members[offsets[key]:offsets[key+1]]) # open when drawn
+                fill = missing & matrix.valid[row]
+                self.assertTrue(fill.any())
+                replay[trial, slot][fill] = matrix.returns[row][fill]
+        np.testing.assert_array_equal(replay, combined)
+
+def run_all(matrix, slots, riskfree, trials, seed, batch_size, workers=1, **kwargs):
+    """ The run_trials() results of all the trials, each result concatenated over the batches """
+    batches = [batch for start, batch in run_trials(matrix, slots, riskfree, trials, seed, batch_size, workers, **kwargs)]
+    return [np.concatenate([b[i] for b in batches]) for i in range(len(batches[0]) - 1)]
+
+class WorkersTest(unittest.TestCase):
+
+    def test_same_trials_for_any_worker_count(self):
+        matrix, slots, riskfree = random_scenario(seed=4)
+        expected = run_all(matrix, slots, riskfree, 230, 11, 50)
+        for workers in [2, 3]:
+            for a, b in zip(expected, run_all(matrix, slots, riskfree, 230, 11, 50, workers)):
+                np.testing.assert_array_equal(a, b)
+
+    def test_same_trials_run_a_part_of_a_batch_at_a_time(self):
+        matrix, slots, riskfree = random_scenario(seed=4)
+        expected = run_all(matrix, slots, riskfree, 230, 11, 50)
+        windows = np.array([[0, 47], [12, 47], [0, 23]])
+        expected_windows = run_all(matrix, slots, riskfree, 230, 11, 50, windows=windows)
+        for workers, sub_batch in [(1, 1), (1, 16), (3, 7)]:
+            for a, b in zip(expected, run_all(matrix, slots, riskfree, 230, 11, 50, workers, sub_batch=sub_batch)):
+                np.testing.assert_array_equal(a, b)
+            np.testing.assert_array_equal(expected_windows[0], run_all(matrix, slots, riskfree, 230, 11, 50, workers,
+                                                                       windows=windows, sub_batch=sub_batch)[0])
+
+    def test_sub_batch_picks(self):
+        matrix, slots, riskfree = random_scenario(seed=4)
+        n_slots = len(slots[1])
+        whole = run_chunk(matrix, slots, riskfree, 2, 50, 11)
+        parts = run_chunk(matrix, slots, riskfree, 2, 50, 11, sub_batch=16)
+        self.assertEqual(spliced_funds(matrix, whole[-1], 50, n_slots), spliced_funds(matrix, parts[-1], 50, n_slots))
+
+    def test_sub_batch_fits_the_budget(self):
+        self.assertEqual(budget_sub_batch(rss_bytes() + 10**12, 4, 120, 1000, 4), 1000)
+        sub_batch = budget_sub_batch(rss_bytes() + 10**7, 4, 120, 1000, 4)
+        self.assertTrue(1 <= sub_batch < 1000)
+        self.assertTrue(sub_batch == 1 or 4 * sub_batch * 4 * 120 * TRIAL_CELL_BYTES <= 10**7)
+
+    def test_continues_from_a_batch(self):
+        matrix, slots, riskfree = random_scenario(seed=4)
+        expected = run_all(matrix, slots, riskfree, 230, 11, 50)
+        rest = run_all(matrix, slots, riskfree, 230, 11, 50, first_trial=100)
+        for a, b in zip(expected, rest):
+            np.testing.assert_array_equal(a[100:], b)
+
+if __name__ == '__main__':
+    unittest.main()
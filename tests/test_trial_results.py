@@ -0,0 +1,71 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+
+### Trial results file tests ###
+### A run that is interrupted and resumed writes the same trials as one that is not ###
+import os
+import unittest
+import numpy as np
+from helpers import *
+from engine import Scenario, run_scenario
+from trial_results import TrialResultsFile, read_trial_column
+
+def scenario(seed=0):
+    matrix, slots, riskfree = random_scenario(seed)
+    return Scenario(1.05, 1.02, 0.1, matrix, slots, riskfree, {})
+
+class ResumeTest(TempDir, unittest.TestCase):
+
+    def setUp(self):
+        TempDir.setUp(self)
+        self.scenario = scenario()
+
+    def run_to(self, name, trials, resume=False, **kwargs):
+        path = os.path.join(self.tmp, name)
+        summary = run_scenario(self.scenario, trials, seed=5, batch_size=50, results_path=path, resume=resume, 
+                               params={'name':'test'}, **kwargs)
+        return path, summary
+
+    def assertSameRun(self, path, summary, expected_path, expected_summary):
+        for column in TrialResultsFile.columns:
+            self.assertTrue(np.array_equal(read_trial_column(path, column), read_trial_column(expected_path, column)))
+        for key in ['trials', 'passive_win_perc', 'under_median', 'over_median', 'under_stdev', 'over_stdev']:
+            self.assertEqual(repr(summary[key]), repr(expected_summary[key]), key)
+        self.assertTrue(np.array_equal(summary['return_diffs'], expected_summary['return_diffs']))
+
+    def test_resume_after_a_crash(self):
+        expected = self.run_to('whole.trials', 230)
+        path, summary = self.run_to('resumed.trials', 120)
+        # a crash while the third batch was being written
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 100)
+        self.assertEqual(TrialResultsFile.resume(path, {}).trials_done, 100)
+        self.assertSameRun(*(self.run_to('resumed.trials', 230, resume=True) + expected))
+
+    def test_extend_a_finished_run_with_more_workers(self):
+        expected = self.run_to('whole.trials', 230)
+        self.run_to('resumed.trials', 120)
+        self.assertSameRun(*(self.run_to('resumed.trials', 230, resume=True, workers=2) + expected))
+
+    def test_resume_refuses_other_parameters(self):
+        path, summary = self.run_to('resumed.trials', 120)
+        self.assertRaises(ValueError, run_scenario, self.scenario, 230, seed=6, batch_size=50, results_path=path, 
+                          resume=True, params={'name':'test'})
+
+if __name__ == '__main__':
+    unittest.main()
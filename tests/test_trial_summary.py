@@ -0,0 +1,105 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+
+### Trial summary tests ###
+### Exact medians from the kept trials, sketch quantiles within their rank_error otherwise ###
+import unittest
+import numpy as np
+from helpers import *
+from trial_summary import QuantileSketch, TrialSummary, SUMMARY_PERCENTILES
+
+def rank_distance(values, value, q):
+    """ How many ranks value is from the q quantile of values (0 if any of its ranks is q * n) """
+    values = np.sort(values)
+    lo, hi = np.searchsorted(values, value, side='left'), np.searchsorted(values, value, side='right')
+    target = q * len(values)
+    return max(lo - target, target - hi, 0)
+
+class QuantileSketchTest(unittest.TestCase):
+
+    def test_exact_below_capacity(self):
+        values = np.random.RandomState(1).normal(size=1000)
+        sketch = QuantileSketch(capacity=1024).update(values[:400]).update(values[400:])
+        self.assertTrue(sketch.exact())
+        self.assertEqual(sketch.rank_error, 0)
+        self.assertEqual(sketch.median(), np.median(values))
+        self.assertEqual(sketch.quantile(0.05), np.percentile(values, 5))
+
+    def test_quantiles_within_rank_error(self):
+        rng = np.random.RandomState(2)
+        values = np.concatenate((rng.normal(size=60000), rng.standard_cauchy(40000)))
+        sketch = QuantileSketch(capacity=256)
+        for part in np.array_split(values, 97):
+            sketch.update(part)
+        self.assertFalse(sketch.exact())
+        self.assertTrue(0 < sketch.rank_error < len(values))
+        for q in [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]:
+            self.assertTrue(rank_distance(values, sketch.quantile(q), q) <= sketch.rank_error, q)
+
+    def test_merged_sketches_within_rank_error(self):
+        rng = np.random.RandomState(3)
+        parts = [rng.lognormal(size=rng.randint(1, 20000)) for i in range(8)]
+        sketch = QuantileSketch(capacity=128)
+        for part in parts:
+            sketch.merge(QuantileSketch(capacity=128).update(part))
+        values = np.concatenate(parts)
+        self.assertEqual(sketch.n, len(values))
+        for q in [0.1, 0.5, 0.9]:
+            self.assertTrue(rank_distance(values, sketch.quantile(q), q) <= sketch.rank_error, q)
+
+class TrialSummaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.diffs = np.random.RandomState(4).normal(0.5, 3, 20000)
+        self.total = TrialSummary(capacity=256)
+        for part in np.array_split(self.diffs, 13):
+            self.total.update(part)
+
+    def test_exact_with_the_trials(self):
+        summary = self.total.summary(self.diffs)
+        self.assertFalse(summary['approximate'])
+        self.assertEqual(summary['rank_error'], 0)
+        self.assertEqual(summary['percentile_rank_error'], 0)
+        self.assertEqual(summary['under_median'], np.median(self.diffs[self.diffs <= 0]))
+        self.assertEqual(summary['over_median'], np.median(self.diffs[self.diffs > 0]))
+        for p in SUMMARY_PERCENTILES:
+            self.assertEqual(summary['percentiles'][p], np.percentile(self.diffs, p))
+
+    def test_sketched_without_the_trials(self):
+        summary = self.total.summary()
+        self.assertTrue(summary['approximate'])
+        self.assertTrue(summary['rank_error'] > 0)
+        under = self.diffs[self.diffs <= 0]
+        self.assertTrue(rank_distance(under, summary['under_median'], 0.5) <= self.total.under_sketch.rank_error)
+        self.assertEqual(summary['over_stdev'], self.total.summary(self.diffs)['over_stdev'])
+
+    def test_percentiles_within_their_rank_error(self):
+        summary = self.total.summary()
+        # the merge of the under and over sketches compacts again, so its bound is above theirs
+        self.assertTrue(summary['percentile_rank_error'] > summary['rank_error'])
+        for p in SUMMARY_PERCENTILES:
+            self.assertTrue(rank_distance(self.diffs, summary['percentiles'][p], p / 100.0) <= summary['percentile_rank_error'], p)
+
+    def test_small_runs_are_exact_either_way(self):
+        total = TrialSummary().update(self.diffs[:500])
+        summary = total.summary()
+        self.assertFalse(summary['approximate'])
+        self.assertEqual(summary['under_median'], total.summary(self.diffs[:500])['under_median'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,356 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Trial engine ###
+### Runs batches of random active portfolio trials as array operations over a fund x month return matrix ###
+from __future__ import division
+import math
+import ctypes
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+from month_axis import *
+from fund_timeline import *
+from returns_store import *
+from horizon_grid import *
+from run_metrics import *
+
+# funds with fewer returns than this inside the time horizon are never used in a trial (too short)
+MIN_FUND_RETURNS = 6
+# safety net for draws that never manage to fill a slot (e.g. a month no fund has a return for)
+MAX_DRAW_ROUNDS = 1000
+# peak bytes per trial slot month of a batch: combined and covered, plus the fancy-indexed copies of the 
+# first draw round or the cumulative values of trial_stats(), whichever is larger (measured at about 32)
+TRIAL_CELL_BYTES = 40
+
+class ReturnMatrix(object):
+    """ Dense fund x month matrix of returns (R+1) for a time horizon
+
+    Rows are funds sorted by crsp_fundno and columns are the months of the horizon.  Months without a
+    return are NaN in returns and False in valid.  counts is the number of raw returns each fund has in
+    the horizon """
+
+    def __init__(self, fundnos, first_month, returns, valid, counts):
+        self.fundnos = fundnos
+        self.first_month = first_month
+        self.returns = returns
+        self.valid = valid
+        self.counts = counts
+
+    @property
+    def months(self):
+        return self.returns.shape[1]
+
+    def rows(self, fundnos):
+        """ Matrix rows for a list of crsp_fundnos (all of which must be in the matrix) """
+        return np.searchsorted(self.fundnos, np.asarray(fundnos, dtype=np.int64))
+
+    def align(self, series):
+        """ Aligns a monthly pandas series to the matrix months, NaN where the series has no value """
+        aligned = np.empty(self.months)
+        aligned.fill(np.nan)
+        cols = month_ordinals(series.index) - self.first_month
+        inside = (cols >= 0) & (cols < self.months)
+        aligned[cols[inside]] = np.asarray(series, dtype=np.float64)[inside]
+        return aligned
+
+    def candidates(self, timeline, min_returns=MIN_FUND_RETURNS):
+        """ (offsets, rows) of an OpenFundTimeline over the matrix horizon, with members as matrix rows
+
+        Funds with fewer than min_returns returns in the horizon are left out.  The trial loop used to
+        draw these and then redraw, so leaving them out keeps the same draw distribution. """
+        if timeline.first_month != self.first_month or timeline.months != self.months:
+            raise ValueError('Timeline does not cover the same months as the return matrix')
+        long_enough = timeline.restricted(self.fundnos[self.counts >= min_returns])
+        count('short_funds', len(np.unique(timeline.members)) - len(np.unique(long_enough.members)))
+        return long_enough.offsets, self.rows(long_enough.members)
+
+def pack_return_matrix(all_fund_returns, start_date, end_date, fund_list):
+    """ Packs the horizon returns of fund_list into a ReturnMatrix
+
+    all_fund_returns is the crsp pandas return object or a ReturnsPanel.
+    Returns are bucketed by month (multiple returns in a month are multiplied) just like resample('M', how='prod') """
+    fundnos = np.unique(np.asarray(fund_list, dtype=np.int64))
+    first_month, last_month = month_ordinal(start_date), month_ordinal(end_date)
+    n_months = last_month - first_month + 1
+
+    if isinstance(all_fund_returns, ReturnsPanel):
+        all_funds, all_months, values = all_fund_returns.take(fundnos)
+    else:
+        all_funds = np.asarray(all_fund_returns.index.get_level_values(0), dtype=np.int64)
+        all_months = month_ordinals(all_fund_returns.index.get_level_values(1))
+        values = np.asarray(all_fund_returns['Return'], dtype=np.float64)
+    keep = np.in1d(all_funds, fundnos) & (all_months >= first_month) & (all_months <= last_month)
+    rows = np.searchsorted(fundnos, all_funds[keep])
+    cells = rows * n_months + (all_months[keep] - first_month)
+    values = values[keep]
+
+    # multiply returns falling into the same cell (stable sort keeps date order within the month)
+    order = np.argsort(cells, kind='mergesort')
+    cells, values = cells[order], values[order]
+    returns = np.empty(len(fundnos) * n_months)
+    returns.fill(np.nan)
+    if len(cells):
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        returns[cells[starts]] = np.multiply.reduceat(values, starts)
+        count('resamples', len(cells) - len(starts))
+    returns = returns.reshape(len(fundnos), n_months)
+    return ReturnMatrix(fundnos, first_month, returns, ~np.isnan(returns), np.bincount(rows, minlength=len(fundnos)))
+
+def trial_slots(port_def, timelines, matrix, active_picks=1):
+    """ Expands a portfolio into one slot per active pick
+
+    timelines holds the OpenFundTimeline of each asset class's fund list.  Returns
+    (names, weights, slot_class, offsets, members): the candidate rows open at month t for the asset
+    class c of a slot are members[offsets[c*months+t]:offsets[c*months+t+1]] """
+    names, weights, slot_class, offsets, members = [], [], [], [], []
+    base = 0
+    for c, asset_class in enumerate(port_def.keys()):
+        class_offsets, class_members = matrix.candidates(timelines[asset_class])
+        offsets.append(class_offsets[:-1] + base)
+        members.append(class_members)
+        base += len(class_members)
+        for pick in range(active_picks):
+            names.append(asset_class)
+            weights.append(port_def[asset_class]['alloc'] / active_picks) #each pick will be equally weighted
+            slot_class.append(c)
+    offsets.append([base])
+    return names, np.array(weights), np.array(slot_class), np.concatenate(offsets), np.concatenate(members)
+
+def run_trial_batch(matrix, slots, riskfree, size, rng, first=0):
+    """ Runs a batch of trials, returns (trial_returns, excess_returns, stddevs, sharpes, picks)
+
+    Funds are drawn as in draw_trial_batch().  Portfolio values are buy-and-hold, riskfree is the monthly
+    risk-free return (R+1) aligned to the matrix months. """
+    combined, picks = draw_trial_batch(matrix, slots, size, rng, first)
+    trial_returns, excess_returns, stddevs, sharpes = trial_stats(combined, slots[1], riskfree)
+    return trial_returns, excess_returns, stddevs, sharpes, picks
+
+def run_horizon_batch(matrix, slots, windows, size, rng, first=0):
+    """ Runs a batch of trials over the whole matrix horizon and returns (trials x windows annualized returns,
+    picks) for each window (see horizon_grid.py), from the same draws run_trial_batch() makes """
+    combined, picks = draw_trial_batch(matrix, slots, size, rng, first)
+    return window_returns(prefix_log_returns(combined), slots[1], windows), picks
+
+class ChunkDraws(object):
+    """ The uniform draws of a chunk of trials: round r is a trials x slots array, taken from the chunk's 
+    random stream the first time a trial of the chunk reaches that round
+
+    A trial's funds then only depend on the stream and the trial's place in the chunk, not on which of the
+    chunk's trials are drawn together, so a chunk can be run a few trials at a time (see run_chunk()). """
+
+    def __init__(self, rng, size, n_slots):
+        self.rng = rng
+        self.shape = (size, n_slots)
+        self.rounds = []
+
+    def round(self, r):
+        while len(self.rounds) <= r:
+            self.rounds.append(self.rng.random_sample(self.shape))
+        return self.rounds[r]
+
+def draw_trial_batch(matrix, slots, size, rng, first=0):
+    """ Draws the funds of a batch of trials, returns (combined, picks)
+
+    Each slot starts with a fund open at the start of the horizon, and whenever the spliced series still
+    has a gap (a fund died) another fund open at the first missing month is drawn and spliced in.
+    All slots of the batch draw together, one round per replacement.  rng is a RandomState or the 
+    ChunkDraws of a chunk the batch is part of, starting at its trial first.
+    combined is the trials x slots x months array of spliced returns (R+1).
+    picks is a list of (trial, slot, row) arrays, one per round, of the funds that were spliced in """
+    names, weights, slot_class, offsets, members = slots
+    n_slots, n_months = len(weights), matrix.months
+    draws = rng if isinstance(rng, ChunkDraws) else ChunkDraws(rng, size, n_slots)
+    combined = np.empty((size, n_slots, n_months))
+    combined.fill(np.nan)
+    covered = np.zeros((size, n_slots, n_months), dtype=bool)
+
+    picks = []
+    trial_idx, slot_idx = [a.ravel() for a in np.indices((size, n_slots))]
+    for draw_round in range(MAX_DRAW_ROUNDS):
+        cov = covered[trial_idx, slot_idx]
+        month = cov.argmin(axis=1) # first month still missing
+        key = slot_class[slot_idx] * n_months + month
+        start, n = offsets[key], offsets[key+1] - offsets[key]
+        if not n.all():
+            empty = np.flatnonzero(n == 0)[0]
+            raise ValueError('No open funds to draw from for %s in %s' % \
+                             (names[slot_idx[empty]], datetime_from_ordinal(matrix.first_month + month[empty])))
+        row = members[start + (draws.round(draw_round)[first + trial_idx, slot_idx] * n).astype(np.int64)]
+
+        # splice the drawn fund into the months that are still missing
+        fill = matrix.valid[row] & ~cov
+        comb = combined[trial_idx, slot_idx]
+        comb[fill] = matrix.returns[row][fill]
+        combined[trial_idx, slot_idx] = comb
+        cov |= fill
+        covered[trial_idx, slot_idx] = cov
+
+        used = fill.any(axis=1)
+        picks.append((trial_idx[used], slot_idx[used], row[used]))
+        count('draw_rounds')
+        count('draws', len(row))
+        count('redraws', len(row) - used.sum()) # drawn funds with nothing to splice in, drawn again
+        if draw_round:
+            count('splices', used.sum()) # replacements of funds that died
+        missing = ~cov.all(axis=1)
+        trial_idx, slot_idx = trial_idx[missing], slot_idx[missing]
+        if not len(trial_idx):
+            break
+    else:
+        raise RuntimeError('Trials could not fill %s slots after %s draws' % (len(trial_idx), MAX_DRAW_ROUNDS))
+    return combined, picks
+
+def trial_stats(combined, weights, riskfree):
+    """ (trial_returns, excess_returns, stddevs, sharpes) of the spliced slot returns of a batch of trials """
+    size, n_slots, n_months = combined.shape
+
+    # To calculate the portfolio return without rebalancing, start each slot with its weight (like a $1
+    # investment), sum the cumulative values for each month to get the portfolio value, then take the return
+    values = np.empty((size, n_slots, n_months+1))
+    values[:,:,0] = weights
+    values[:,:,1:] = combined
+    pf_values = values.cumprod(axis=2).sum(axis=1)
+    pf_returns = pf_values[:,1:] / pf_values[:,:-1]
+    # the leading weight month counts toward the period, the same as get_portfolio_return()
+    trial_returns = np.prod(pf_returns, axis=1)**(12/(n_months+1))
+
+    # excess return and annualized stddev (for sharpe calculation)
+    has_rf = ~np.isnan(riskfree)
+    excess = pf_returns[:,has_rf] - (riskfree[has_rf] - 1)
+    excess_returns = np.prod(excess, axis=1)**(12/has_rf.sum())
+    # summed in month order (cumsum), so a trial's stddev is the same to the last bit whatever batch it is
+    # in: np.std's pairwise sums round differently with the shape and place in memory of the batch
+    n = excess.shape[1]
+    deviations = excess - (np.cumsum(excess, axis=1)[:, -1] / n)[:, None]
+    stddevs = np.sqrt(np.cumsum(deviations**2, axis=1)[:, -1] / (n - 1)) * math.sqrt(12)
+    return trial_returns, excess_returns, stddevs, (excess_returns - 1) / stddevs
+
+def spliced_funds(matrix, picks, size, n_slots):
+    """ crsp_fundnos spliced into each trial slot in draw order, as funds[trial][slot] lists """
+    funds = [[[] for slot in range(n_slots)] for trial in range(size)]
+    for trial_idx, slot_idx, rows in picks:
+        for trial, slot, fundno in zip(trial_idx, slot_idx, matrix.fundnos[rows]):
+            funds[trial][slot].append(fundno)
+    return funds
+
+def chunk_rng(seed, chunk):
+    """ Random stream for one chunk of trials, seeded by (seed, chunk) so the stream does not depend on
+    which process runs the chunk or how many processes there are """
+    return np.random.RandomState([seed, chunk])
+
+def budget_sub_batch(memory_budget, n_slots, n_months, batch_size=1000, workers=1):
+    """ How many trials of a chunk of batch_size each of the workers should run at once to fit in what the 
+    memory budget (bytes) leaves after the current RSS: batch_size, halved until it fits (at least 1) """
+    room = memory_budget - rss_bytes()
+    sub_batch = batch_size
+    while sub_batch > 1 and workers * sub_batch * n_slots * n_months * TRIAL_CELL_BYTES > room:
+        sub_batch //= 2
+    return sub_batch
+
+def run_trials(matrix, slots, riskfree, trials, seed, batch_size=1000, workers=1, windows=None, first_trial=0,
+               sub_batch=None):
+    """ Runs the trials in chunks of batch_size, yields (first_trial, run_trial_batch results) in trial order
+
+    Every chunk draws from its own chunk_rng() stream, so a given seed and batch_size give the same trials
+    whether they run here (workers=1) or spread over a pool of worker processes, and a run can be continued
+    from any chunk boundary by passing it as first_trial.  Workers attach to a single shared-memory copy of
+    the matrix, candidate timelines and risk-free returns.  With sub_batch, each chunk is run that many
+    trials at a time to save memory, which gives the same trials (see run_chunk()).
+    With windows (see horizon_grid.py), the results are those of run_horizon_batch() instead. """
+    if first_trial % batch_size:
+        raise ValueError('Trials can only be continued from a multiple of the batch size')
+    chunks = [(chunk, start, min(batch_size, trials - start), seed, windows, sub_batch) 
+              for chunk, start in enumerate(range(0, trials, batch_size)) if start >= first_trial]
+    if not chunks:
+        return
+    if workers <= 1:
+        for chunk, start, size, seed, windows, sub_batch in chunks:
+            yield start, run_chunk(matrix, slots, riskfree, chunk, size, seed, windows, sub_batch)
+        return
+
+    shared = share_arrays(trial_arrays(matrix, slots, riskfree))
+    pool = Pool(workers, initializer=_attach_worker, initargs=(shared, slots[0], matrix.first_month))
+    try:
+        for start, results, taken in pool.imap(_run_chunk, chunks):
+            metrics.merge(taken)
+            yield start, results
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def trial_arrays(matrix, slots, riskfree):
+    """ The arrays a trial worker needs, by name """
+    names, weights, slot_class, offsets, members = slots
+    return {'fundnos':matrix.fundnos, 'returns':matrix.returns, 'valid':matrix.valid, 'counts':matrix.counts, 
+            'weights':weights, 'slot_class':slot_class, 'offsets':offsets, 'members':members, 'riskfree':riskfree}
+
+def share_arrays(arrays):
+    """ Copies a dict of arrays into shared memory, returns name -> (buffer, dtype, shape) for attach_arrays() """
+    shared = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        buf = RawArray(ctypes.c_char, max(array.nbytes, 1))
+        np.frombuffer(buf, dtype=array.dtype, count=array.size)[:] = array.ravel()
+        shared[name] = (buf, array.dtype.str, array.shape)
+    return shared
+
+def attach_arrays(shared):
+    """ Numpy views onto arrays copied into shared memory by share_arrays() (no copying) """
+    arrays = {}
+    for name, (buf, dtype, shape) in shared.items():
+        arrays[name] = np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    return arrays
+
+_worker = {}
+
+def _attach_worker(shared, slot_names, first_month):
+    """ Pool initializer: rebuilds the matrix and slots as views onto the shared arrays """
+    a = attach_arrays(shared)
+    _worker['matrix'] = ReturnMatrix(a['fundnos'], first_month, a['returns'], a['valid'], a['counts'])
+    _worker['slots'] = (slot_names, a['weights'], a['slot_class'], a['offsets'], a['members'])
+    _worker['riskfree'] = a['riskfree']
+    metrics.take() # drop what was recorded before the fork, the parent has it
+
+def run_chunk(matrix, slots, riskfree, chunk, size, seed, windows=None, sub_batch=None):
+    """ Runs the trials of a chunk, sub_batch trials at a time if given, all drawn from the chunk's ChunkDraws
+    so the results are the same however the chunk is split """
+    draws = ChunkDraws(chunk_rng(seed, chunk), size, len(slots[1]))
+    count('trials', size)
+    parts = []
+    with phase('trial batch', chunk=chunk):
+        for first in range(0, size, sub_batch or size):
+            n = min(sub_batch or size, size - first)
+            if windows is not None:
+                parts.append(run_horizon_batch(matrix, slots, windows, n, draws, first))
+            else:
+                parts.append(run_trial_batch(matrix, slots, riskfree, n, draws, first))
+    return join_batches(parts, sub_batch or size)
+
+def join_batches(parts, sub_batch):
+    """ The results of consecutive batches of sub_batch trials as those of one batch (picks renumbered) """
+    if len(parts) == 1:
+        return parts[0]
+    picks = [(trial_idx + i * sub_batch, slot_idx, rows) for i, part in enumerate(parts) 
+             for trial_idx, slot_idx, rows in part[-1]]
+    return tuple(np.concatenate([part[k] for part in parts]) for k in range(len(parts[0]) - 1)) + (picks,)
+
+def _run_chunk(args):
+    chunk, start, size, seed, windows, sub_batch = args
+    results = run_chunk(_worker['matrix'], _worker['slots'], _worker['riskfree'], chunk, size, seed, windows, sub_batch)
+    return start, results, metrics.take()
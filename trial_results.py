@@ -0,0 +1,156 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Trial results file ###
+### Trial results appended to disk batch by batch as they finish, so long runs can be resumed, and the per trial log ###
+import os
+import json
+import struct
+import numpy as np
+
+MAGIC = 'TRIALS1\n'
+# (first trial, number of trials) at the start of every batch
+BATCH_HEADER = struct.Struct('<qq')
+
+class TrialResultsFile(object):
+    """ Binary file of trial results: a header with the run parameters, then one record per batch of trials
+
+    The header is MAGIC, the length of the parameters json (8 bytes, little endian) and the json.  A batch
+    record is BATCH_HEADER followed by the columns, each as count little endian float64.  Every record is
+    flushed and synced to disk before the next batch is run, so a run that dies loses at most the batch in
+    progress; a record cut short by the crash is dropped when the file is opened again.
+
+    The random stream of every batch is seeded by (seed, batch number) (see trial_engine.chunk_rng()), so the
+    seed and batch size in the parameters are the whole random state of the run: resuming after the last
+    complete batch draws exactly the trials an uninterrupted run would have. """
+
+    columns = ['trial_returns', 'excess_returns', 'stddevs', 'sharpes']
+
+    def __init__(self, path, params, trials_done, f):
+        self.path = path
+        self.params = params
+        self.trials_done = trials_done
+        self.f = f
+
+    @classmethod
+    def create(cls, path, params):
+        """ Starts a new results file (replacing any there) for a run with the given parameters (a json-able dict) """
+        header = json.dumps(params, sort_keys=True)
+        f = open(path, 'wb')
+        f.write(MAGIC + struct.pack('<q', len(header)) + header)
+        cls._sync(f)
+        return cls(path, params, 0, f)
+
+    @classmethod
+    def resume(cls, path, params, ignore=('trials',)):
+        """ Reopens a results file to append to it, after checking it was written for the same parameters
+        (except those in ignore, so e.g. a run can be extended to more trials).  Parameters that are None
+        are taken from the file (e.g. the seed) """
+        header, batches, end = cls.scan(path)
+        merged = dict(params)
+        for key, value in header.items():
+            if merged.get(key) is None:
+                merged[key] = value
+        different = [key for key in set(header).union(merged) if key not in ignore and header.get(key) != merged.get(key)]
+        if different:
+            raise ValueError('%s was written for different parameters (%s), not resuming' % (path, ', '.join(sorted(different))))
+        # keep the batches an uninterrupted run of merged['trials'] would have made: a short last batch is 
+        # redrawn in full when the run is extended
+        if merged.get('trials') is not None and merged.get('batch_size'):
+            kept = 0
+            while kept < len(batches) and batches[kept][1] == min(merged['batch_size'], merged['trials'] - batches[kept][0]):
+                kept += 1
+            if kept < len(batches):
+                end = batches[kept][2] - BATCH_HEADER.size
+            batches = batches[:kept]
+        f = open(path, 'r+b')
+        f.truncate(end) # drop a batch cut short by a crash
+        f.seek(end)
+        return cls(path, merged, sum(count for start, count, offset in batches), f)
+
+    @staticmethod
+    def scan(path):
+        """ (parameters, [(first trial, count, data offset) of each complete batch], end of the last complete batch) """
+        f = open(path, 'rb')
+        try:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a trial results file' % path)
+            length, = struct.unpack('<q', f.read(8))
+            params = json.loads(f.read(length))
+            size = os.fstat(f.fileno()).st_size
+            batches = []
+            end = f.tell()
+            while end + BATCH_HEADER.size <= size:
+                start, count = BATCH_HEADER.unpack(f.read(BATCH_HEADER.size))
+                data_end = end + BATCH_HEADER.size + 8 * count * len(TrialResultsFile.columns)
+                if data_end > size:
+                    break
+                batches.append((start, count, end + BATCH_HEADER.size))
+                f.seek(data_end)
+                end = data_end
+            return params, batches, end
+        finally:
+            f.close()
+
+    def append(self, start, results):
+        """ Writes a batch of trials (the run_trial_batch() result arrays, in columns order) and syncs it to disk """
+        arrays = [np.asarray(a, dtype='<f8') for a in results[:len(self.columns)]]
+        self.f.write(BATCH_HEADER.pack(start, len(arrays[0])) + ''.join(a.tostring() for a in arrays))
+        self._sync(self.f)
+        self.trials_done += len(arrays[0])
+
+    def close(self):
+        self.f.close()
+
+    @staticmethod
+    def _sync(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+def read_trial_batches(path):
+    """ Yields (first trial, {column: array}) for each complete batch of a results file, one batch in memory at a time """
+    params, batches, end = TrialResultsFile.scan(path)
+    f = open(path, 'rb')
+    try:
+        for start, count, offset in batches:
+            f.seek(offset)
+            data = np.fromstring(f.read(8 * count * len(TrialResultsFile.columns)), dtype='<f8')
+            yield start, dict(zip(TrialResultsFile.columns, data.reshape(len(TrialResultsFile.columns), count)))
+    finally:
+        f.close()
+
+def read_trial_column(path, column):
+    """ One column of all the trials of a results file as an array, in trial order """
+    parts = [batch[column] for start, batch in read_trial_batches(path)]
+    return np.concatenate(parts) if parts else np.zeros(0)
+
+class TrialLog(object):
+    """ Json lines file of per trial detail, one object per trial, written a batch of trials at a time
+
+    Appending when a run resumes can repeat the trials of a batch that was logged but not saved to the results
+    file before a crash; the trial number in each record tells them apart. """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.f = open(path, 'a' if append else 'w')
+
+    def append(self, records):
+        self.f.write(''.join(json.dumps(record, sort_keys=True) + '\n' for record in records))
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
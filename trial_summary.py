@@ -0,0 +1,210 @@
+# Copyright 2013 Betterment
+
+# This file is part of The Index Portfolio Whitepaper Engine.
+
+# The Index Portfolio Whitepaper Engine is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The Index Portfolio Whitepaper Engine is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with The Index Portfolio Whitepaper Engine.  If not, see <http://www.gnu.org/licenses/>.
+
+### Trial summary ###
+### Win percentages, medians and stddevs of trial results, accumulated batch by batch and mergeable ###
+from __future__ import division
+import numpy as np
+
+# values a quantile sketch keeps per level; quantiles are exact until more than this many values are added
+SKETCH_CAPACITY = 4096
+# percentiles of the return differences reported in the summary
+SUMMARY_PERCENTILES = [5, 25, 50, 75, 95]
+
+class RunningMoments(object):
+    """ Count, mean and sum of squared deviations (Welford), updated a batch at a time and merged exactly
+    (Chan et al.'s pairwise combination) """
+
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if len(values):
+            mean = values.mean()
+            self.merge(RunningMoments(len(values), mean, ((values - mean)**2).sum()))
+        return self
+
+    def merge(self, other):
+        n = self.n + other.n
+        if other.n:
+            delta = other.mean - self.mean
+            self.mean += delta * other.n / n
+            self.m2 += other.m2 + delta**2 * self.n * other.n / n
+            self.n = n
+        return self
+
+    def std(self):
+        """ Population stddev (as np.std), NaN without values """
+        return np.sqrt(np.float64(self.m2) / self.n) if self.n else np.float64(np.nan)
+
+class QuantileSketch(object):
+    """ Mergeable quantile sketch (a compactor hierarchy as in KLL, with a fixed capacity per level)
+
+    Values are added to level 0.  When a level holds more than capacity values it is sorted and every other
+    value moves up a level with twice the weight (alternating which half moves), so memory stays at about
+    capacity * log2(n / capacity) values.  Each compaction at level h moves ranks by at most 2**h;
+    rank_error is the sum over all compactions so far, a bound on how far the rank of a returned quantile
+    is from the exact one (in practice it is far smaller).  Until the first compaction, quantiles are exact
+    and the median matches np.median. """
+
+    def __init__(self, capacity=SKETCH_CAPACITY):
+        self.capacity = capacity
+        self.levels = [np.zeros(0)]
+        self.offsets = [0]
+        self.rank_error = 0
+        self.n = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self.n += len(values)
+        self.compact()
+        return self
+
+    def merge(self, other):
+        """ Adds another sketch's values (the result is as good as a sketch of both sets of values) """
+        if other.capacity != self.capacity:
+            raise ValueError('Cannot merge quantile sketches of different capacities')
+        for h, level in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.zeros(0))
+                self.offsets.append(0)
+            self.levels[h] = np.concatenate((self.levels[h], level))
+        self.n += other.n
+        self.rank_error += other.rank_error
+        self.compact()
+        return self
+
+    def compact(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) > self.capacity:
+                level = np.sort(level)
+                paired = len(level) - len(level) % 2 # an odd value out stays on this level
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.zeros(0))
+                    self.offsets.append(0)
+                self.levels[h+1] = np.concatenate((self.levels[h+1], level[self.offsets[h]:paired:2]))
+                self.levels[h] = level[paired:]
+                self.offsets[h] = 1 - self.offsets[h]
+                self.rank_error += 2**h
+            h += 1
+
+    def exact(self):
+        return len(self.levels) == 1
+
+    def quantile(self, q):
+        """ Value at quantile q (0-1), NaN when empty """
+        if not self.n:
+            return np.float64(np.nan)
+        if self.exact():
+            return np.percentile(self.levels[0], q * 100)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.repeat(2.0**h, len(level)) for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind='mergesort')
+        cumulative = np.cumsum(weights[order])
+        return values[order][min(np.searchsorted(cumulative, q * cumulative[-1]), len(values) - 1)]
+
+    def median(self):
+        return self.quantile(0.5)
+
+class TrialSummary(object):
+    """ Running summary of trial return differences (active - passive, in %) and sharpe ratio differences
+
+    Passive wins a trial when its return difference is below 0.  Underperformers are the differences <= 0 and
+    outperformers those > 0, each with running moments and a quantile sketch.  Summaries of separate
+    batches, workers or shards merge into the summary of all of them: counts and moments exactly, medians
+    within the sketches' rank_error.  The sketches only stand in for the trials when these are not kept 
+    (see summary()). """
+
+    def __init__(self, capacity=SKETCH_CAPACITY):
+        self.trials = 0
+        self.passive_wins = 0
+        self.sharpe_trials = 0
+        self.sharpe_passive_wins = 0
+        self.under = RunningMoments()
+        self.over = RunningMoments()
+        self.under_sketch = QuantileSketch(capacity)
+        self.over_sketch = QuantileSketch(capacity)
+
+    def update(self, return_diffs, sharpe_diffs=None):
+        return_diffs = np.asarray(return_diffs, dtype=np.float64)
+        under = return_diffs <= 0
+        self.trials += len(return_diffs)
+        self.passive_wins += int((return_diffs < 0).sum())
+        self.under.update(return_diffs[under])
+        self.over.update(return_diffs[~under])
+        self.under_sketch.update(return_diffs[under])
+        self.over_sketch.update(return_diffs[~under])
+        if sharpe_diffs is not None:
+            sharpe_diffs = np.asarray(sharpe_diffs, dtype=np.float64)
+            self.sharpe_trials += len(sharpe_diffs)
+            self.sharpe_passive_wins += int((sharpe_diffs < 0).sum())
+        return self
+
+    def merge(self, other):
+        self.trials += other.trials
+        self.passive_wins += other.passive_wins
+        self.sharpe_trials += other.sharpe_trials
+        self.sharpe_passive_wins += other.sharpe_passive_wins
+        self.under.merge(other.under)
+        self.over.merge(other.over)
+        self.under_sketch.merge(other.under_sketch)
+        self.over_sketch.merge(other.over_sketch)
+        return self
+
+    def percentile_sketch(self):
+        """ A sketch of all the return differences, merging the under and over sketches (its rank_error 
+        includes the compactions of the merge) """
+        return QuantileSketch(self.under_sketch.capacity).merge(self.under_sketch).merge(self.over_sketch)
+
+    def percentile(self, p):
+        """ Percentile (0-100) of all the return differences, from the sketches """
+        return self.percentile_sketch().quantile(p / 100)
+
+    def summary(self, return_diffs=None):
+        """ The summary as a dict: passive_win_perc, sharpe_win_perc, under/over_median, under/over_stdev,
+        percentiles of the return differences and the trial count
+
+        With return_diffs (the return differences of all the trials summarized) the medians and percentiles
+        are exact.  Without, they come from the sketches: approximate is then True once the sketches have
+        compacted, rank_error bounds how many ranks the medians can be off by and percentile_rank_error the
+        same for the percentiles (both 0 when exact). """
+        if return_diffs is not None:
+            return_diffs = np.asarray(return_diffs, dtype=np.float64)
+            under, over = return_diffs[return_diffs <= 0], return_diffs[return_diffs > 0]
+            medians = [np.median(d) if len(d) else np.float64(np.nan) for d in (under, over)]
+            percentiles = dict((p, np.percentile(return_diffs, p) if len(return_diffs) else np.float64(np.nan))
+                               for p in SUMMARY_PERCENTILES)
+            rank_error = percentile_rank_error = 0
+        else:
+            medians = [self.under_sketch.median(), self.over_sketch.median()]
+            both = self.percentile_sketch()
+            percentiles = dict((p, both.quantile(p / 100)) for p in SUMMARY_PERCENTILES)
+            rank_error = self.under_sketch.rank_error + self.over_sketch.rank_error
+            percentile_rank_error = both.rank_error
+        return {'trials':self.trials,
+                'passive_win_perc':round(self.passive_wins / self.trials * 100, 1) if self.trials else np.nan,
+                'sharpe_win_perc':round(self.sharpe_passive_wins / self.sharpe_trials * 100, 1) if self.sharpe_trials else np.nan,
+                'under_median':medians[0], 'over_median':medians[1],
+                'under_stdev':self.under.std(), 'over_stdev':self.over.std(),
+                'percentiles':percentiles, 'approximate':max(rank_error, percentile_rank_error) > 0, 
+                'rank_error':rank_error, 'percentile_rank_error':percentile_rank_error}